@@ -0,0 +1,83 @@
+import os
+import queue
+import threading
+import time
+import torch
+
+
+class AsyncWriter:
+    # runs write jobs (torch.save, image saves, ...) on a background thread so the caller keeps computing;
+    # the first failing job is re-raised in the caller on the next submit/flush/close
+    #
+    # max_pending bounds the queue: once that many jobs are waiting, submit blocks (backpressure),
+    # so a slow disk cannot pile up an unbounded number of tensors in memory
+    def __init__(self, name='writer', max_pending=0):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.written = []
+        self.stats = {'jobs': 0, 'write_s': 0.0, 'blocked_s': 0.0, 'sync_s': 0.0}
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        self._raise_error()
+        start = time.perf_counter()
+        self.queue.put((fn, args, kwargs))
+        self.stats['blocked_s'] += time.perf_counter() - start
+
+    def save_tensor(self, tensor, path):
+        # detached cpu copy, so the caller is free to reuse or overwrite its tensor right away
+        self.submit(self._save_tensor, tensor.detach().to('cpu', copy=True), path)
+
+    def _save_tensor(self, tensor, path):
+        torch.save(tensor, path)
+        self.written.append(path)
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                break
+            fn, args, kwargs = job
+            try:
+                if self.error is None:
+                    start = time.perf_counter()
+                    fn(*args, **kwargs)
+                    self.stats['write_s'] += time.perf_counter() - start
+                    self.stats['jobs'] += 1
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise RuntimeError(f'background write failed: {self.error!r}') from self.error
+
+    def flush(self, fsync=False):
+        # barrier: block until every submitted job has run, optionally until the files are on disk
+        self.queue.join()
+        self._raise_error()
+        written, self.written = self.written, []
+        if fsync:
+            start = time.perf_counter()
+            for path in written + sorted({os.path.dirname(path) or '.' for path in written}):
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            self.stats['sync_s'] += time.perf_counter() - start
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,66 @@
+import argparse
+import torch
+import yaml
+
+from diffstyler import PNP
+from pnp_utils_combine import seed_everything
+from bench_utils import time_fn, print_table, write_results
+
+# per-step latency of PNP.denoise_step: legacy eager, gated eager and torch.compile'd gated
+
+
+def time_steps(pnp, n_steps, iters):
+    timesteps = pnp.scheduler.timesteps[:n_steps]
+
+    def run():
+        for t in timesteps:
+            pnp.denoise_step(pnp.eps, t)
+
+    with torch.no_grad():
+        result = time_fn(run, device=pnp.device, warmup=1, iters=iters)
+    return result['mean_ms'] / len(timesteps)
+
+
+def run(opt):
+    with open(opt.config_path, "r") as f:
+        config = yaml.safe_load(f)
+    config["device"] = opt.device
+    if opt.compile_mode is not None:
+        config["compile_mode"] = opt.compile_mode
+    if opt.compile_cache_dir is not None:
+        config["compile_cache_dir"] = opt.compile_cache_dir
+    seed_everything(config["seed"])
+
+    config["compile"] = False
+    pnp = PNP(config)
+    rows = []
+
+    pnp.init_pnp(conv_injection_t=50, qk_injection_t=50)
+    rows.append({'variant': 'eager', 'step_ms': time_steps(pnp, opt.steps, opt.iters)})
+
+    config["compile"] = True
+    pnp.init_pnp(conv_injection_t=50, qk_injection_t=50)
+    rows.append({'variant': 'eager-gated', 'step_ms': time_steps(pnp, opt.steps, opt.iters)})
+
+    pnp.compile_unets()
+    rows.append({'variant': 'compiled-gated', 'step_ms': time_steps(pnp, opt.steps, opt.iters)})
+
+    base = rows[0]['step_ms']
+    for row in rows:
+        row['speedup'] = base / row['step_ms']
+    print_table(rows, ['variant', 'step_ms', 'speedup'])
+    write_results(opt.output, rows, meta={'config': opt.config_path, 'device': opt.device,
+                                          'loras': len(pnp.lora_models), 'threads': torch.get_num_threads()})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config_path', type=str, default='configs/config-girl1.yaml')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--steps', type=int, default=5, help='sampling steps timed per iteration')
+    parser.add_argument('--iters', type=int, default=2)
+    parser.add_argument('--compile_mode', type=str, default=None)
+    parser.add_argument('--compile_cache_dir', type=str, default=None)
+    parser.add_argument('--output', type=str, default='benchmarks/compile.json')
+    opt = parser.parse_args()
+    run(opt)
@@ -0,0 +1,90 @@
+import argparse
+import os
+import tempfile
+import time
+import torch
+
+from bench_utils import image_metrics, print_table, synchronize, write_results
+from feature_cache import register_feature_cache, remove_feature_cache
+from pnp_utils_combine import seed_everything
+
+# latency / quality of cross-step feature caching (feature_cache.py) at different refresh intervals
+#
+#   python bench_feature_cache.py --intervals 2 3 5
+#   python bench_feature_cache.py --config_path configs/config-girl1.yaml --intervals 2 3 5 --shallow_levels 1 2
+#
+# For every interval and split the whole sample_loop is timed and its output compared with the uncached one.
+# Without --config_path the tiny random models of tiny_models.py are used: the timings show the trend
+# offline, use a real config for the quality numbers.
+
+
+def build_pnp(opt):
+    from diffstyler import PNP
+    if opt.config_path is not None:
+        import yaml
+        with open(opt.config_path, "r") as f:
+            config = yaml.safe_load(f)
+        models = None
+    else:
+        from tiny_models import build_tiny_models, build_tiny_workspace
+        config = build_tiny_workspace(opt.workdir, build_tiny_models(seed=opt.seed), n_loras=opt.loras, seed=opt.seed)
+        models = build_tiny_models(seed=opt.seed)
+    config = dict(config, output_path=os.path.join(opt.workdir, 'results'), feature_cache=None)
+    os.makedirs(config["output_path"], exist_ok=True)
+    seed_everything(config["seed"])
+    pnp = PNP(config, models=models)
+    pnp.init_pnp(conv_injection_t=int(config["n_timesteps"] * config["pnp_f_t"]),
+                 qk_injection_t=int(config["n_timesteps"] * config["pnp_attn_t"]))
+    return pnp
+
+
+@torch.no_grad()
+def run_setting(opt, pnp, interval, shallow_levels):
+    unets = list(dict.fromkeys([pnp.unet] + [lora_model['unet'] for lora_model in pnp.lora_models]))
+    for unet in unets:
+        if interval > 1:
+            register_feature_cache(unet, interval, shallow_levels=shallow_levels)
+        else:
+            remove_feature_cache(unet)
+    seed_everything(opt.seed)
+    start = time.perf_counter()
+    image = pnp.sample_loop(pnp.eps)
+    synchronize(pnp.device)
+    row = {'interval': interval, 'shallow_levels': shallow_levels if interval > 1 else '-',
+           'sampling_s': time.perf_counter() - start}
+    cache = getattr(pnp.unet, 'feature_cache', None)
+    row['full_steps'] = cache.stats['full'] if cache is not None else len(pnp.scheduler.timesteps)
+    return image, row
+
+
+def run(opt):
+    opt.workdir = opt.workdir or tempfile.mkdtemp(prefix='diffstyler-cache-')
+    pnp = build_pnp(opt)
+    # one run first so lazy initialization is not charged to the reference
+    run_setting(opt, pnp, 1, 1)
+    reference, reference_row = run_setting(opt, pnp, 1, 1)
+    rows = [dict(reference_row, speedup=1.0)]
+    for shallow_levels in opt.shallow_levels:
+        for interval in opt.intervals:
+            image, row = run_setting(opt, pnp, interval, shallow_levels)
+            row.update(image_metrics(reference, image))
+            row['speedup'] = reference_row['sampling_s'] / row['sampling_s']
+            print(f'[INFO] interval {interval}, shallow levels {shallow_levels}: {row["speedup"]:.2f}x, '
+                  f'psnr {row["psnr_db"]:.2f} dB')
+            rows.append(row)
+    print_table(rows, ['interval', 'shallow_levels', 'full_steps', 'sampling_s', 'speedup', 'psnr_db', 'mean_abs'])
+    write_results(opt.output, rows, meta={'config': opt.config_path, 'n_timesteps': len(pnp.scheduler.timesteps),
+                                          'torch': torch.__version__, 'seed': opt.seed})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config_path', type=str, default=None, help="real config; tiny random models if not set")
+    parser.add_argument('--intervals', type=int, nargs='+', default=[2, 3, 5], help="full UNet every N steps")
+    parser.add_argument('--shallow_levels', type=int, nargs='+', default=[1], help="resolution levels recomputed every step")
+    parser.add_argument('--loras', type=int, default=1, help="LoRAs of the tiny workspace")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', type=str, default=None, help="outputs, a temp dir if not set")
+    parser.add_argument('--output', type=str, default='benchmarks/feature_cache.json')
+    opt = parser.parse_args()
+    run(opt)
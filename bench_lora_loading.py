@@ -0,0 +1,85 @@
+import argparse
+import os
+import tempfile
+import torch
+from safetensors.torch import save_file
+
+from lora_registry import LoRARegistry, load_lora_state_dict
+from precision import get_device
+from bench_utils import time_fn, print_table, write_results
+
+# LoRA loading time of pickled .ckpt vs memory-mapped .safetensors files
+#
+#   python bench_lora_loading.py                          # synthetic SD 2.1 sized adapters
+#   python bench_lora_loading.py --paths lora_models/*.safetensors lora_models/*.ckpt
+#
+# Reports single-file load time to the device and the time for the registry to load all files concurrently.
+# Files are read from the page cache after the first load, so the numbers are warm-cache times.
+
+# attention widths of the SD 2.x UNet: (processor name prefix, hidden size, attentions)
+SD_ATTENTIONS = [('down_blocks.0', 320, 2), ('down_blocks.1', 640, 2), ('down_blocks.2', 1280, 2),
+                 ('mid_block', 1280, 1), ('up_blocks.1', 1280, 3), ('up_blocks.2', 640, 3), ('up_blocks.3', 320, 3)]
+
+
+def synthetic_state_dict(rank=16, cross_attention_dim=1024):
+    # random LoRA weights with the keys and shapes lora_train.py saves for SD 2.1
+    state_dict = {}
+    for prefix, hidden_size, n_attentions in SD_ATTENTIONS:
+        for i in range(n_attentions):
+            for attn, context_dim in [('attn1', hidden_size), ('attn2', cross_attention_dim)]:
+                name = f'unet.{prefix}.attentions.{i}.transformer_blocks.0.{attn}.processor'
+                for proj, in_features in [('to_q', hidden_size), ('to_k', context_dim), ('to_v', context_dim),
+                                          ('to_out', hidden_size)]:
+                    state_dict[f'{name}.{proj}_lora.down.weight'] = torch.randn(rank, in_features) / rank
+                    state_dict[f'{name}.{proj}_lora.up.weight'] = torch.randn(hidden_size, rank) * 0.01
+    return state_dict
+
+
+def make_files(workdir, n_files, rank):
+    paths = []
+    for i in range(n_files):
+        state_dict = synthetic_state_dict(rank)
+        ckpt = os.path.join(workdir, f'lora_{i}.ckpt')
+        torch.save(state_dict, ckpt)
+        safetensors = os.path.join(workdir, f'lora_{i}.safetensors')
+        save_file(state_dict, safetensors, metadata={'format': 'pt'})
+        paths += [ckpt, safetensors]
+    return paths
+
+
+def run(opt):
+    device = get_device(opt.device)
+    paths = opt.paths or make_files(opt.workdir or tempfile.mkdtemp(prefix='diffstyler-lora-'), opt.n_files, opt.rank)
+
+    rows = []
+    for fmt in ['.ckpt', '.safetensors']:
+        fmt_paths = [path for path in paths if path.endswith(fmt)]
+        if not fmt_paths:
+            continue
+        single = time_fn(lambda: load_lora_state_dict(fmt_paths[0], device), device, warmup=1, iters=opt.iters)
+
+        def load_all():
+            registry = LoRARegistry([{'weight_path': path} for path in fmt_paths], device, max_workers=opt.workers)
+            for path in registry.paths:
+                registry.state_dict(path)
+        all_files = time_fn(load_all, device, warmup=1, iters=opt.iters)
+        rows.append({'format': fmt, 'files': len(fmt_paths), 'size_mb': os.path.getsize(fmt_paths[0]) / 2 ** 20,
+                     'single_ms': single['mean_ms'], 'all_ms': all_files['mean_ms']})
+
+    print_table(rows, ['format', 'files', 'size_mb', 'single_ms', 'all_ms'])
+    write_results(opt.output, rows, meta={'device': str(device), 'workers': opt.workers, 'rank': opt.rank,
+                                          'synthetic': not opt.paths})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--paths', type=str, nargs='*', default=None, help="LoRA files to load (default: synthetic)")
+    parser.add_argument('--n_files', type=int, default=4, help="synthetic files per format")
+    parser.add_argument('--rank', type=int, default=16, help="rank of the synthetic adapters")
+    parser.add_argument('--device', type=str, default=None)
+    parser.add_argument('--workers', type=int, default=4, help="registry thread pool size")
+    parser.add_argument('--iters', type=int, default=5)
+    parser.add_argument('--workdir', type=str, default=None)
+    parser.add_argument('--output', type=str, default='benchmarks/lora_loading.json')
+    opt = parser.parse_args()
+    run(opt)
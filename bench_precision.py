@@ -0,0 +1,85 @@
+import argparse
+import multiprocessing as mp
+import torch
+from transformers import CLIPTextModel, CLIPTokenizer, logging
+from diffusers import AutoencoderKL, UNet2DConditionModel
+
+from precision import get_device, resolve_precision, apply_precision, policy_name
+from bench_utils import time_fn, print_table, write_results
+from runtime import peak_memory_mb
+from model_resolver import resolve_model
+
+# suppress partial model loading warning
+logging.set_verbosity_error()
+
+# latency / peak memory matrix of the precision policies in precision.py
+# every policy runs in a fresh process so the peak RSS belongs to that policy alone
+
+POLICIES = {
+    'fp32': 'fp32',
+    'bf16': 'bf16',
+    'fp16': 'fp16',
+    'unet-bf16': {'unet': 'bf16', 'vae': 'fp32', 'text_encoder': 'fp32'},
+    'fp32-channels_last': {'unet': 'fp32', 'vae': 'fp32', 'text_encoder': 'fp32', 'channels_last': True},
+    'bf16-channels_last': {'unet': 'bf16', 'vae': 'bf16', 'text_encoder': 'bf16', 'channels_last': True},
+}
+
+
+@torch.no_grad()
+def run_policy(opt, name):
+    device = get_device(opt['device'])
+    policy = resolve_precision(POLICIES[name], device)
+
+    model_path = resolve_model(opt['model_key'], subfolders=['tokenizer', 'text_encoder', 'vae', 'unet'])
+    tokenizer = CLIPTokenizer.from_pretrained(model_path, subfolder="tokenizer")
+    text_encoder = CLIPTextModel.from_pretrained(model_path, subfolder="text_encoder").to(device)
+    vae = AutoencoderKL.from_pretrained(model_path, subfolder="vae").to(device)
+    unet = UNet2DConditionModel.from_pretrained(model_path, subfolder="unet").to(device)
+    apply_precision(policy, unet=unet, vae=vae, text_encoder=text_encoder)
+
+    # same shapes as PNP.denoise_step: [source, uncond, cond] rows of a 512x512 image
+    latent_size = opt['resolution'] // 8
+    batch_size = 3 * opt['batch_size']
+    latents = torch.randn(batch_size, 4, latent_size, latent_size, device=device, dtype=policy['unet'])
+    t = torch.tensor(500, device=device)
+    input_ids = tokenizer([''] * batch_size, padding='max_length', max_length=tokenizer.model_max_length,
+                          return_tensors='pt').input_ids.to(device)
+    text_embeds = text_encoder(input_ids)[0].to(policy['unet'])
+    if policy['channels_last']:
+        latents = latents.to(memory_format=torch.channels_last)
+    decode_input = torch.randn(1, 4, latent_size, latent_size, device=device, dtype=policy['vae'])
+
+    row = {'policy': name, 'resolved': policy_name(policy)}
+    timing = dict(device=device, warmup=opt['warmup'], iters=opt['iters'])
+    row['text_encoder_ms'] = time_fn(lambda: text_encoder(input_ids), **timing)['mean_ms']
+    row['unet_step_ms'] = time_fn(lambda: unet(latents, t, encoder_hidden_states=text_embeds), **timing)['mean_ms']
+    row['vae_decode_ms'] = time_fn(lambda: vae.decode(decode_input), **timing)['mean_ms']
+    row['peak_memory_mb'] = peak_memory_mb(device)
+    return row
+
+
+def run(opt):
+    rows = []
+    ctx = mp.get_context('spawn')
+    for name in opt.policies:
+        print(f'[INFO] benchmarking policy {name}')
+        with ctx.Pool(1) as pool:
+            rows.append(pool.apply(run_policy, (vars(opt), name)))
+    print_table(rows, ['policy', 'resolved', 'text_encoder_ms', 'unet_step_ms', 'vae_decode_ms', 'peak_memory_mb'])
+    write_results(opt.output, rows, meta={'device': str(get_device(opt.device)), 'model_key': opt.model_key,
+                                          'threads': torch.get_num_threads()})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_key', type=str, default='stabilityai/stable-diffusion-2-1-base')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--policies', type=str, nargs='+', default=['fp32', 'bf16', 'unet-bf16', 'bf16-channels_last'],
+                        choices=list(POLICIES))
+    parser.add_argument('--resolution', type=int, default=512)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--iters', type=int, default=3)
+    parser.add_argument('--output', type=str, default='benchmarks/precision.json')
+    opt = parser.parse_args()
+    run(opt)
@@ -0,0 +1,64 @@
+import argparse
+import os
+import time
+import torch
+import yaml
+
+from diffstyler import PNP
+from pnp_utils_combine import seed_everything
+from bench_utils import image_metrics, print_table, write_results
+
+# latency and pixel accuracy of the int8 UNet modes against the fp32 output of the same config
+
+
+def sample(pnp, name):
+    start = time.perf_counter()
+    image = pnp.sample_loop(pnp.eps)
+    elapsed = time.perf_counter() - start
+    # sample_loop always writes output-<prompt>.png, keep one file per mode
+    output = f'{pnp.config["output_path"]}/output-{pnp.config["prompt"]}.png'
+    os.replace(output, f'{pnp.config["output_path"]}/quantization-{name}.png')
+    return image, elapsed
+
+
+def build(config, quantize=None, quantize_lora='keep'):
+    config = dict(config, quantize=quantize, quantize_lora=quantize_lora)
+    seed_everything(config["seed"])
+    pnp = PNP(config)
+    if quantize:
+        pnp.quantize_unets()
+    pnp.init_pnp(conv_injection_t=50, qk_injection_t=50)
+    return pnp
+
+
+def run(opt):
+    with open(opt.config_path, "r") as f:
+        config = yaml.safe_load(f)
+    config.update(device='cpu', precision='fp32', output_path=opt.output_dir)
+    if opt.n_timesteps is not None:
+        config["n_timesteps"] = opt.n_timesteps
+    os.makedirs(opt.output_dir, exist_ok=True)
+
+    reference, elapsed = sample(build(config), 'fp32')
+    rows = [{'mode': 'fp32', 'lora': '-', 'sample_s': elapsed, **image_metrics(reference, reference)}]
+    for mode in opt.modes:
+        for lora_mode in opt.lora_modes:
+            image, elapsed = sample(build(config, quantize=mode, quantize_lora=lora_mode), f'{mode}-{lora_mode}')
+            rows.append({'mode': mode, 'lora': lora_mode, 'sample_s': elapsed, **image_metrics(reference, image)})
+
+    for row in rows:
+        row['speedup'] = rows[0]['sample_s'] / row['sample_s']
+    print_table(rows, ['mode', 'lora', 'sample_s', 'speedup', 'psnr_db', 'mean_abs', 'max_abs'])
+    write_results(f'{opt.output_dir}/quantization.json', rows,
+                  meta={'config': opt.config_path, 'n_timesteps': config["n_timesteps"], 'threads': torch.get_num_threads()})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config_path', type=str, default='configs/config-girl1.yaml')
+    parser.add_argument('--modes', type=str, nargs='+', default=['dynamic', 'static'], choices=['dynamic', 'static'])
+    parser.add_argument('--lora_modes', type=str, nargs='+', default=['keep', 'merge'], choices=['keep', 'merge'])
+    parser.add_argument('--n_timesteps', type=int, default=None)
+    parser.add_argument('--output_dir', type=str, default='benchmarks')
+    opt = parser.parse_args()
+    run(opt)
@@ -0,0 +1,115 @@
+import argparse
+import os
+import tempfile
+import time
+import torch
+
+from launch import plan_workers, run_workers
+from bench_utils import print_table, process_memory_mb, write_results
+
+# memory of N concurrent workers with private or shared frozen weights (shared_weights.py), on the tiny random
+# models of tiny_models.py (offline) or on a real SD version
+#
+#   python bench_shared_weights.py --workers 1 2 4
+#   python bench_shared_weights.py --sd_version 2.1 --precision bf16 --workers 1 2 4
+#
+# Every worker loads (private) or attaches (shared) the UNet, VAE and text encoder, runs one UNet forward and
+# then measures its memory while all workers are alive. PSS splits the shared pages between the processes
+# that map them, so the sum over the workers is what the host pays.
+
+COMPONENTS = ['unet', 'vae', 'text_encoder']
+
+
+def load_private(sd_version, policy, seed):
+    from precision import apply_precision
+    if sd_version is None:
+        from tiny_models import build_tiny_models
+        models = build_tiny_models(seed=seed)
+    else:
+        from diffstyler import PNP
+        models = PNP.load_models(sd_version)
+    apply_precision(policy, unet=models['unet'], vae=models['vae'], text_encoder=models['text_encoder'])
+    return models
+
+
+@torch.no_grad()
+def memory_worker(mode, export_dir, sd_version, precision, seed, barrier):
+    from precision import resolve_precision
+    from shared_weights import attach_module
+
+    policy = resolve_precision(precision, 'cpu')
+    start = time.perf_counter()
+    if mode == 'shared':
+        models = {name: attach_module(os.path.join(export_dir, name)) for name in COMPONENTS}
+    else:
+        models = load_private(sd_version, policy, seed)
+    load_s = time.perf_counter() - start
+
+    unet = models['unet']
+    size = unet.config.sample_size
+    latents = torch.randn(3, unet.config.in_channels, size, size, dtype=policy['unet'])
+    text_embeds = torch.randn(3, 77, unet.config.cross_attention_dim, dtype=policy['unet'])
+    unet(latents, 999, encoder_hidden_states=text_embeds)
+
+    # measured while every worker holds its models
+    barrier.wait()
+    memory = process_memory_mb()
+    barrier.wait()
+    return dict(memory, load_s=load_s)
+
+
+def export_weights(opt, policy):
+    from shared_weights import ensure_export, export_module
+    if opt.sd_version is not None:
+        from diffstyler import PNP
+        return ensure_export(opt.shared_dir or True, opt.sd_version, policy, PNP.load_models)
+    # the tiny tokenizer has no save_pretrained, only the networks are exported
+    directory = os.path.join(opt.workdir, 'tiny-export')
+    models = load_private(None, policy, opt.seed)
+    for name in COMPONENTS:
+        export_module(models[name], os.path.join(directory, name))
+    return directory
+
+
+def bench(opt, mode, n_workers, export_dir):
+    import multiprocessing as mp
+
+    runtimes = plan_workers(n_workers, threads=opt.threads)
+    barrier = mp.get_context('spawn').Barrier(n_workers)
+    worker_args = [(mode, export_dir, opt.sd_version, opt.precision, opt.seed, barrier) for _ in range(n_workers)]
+    results = [result['result'] for result in run_workers(memory_worker, worker_args, runtimes)]
+    total_pss = sum(r.get('pss_mb', r['rss_mb']) for r in results)
+    return {'mode': mode, 'workers': n_workers, 'total_pss_mb': total_pss, 'pss_per_worker_mb': total_pss / n_workers,
+            'private_per_worker_mb': sum(r.get('private_mb', 0.0) for r in results) / n_workers,
+            'load_s': sum(r['load_s'] for r in results) / n_workers}
+
+
+def run(opt):
+    from precision import resolve_precision
+
+    opt.workdir = opt.workdir or tempfile.mkdtemp(prefix='diffstyler-shared-')
+    policy = resolve_precision(opt.precision, 'cpu')
+    export_dir = export_weights(opt, policy)
+    rows = []
+    for n_workers in opt.workers:
+        for mode in ['private', 'shared']:
+            row = bench(opt, mode, n_workers, export_dir)
+            print(f'[INFO] {n_workers} workers, {mode} weights: {row["total_pss_mb"]:.0f} MB')
+            rows.append(row)
+    print_table(rows, ['mode', 'workers', 'total_pss_mb', 'pss_per_worker_mb', 'private_per_worker_mb', 'load_s'])
+    write_results(opt.output, rows, meta={'sd_version': opt.sd_version or 'tiny', 'precision': opt.precision,
+                                          'export_dir': export_dir})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sd_version', type=str, default=None, help="benchmark a real SD version instead of the tiny models")
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--threads', type=int, default=1, help="intra-op threads per worker")
+    parser.add_argument('--shared_dir', type=str, default=None, help="export directory (default: /dev/shm/diffstyler)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', type=str, default=None)
+    parser.add_argument('--output', type=str, default='benchmarks/shared_weights.json')
+    opt = parser.parse_args()
+    run(opt)
@@ -0,0 +1,97 @@
+import argparse
+import os
+import tempfile
+import time
+import torch
+
+from bench_utils import image_metrics, print_table, write_results
+from pnp_utils_combine import seed_everything
+from precision import get_device
+
+# quality / latency of the samplers at different step counts
+#
+#   python bench_solver.py --steps 10 20 30 50
+#   python bench_solver.py --config_path configs/config-girl1.yaml --steps 10 20 30 50
+#
+# For every sampler and step count the content image is inverted on that sampler's schedule
+# (preprocess.py --sampler) and then stylized with the same sampler and n_timesteps. The output is compared
+# with a DDIM reference (--reference_steps, 50 by default, the production setting). Without --config_path
+# the tiny random models of tiny_models.py are used: the timings are meaningful offline, the image metrics
+# only show that the pipeline is consistent; use a real config for the quality numbers.
+
+
+def build_models(opt):
+    if opt.config_path is not None:
+        return None
+    from tiny_models import build_tiny_models
+    # fresh models every time: PnP patches the UNet forwards in place
+    return build_tiny_models(seed=opt.seed)
+
+
+def run_setting(opt, config, sampler, n_steps):
+    from diffstyler import PNP
+    from preprocess import Preprocess
+
+    name = os.path.splitext(os.path.basename(config["image_path"]))[0]
+    latents_path = os.path.join(opt.workdir, f'latents_{sampler}_{n_steps}')
+    os.makedirs(os.path.join(latents_path, name), exist_ok=True)
+
+    seed_everything(config["seed"])
+    model = Preprocess(get_device(config["device"]), sd_version=config["sd_version"], models=build_models(opt),
+                       precision=config.get("precision"), sampler=sampler)
+    start = time.perf_counter()
+    model.extract_latents(num_steps=n_steps, data_path=config["image_path"], save_path=os.path.join(latents_path, name),
+                          timesteps_to_save=None, recon='none')
+    inversion_s = time.perf_counter() - start
+    del model
+
+    run_config = dict(config, sampler=sampler, n_timesteps=n_steps, latents_path=latents_path,
+                      output_path=os.path.join(opt.workdir, 'results', f'{sampler}_{n_steps}'))
+    os.makedirs(run_config["output_path"], exist_ok=True)
+    seed_everything(config["seed"])
+    pnp = PNP(run_config, models=build_models(opt))
+    pnp.init_pnp(conv_injection_t=int(n_steps * config["pnp_f_t"]), qk_injection_t=int(n_steps * config["pnp_attn_t"]))
+    start = time.perf_counter()
+    image = pnp.sample_loop(pnp.eps)
+    sampling_s = time.perf_counter() - start
+    return image, {'sampler': sampler, 'steps': n_steps, 'inversion_s': inversion_s, 'sampling_s': sampling_s}
+
+
+def run(opt):
+    opt.workdir = opt.workdir or tempfile.mkdtemp(prefix='diffstyler-solver-')
+    if opt.config_path is not None:
+        import yaml
+        with open(opt.config_path, "r") as f:
+            config = yaml.safe_load(f)
+    else:
+        from tiny_models import build_tiny_models, build_tiny_workspace
+        config = build_tiny_workspace(opt.workdir, build_tiny_models(seed=opt.seed), n_loras=opt.loras, seed=opt.seed)
+
+    reference, reference_row = run_setting(opt, config, 'ddim', opt.reference_steps)
+    print(f'[INFO] reference ddim {opt.reference_steps} steps: sampling {reference_row["sampling_s"]:.1f} s')
+    rows = []
+    for sampler in opt.samplers:
+        for n_steps in opt.steps:
+            image, row = run_setting(opt, config, sampler, n_steps)
+            row.update(image_metrics(reference, image))
+            # sampling time relative to the reference
+            row['speedup'] = reference_row['sampling_s'] / row['sampling_s']
+            print(f'[INFO] {sampler} {n_steps} steps: sampling {row["sampling_s"]:.1f} s, psnr {row["psnr_db"]:.2f} dB')
+            rows.append(row)
+    print_table(rows, ['sampler', 'steps', 'inversion_s', 'sampling_s', 'speedup', 'psnr_db', 'mean_abs'])
+    write_results(opt.output, rows, meta={'config': opt.config_path, 'reference': reference_row,
+                                          'torch': torch.__version__, 'seed': opt.seed})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config_path', type=str, default=None, help="real config; tiny random models if not set")
+    parser.add_argument('--samplers', type=str, nargs='+', default=['ddim', 'dpmsolver++'])
+    parser.add_argument('--steps', type=int, nargs='+', default=[10, 20, 30, 50])
+    parser.add_argument('--reference_steps', type=int, default=50, help="DDIM steps of the reference output")
+    parser.add_argument('--loras', type=int, default=1, help="LoRAs of the tiny workspace")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', type=str, default=None, help="latents and outputs, a temp dir if not set")
+    parser.add_argument('--output', type=str, default='benchmarks/solver.json')
+    opt = parser.parse_args()
+    run(opt)
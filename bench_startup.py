@@ -0,0 +1,70 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from bench_utils import print_table, write_results
+
+# startup time of the command line entry points
+#
+#   python bench_startup.py --repeats 5
+#
+# Every entry point runs `--help` in a fresh interpreter, so the time is import and argument parsing only:
+# what a short job or a CLI call pays before any work. The modules that are expensive to import and not needed
+# for that (diffusers, transformers, cv2, ...) are listed per entry point; they should only appear once the
+# path that needs them runs. `import torch` alone is the floor.
+
+ENTRY_POINTS = ['diffstyler.py', 'preprocess.py', 'lora_train.py', 'sweep.py', 'strength_strip.py',
+                'stylize_sequence.py', 'job_queue.py', 'launch.py', 'convert_lora.py', 'compress_lora.py',
+                'bench_solver.py']
+HEAVY_MODULES = ['diffusers', 'transformers', 'accelerate', 'cv2', 'matplotlib']
+
+# runs an entry point with --help and reports which heavy modules it imported
+PROBE = '''
+import json, os, runpy, sys
+sys.argv = [sys.argv[1], '--help']
+sys.stdout = open(os.devnull, 'w')
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+except SystemExit:
+    pass
+sys.stdout = sys.__stdout__
+print(json.dumps([name for name in {heavy} if name in sys.modules]))
+'''.format(heavy=HEAVY_MODULES)
+
+
+def time_command(command, repeats):
+    # wall time in ms of each run, and the last run's stdout
+    times, output = [], ''
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = subprocess.run(command, capture_output=True, text=True, env=dict(os.environ, HF_HUB_OFFLINE='1'))
+        times.append((time.perf_counter() - start) * 1000)
+        if result.returncode != 0:
+            raise RuntimeError(f'{" ".join(command)} failed:\n{result.stderr}')
+        output = result.stdout
+    return times, output
+
+
+def run(opt):
+    rows = []
+    times, _ = time_command([sys.executable, '-c', 'import torch'], opt.repeats)
+    rows.append({'entry': 'import torch', 'mean_ms': sum(times) / len(times), 'min_ms': min(times), 'heavy': ''})
+    for entry in opt.entry_points:
+        times, output = time_command([sys.executable, '-c', PROBE, entry], opt.repeats)
+        heavy = json.loads(output.strip().splitlines()[-1])
+        rows.append({'entry': entry, 'mean_ms': sum(times) / len(times), 'min_ms': min(times),
+                     'heavy': ','.join(heavy)})
+    print_table(rows, ['entry', 'mean_ms', 'min_ms', 'heavy'])
+    write_results(opt.output, rows, meta={'repeats': opt.repeats, 'python': sys.version.split()[0]})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entry_points', type=str, nargs='+', default=ENTRY_POINTS)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--output', type=str, default='benchmarks/startup.json')
+    opt = parser.parse_args()
+    run(opt)
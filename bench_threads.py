@@ -0,0 +1,103 @@
+import argparse
+import os
+import tempfile
+import time
+import torch
+
+from launch import plan_workers, run_workers
+from bench_utils import print_table, write_results
+
+# sampling throughput of different worker/thread splits of this host, on the tiny random models of
+# tiny_models.py (offline) or on a real config
+#
+#   python bench_threads.py --workers 1 2 4 8 --samples 8
+#
+# Every split runs the same total number of sample_loop calls; throughput is counted over the window in
+# which all workers were sampling, so model loading and process start-up are left out.
+
+
+def sample_worker(workspace, config_path, n_samples, n_loras, seed, output_path):
+    from pnp_utils_combine import seed_everything
+    if config_path is not None:
+        import yaml
+        from diffstyler import PNP
+        with open(config_path, "r") as f:
+            config = yaml.safe_load(f)
+        config["output_path"] = output_path
+        seed_everything(config["seed"])
+        pnp = PNP(config)
+        pnp.init_pnp(conv_injection_t=int(config["n_timesteps"] * config["pnp_f_t"]),
+                     qk_injection_t=int(config["n_timesteps"] * config["pnp_attn_t"]))
+    else:
+        from benchmark import build_pnp
+        pnp = build_pnp(dict(workspace, output_path=output_path), n_loras, seed)
+    os.makedirs(output_path, exist_ok=True)
+
+    # one warm-up step so lazy initialization is not charged to the first sample
+    with torch.no_grad():
+        pnp.denoise_step(pnp.eps, pnp.scheduler.timesteps[0])
+    start = time.time()
+    latencies = []
+    for _ in range(n_samples):
+        sample_start = time.perf_counter()
+        pnp.sample_loop(pnp.eps)
+        latencies.append(time.perf_counter() - sample_start)
+    return {'start': start, 'end': time.time(), 'latencies': latencies}
+
+
+def bench_split(opt, workspace, n_workers, threads):
+    runtimes = plan_workers(n_workers, numa=opt.numa, threads=threads, interop_threads=opt.interop_threads)
+    samples = [opt.samples // n_workers + (i < opt.samples % n_workers) for i in range(n_workers)]
+    worker_args = [(workspace, opt.config_path, samples[i], opt.loras, opt.seed,
+                    os.path.join(opt.workdir, 'results', f'{n_workers}x{runtimes[i]["threads"]}-{i}'))
+                   for i in range(n_workers)]
+    results = [result['result'] for result in run_workers(sample_worker, worker_args, runtimes)]
+    window = max(r['end'] for r in results) - min(r['start'] for r in results)
+    latencies = sorted(latency for r in results for latency in r['latencies'])
+    return {'workers': n_workers, 'threads': runtimes[0]['threads'], 'interop_threads': opt.interop_threads,
+            'samples': len(latencies), 'throughput_per_min': len(latencies) / window * 60,
+            'mean_latency_s': sum(latencies) / len(latencies),
+            'p95_latency_s': latencies[min(int(0.95 * len(latencies)), len(latencies) - 1)]}
+
+
+def run(opt):
+    opt.workdir = opt.workdir or tempfile.mkdtemp(prefix='diffstyler-threads-')
+    workspace = None
+    if opt.config_path is None:
+        from tiny_models import build_tiny_models, build_tiny_workspace
+        workspace = build_tiny_workspace(opt.workdir, build_tiny_models(seed=opt.seed), n_timesteps=opt.n_timesteps,
+                                         n_loras=opt.loras, seed=opt.seed)
+
+    n_cpus = len(os.sched_getaffinity(0))
+    rows = []
+    for n_workers in opt.workers:
+        if n_workers > n_cpus or n_workers > opt.samples:
+            print(f'[INFO] skipping {n_workers} workers: {n_cpus} cpus, {opt.samples} samples')
+            continue
+        row = bench_split(opt, workspace, n_workers, opt.threads)
+        print(f'[INFO] {row["workers"]} workers x {row["threads"]} threads: {row["throughput_per_min"]:.2f} samples/min')
+        rows.append(row)
+
+    best = max(rows, key=lambda row: row['throughput_per_min'])
+    print_table(rows, ['workers', 'threads', 'interop_threads', 'samples', 'throughput_per_min',
+                       'mean_latency_s', 'p95_latency_s'])
+    print(f'[INFO] best split: --workers {best["workers"]} --threads {best["threads"]}')
+    write_results(opt.output, rows, meta={'config': opt.config_path or 'tiny', 'cpus': n_cpus, 'numa': opt.numa,
+                                          'loras': opt.loras, 'n_timesteps': opt.n_timesteps, 'best': best})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config_path', type=str, default=None, help="benchmark a real config instead of the tiny models")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--threads', type=int, default=None, help="intra-op threads per worker (default: its cpu count)")
+    parser.add_argument('--interop_threads', type=int, default=1)
+    parser.add_argument('--numa', default=False, action='store_true')
+    parser.add_argument('--samples', type=int, default=8, help="sample_loop calls per split, shared by the workers")
+    parser.add_argument('--loras', type=int, default=1, help="LoRA branches of the tiny models")
+    parser.add_argument('--n_timesteps', type=int, default=10, help="sampling steps of the tiny models")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', type=str, default=None)
+    parser.add_argument('--output', type=str, default='benchmarks/threads.json')
+    opt = parser.parse_args()
+    run(opt)
@@ -0,0 +1,112 @@
+import argparse
+import os
+import tempfile
+import time
+import torch
+
+from bench_utils import image_metrics, print_table, synchronize, time_fn, write_results
+from pnp_utils_combine import seed_everything
+from token_merge import register_token_merge, remove_token_merge, token_merge_modules
+
+# latency / quality of token merging (token_merge.py) at different merge ratios
+#
+#   python bench_token_merge.py --ratios 0.3 0.5 0.7
+#   python bench_token_merge.py --config_path configs/config-girl1.yaml --ratios 0.3 0.5 0.7
+#
+# For every ratio: the time of one merged attn1 layer of up_blocks[3] (on the input it gets at the first
+# sampling step), of one denoise_step, of the whole sample_loop, and the difference of the output to the
+# unmerged one. Without --config_path the tiny random models of tiny_models.py are used (32x32 latents,
+# 1024 tokens in the merged layers): the timings show the trend offline, use a real config for the quality.
+
+
+def build_pnp(opt):
+    from diffstyler import PNP
+    if opt.config_path is not None:
+        import yaml
+        with open(opt.config_path, "r") as f:
+            config = yaml.safe_load(f)
+        models = None
+    else:
+        from tiny_models import build_tiny_models, build_tiny_workspace
+        config = build_tiny_workspace(opt.workdir, build_tiny_models(seed=opt.seed), n_loras=opt.loras, seed=opt.seed)
+        models = build_tiny_models(seed=opt.seed)
+    config = dict(config, output_path=os.path.join(opt.workdir, 'results'), token_merge=None)
+    os.makedirs(config["output_path"], exist_ok=True)
+    seed_everything(config["seed"])
+    pnp = PNP(config, models=models)
+    pnp.init_pnp(conv_injection_t=int(config["n_timesteps"] * config["pnp_f_t"]),
+                 qk_injection_t=int(config["n_timesteps"] * config["pnp_attn_t"]))
+    return pnp
+
+
+def unets(pnp):
+    return list(dict.fromkeys([pnp.unet] + [lora_model['unet'] for lora_model in pnp.lora_models]))
+
+
+@torch.no_grad()
+def layer_input(pnp, module):
+    # the input of `module` at the first sampling step
+    captured = {}
+
+    def capture(module, args):
+        captured.setdefault('x', args[0])
+
+    handle = module.register_forward_pre_hook(capture)
+    pnp.denoise_step(pnp.eps, pnp.scheduler.timesteps[0])
+    handle.remove()
+    return captured['x']
+
+
+@torch.no_grad()
+def run_ratio(opt, pnp, ratio, x):
+    for unet in unets(pnp):
+        if ratio:
+            register_token_merge(unet, ratio, sx=opt.sx, sy=opt.sy, seed=opt.seed)
+        else:
+            remove_token_merge(unet)
+    module = next(token_merge_modules(pnp.unet))
+    t = pnp.scheduler.timesteps[0]
+    # the layer alone needs the latent size of its UNet call
+    if ratio:
+        pnp.unet.token_merge_state.latent_size = tuple(pnp.eps.shape[-2:])
+    layer = time_fn(lambda: module(x), device=pnp.device, warmup=1, iters=opt.iters)
+    step = time_fn(lambda: pnp.denoise_step(pnp.eps, t), device=pnp.device, warmup=1, iters=opt.iters)
+    seed_everything(opt.seed)
+    start = time.perf_counter()
+    image = pnp.sample_loop(pnp.eps)
+    synchronize(pnp.device)
+    return image, {'ratio': ratio, 'tokens': x.shape[1], 'merged_tokens': x.shape[1] - int(x.shape[1] * ratio),
+                   'layer_ms': layer['mean_ms'], 'step_ms': step['mean_ms'], 'sampling_s': time.perf_counter() - start}
+
+
+def run(opt):
+    opt.workdir = opt.workdir or tempfile.mkdtemp(prefix='diffstyler-tome-')
+    pnp = build_pnp(opt)
+    x = layer_input(pnp, next(token_merge_modules(pnp.unet)))
+    reference, reference_row = run_ratio(opt, pnp, 0.0, x)
+    rows = [dict(reference_row, speedup=1.0)]
+    for ratio in opt.ratios:
+        image, row = run_ratio(opt, pnp, ratio, x)
+        row.update(image_metrics(reference, image))
+        row['speedup'] = reference_row['sampling_s'] / row['sampling_s']
+        print(f'[INFO] ratio {ratio}: step {row["step_ms"]:.1f} ms, psnr {row["psnr_db"]:.2f} dB')
+        rows.append(row)
+    print_table(rows, ['ratio', 'tokens', 'merged_tokens', 'layer_ms', 'step_ms', 'sampling_s', 'speedup',
+                       'psnr_db', 'mean_abs'])
+    write_results(opt.output, rows, meta={'config': opt.config_path, 'sx': opt.sx, 'sy': opt.sy,
+                                          'torch': torch.__version__, 'seed': opt.seed})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config_path', type=str, default=None, help="real config; tiny random models if not set")
+    parser.add_argument('--ratios', type=float, nargs='+', default=[0.3, 0.5, 0.7])
+    parser.add_argument('--sx', type=int, default=2)
+    parser.add_argument('--sy', type=int, default=2)
+    parser.add_argument('--loras', type=int, default=1, help="LoRAs of the tiny workspace")
+    parser.add_argument('--iters', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', type=str, default=None, help="outputs, a temp dir if not set")
+    parser.add_argument('--output', type=str, default='benchmarks/token_merge.json')
+    opt = parser.parse_args()
+    run(opt)
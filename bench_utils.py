@@ -0,0 +1,74 @@
+import json
+import os
+import time
+import torch
+
+from runtime import peak_memory_mb
+
+# small helpers shared by the bench_*.py scripts
+
+
+def synchronize(device):
+    device = torch.device(device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    elif device.type == 'mps':
+        torch.mps.synchronize()
+
+
+def process_memory_mb():
+    # resident, proportional (shared pages split between the processes mapping them) and private memory of
+    # this process; Linux only, elsewhere just the peak RSS
+    path = '/proc/self/smaps_rollup'
+    if not os.path.exists(path):
+        return {'rss_mb': peak_memory_mb()}
+    fields = {}
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    return {'rss_mb': fields.get('Rss', 0.0), 'pss_mb': fields.get('Pss', 0.0),
+            'private_mb': fields.get('Private_Clean', 0.0) + fields.get('Private_Dirty', 0.0)}
+
+
+def time_fn(fn, device='cpu', warmup=1, iters=5):
+    # wall time of fn() in milliseconds, with device synchronization around every call
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    times = []
+    for _ in range(iters):
+        start = time.perf_counter()
+        fn()
+        synchronize(device)
+        times.append((time.perf_counter() - start) * 1000)
+    return {'mean_ms': sum(times) / len(times), 'min_ms': min(times), 'max_ms': max(times), 'iters': iters}
+
+
+def image_metrics(reference, image):
+    # pixel metrics between two image tensors in [0, 1]
+    diff = (image.float() - reference.float()).abs()
+    mse = (diff ** 2).mean().item()
+    psnr = float('inf') if mse == 0 else 10 * torch.log10(torch.tensor(1.0 / mse)).item()
+    return {'mse': mse, 'psnr_db': psnr, 'mean_abs': diff.mean().item(), 'max_abs': diff.max().item()}
+
+
+def print_table(rows, columns):
+    widths = [max([len(col)] + [len(_fmt(row.get(col))) for row in rows]) for col in columns]
+    print('  '.join(col.ljust(w) for col, w in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(_fmt(row.get(col)).ljust(w) for col, w in zip(columns, widths)))
+
+
+def _fmt(value):
+    if isinstance(value, float):
+        return f'{value:.2f}'
+    return str(value)
+
+
+def write_results(path, rows, meta=None):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'meta': meta or {}, 'results': rows}, f, indent=2)
+    print(f'[INFO] results written to {path}')
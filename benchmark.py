@@ -0,0 +1,185 @@
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import tempfile
+import torch
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+
+from diffstyler import PNP
+from preprocess import Preprocess
+from pnp_utils_combine import load_source_latents_t, seed_everything
+from diffusers import DDIMScheduler
+from tiny_models import SCHEDULER_CONFIG, build_tiny_models, build_tiny_feature_extractor, build_tiny_workspace
+from bench_utils import time_fn, print_table, write_results
+
+# offline throughput benchmarks on small random models with the SD block layout (see tiny_models.py)
+#
+#   python benchmark.py --output benchmarks/baseline.json
+#   python benchmark.py --output benchmarks/new.json --compare benchmarks/baseline.json
+#
+# Every benchmark runs for each thread count; denoise_step and sample_loop also sweep the LoRA counts and
+# batch sizes, ddim_inversion the batch sizes, train_lora the training settings (fp32, bf16 autocast, gradient
+# checkpointing; each in a fresh process, so its peak memory is its own). Nothing is downloaded, the numbers
+# only track relative changes.
+
+BENCHMARKS = ['latent_load', 'denoise_step', 'sample_loop', 'ddim_inversion', 'train_lora']
+KEY = ['benchmark', 'threads', 'loras', 'batch', 'setting']
+# name: (mixed_precision, gradient_checkpointing) of lora_train.train_lora
+TRAIN_SETTINGS = {'fp32': ('no', False), 'bf16': ('bf16', False), 'fp32+checkpointing': ('no', True)}
+
+
+def build_pnp(workspace, n_loras, seed, lora_mode='blend'):
+    config = dict(workspace, lora_configs=workspace['lora_configs'][:n_loras], lora_mode=lora_mode)
+    seed_everything(seed)
+    pnp = PNP(config, models=build_tiny_models(seed=seed))
+    pnp.init_pnp(conv_injection_t=int(config["n_timesteps"] * config["pnp_f_t"]),
+                 qk_injection_t=int(config["n_timesteps"] * config["pnp_attn_t"]))
+    return pnp
+
+
+def bench_latent_load(opt, workspace):
+    latents_path = os.path.join(workspace['latents_path'], 'tiny')
+    scheduler = DDIMScheduler(**SCHEDULER_CONFIG)
+    scheduler.set_timesteps(opt.n_timesteps)
+
+    def load_all():
+        for t in scheduler.timesteps:
+            load_source_latents_t(t, latents_path)
+
+    result = time_fn(load_all, warmup=1, iters=opt.iters)
+    yield {'loras': '-', 'batch': 1, 'unit': f'{opt.n_timesteps} latents', **result}
+
+
+def bench_denoise_step(opt, workspace):
+    for n_loras in opt.loras:
+        pnp = build_pnp(workspace, n_loras, opt.seed, opt.lora_mode)
+        t = pnp.scheduler.timesteps[0]
+        for batch in opt.batch_sizes:
+            x = pnp.eps.repeat(batch, 1, 1, 1)
+            with torch.no_grad():
+                result = time_fn(lambda: pnp.denoise_step(x, t), warmup=1, iters=opt.iters)
+            yield {'loras': n_loras, 'batch': batch, 'unit': 'step', **result}
+
+
+def bench_sample_loop(opt, workspace):
+    for n_loras in opt.loras:
+        pnp = build_pnp(workspace, n_loras, opt.seed, opt.lora_mode)
+        for batch in opt.batch_sizes:
+            x = pnp.eps.repeat(batch, 1, 1, 1)
+            result = time_fn(lambda: pnp.sample_loop(x), warmup=0, iters=1)
+            yield {'loras': n_loras, 'batch': batch, 'unit': f'{opt.n_timesteps} steps + decode', **result}
+
+
+def bench_ddim_inversion(opt, workspace):
+    seed_everything(opt.seed)
+    model = Preprocess(torch.device('cpu'), models=build_tiny_models(seed=opt.seed))
+    model.scheduler.set_timesteps(opt.inversion_steps)
+    cond = model.get_text_embeds('', '', device_type='cpu')[1].unsqueeze(0)
+    latent_size = model.unet.config.sample_size
+    for batch in opt.batch_sizes:
+        latent = torch.randn(batch, 4, latent_size, latent_size)
+        result = time_fn(lambda: model.ddim_inversion(cond, latent, None, save_latents=False), warmup=0, iters=1)
+        yield {'loras': '-', 'batch': batch, 'unit': f'{opt.inversion_steps} steps', **result}
+
+
+def train_lora_stats(image_path, save_dir, name, train_steps, seed, threads):
+    # one training run in this (fresh) process; returns the training_stats of lora_train.train_lora
+    from lora_train import train_lora
+
+    torch.set_num_threads(threads)
+    mixed_precision, gradient_checkpointing = TRAIN_SETTINGS[name]
+    image = Image.open(image_path).convert('RGB')
+    models = build_tiny_models(seed=seed)
+    weight_name = f'lora_bench_{name.replace("+", "_")}.safetensors'
+    train_lora(image, 'painting of <sss>', save_dir, tokenizer=models['tokenizer'], text_encoder=models['text_encoder'],
+               vae=models['vae'], unet=models['unet'], noise_scheduler=models['noise_scheduler'],
+               lora_steps=train_steps, lora_rank=4, weight_name=weight_name, style_image=image, device='cpu',
+               mixed_precision=mixed_precision, gradient_checkpointing=gradient_checkpointing,
+               feature_extractor=build_tiny_feature_extractor(seed))
+    with open(os.path.join(save_dir, f'{os.path.splitext(weight_name)[0]}_training_stats.json')) as f:
+        return json.load(f)
+
+
+def bench_train_lora(opt, workspace):
+    save_dir = os.path.join(opt.workdir, 'lora_train')
+    os.makedirs(save_dir, exist_ok=True)
+    for name in opt.train_settings:
+        with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('spawn')) as pool:
+            stats = pool.submit(train_lora_stats, workspace['image_path'], save_dir, name, opt.train_steps,
+                                opt.seed, torch.get_num_threads()).result()
+        per_iter = stats['mean_iter_time_s'] * 1000
+        yield {'loras': '-', 'batch': 1, 'setting': name, 'unit': 'iteration', 'mean_ms': per_iter,
+               'min_ms': per_iter, 'max_ms': per_iter, 'iters': opt.train_steps,
+               'peak_memory_mb': stats['peak_memory_mb'], 'final_loss': stats['final_loss']}
+
+
+def compare(rows, baseline_path, tolerance):
+    # ratio of each mean time to the baseline entry with the same key (> 1 is slower)
+    with open(baseline_path) as f:
+        baseline = {tuple(row.get(k, '-') for k in KEY): row for row in json.load(f)['results']}
+    for row in rows:
+        reference = baseline.get(tuple(row.get(k, '-') for k in KEY))
+        row['vs_baseline'] = row['mean_ms'] / reference['mean_ms'] if reference else None
+    regressions = [row for row in rows if row['vs_baseline'] is not None and row['vs_baseline'] > 1 + tolerance]
+    for row in regressions:
+        print(f'[WARN] {row["benchmark"]} threads={row["threads"]} loras={row["loras"]} batch={row["batch"]} '
+              f'setting={row["setting"]}: {row["vs_baseline"]:.2f}x the baseline time')
+    return regressions
+
+
+def run(opt):
+    opt.workdir = opt.workdir or tempfile.mkdtemp(prefix='diffstyler-bench-')
+    models = build_tiny_models(seed=opt.seed)
+    workspace = build_tiny_workspace(opt.workdir, models, n_timesteps=opt.n_timesteps,
+                                     n_loras=max(opt.loras), seed=opt.seed)
+    os.makedirs(workspace['output_path'], exist_ok=True)
+
+    rows = []
+    for threads in opt.threads:
+        torch.set_num_threads(threads)
+        for name in opt.benchmarks:
+            for row in globals()[f'bench_{name}'](opt, workspace):
+                rows.append({'benchmark': name, 'threads': threads, 'setting': '-', **row})
+                print(f'[INFO] {name} threads={threads} loras={row["loras"]} batch={row["batch"]} '
+                      f'setting={rows[-1]["setting"]}: {row["mean_ms"]:.1f} ms')
+
+    columns = KEY + ['unit', 'mean_ms', 'min_ms']
+    if 'train_lora' in opt.benchmarks:
+        columns.append('peak_memory_mb')
+    regressions = []
+    if opt.compare:
+        regressions = compare(rows, opt.compare, opt.tolerance)
+        columns.append('vs_baseline')
+    print_table(rows, columns)
+    write_results(opt.output, rows, meta={
+        'torch': torch.__version__, 'platform': platform.platform(), 'processor': platform.processor(),
+        'cpu_count': os.cpu_count(), 'seed': opt.seed, 'lora_mode': opt.lora_mode, 'n_timesteps': opt.n_timesteps,
+        'inversion_steps': opt.inversion_steps, 'train_steps': opt.train_steps,
+        'train_settings': opt.train_settings, 'compare': opt.compare})
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmarks', type=str, nargs='+', default=BENCHMARKS, choices=BENCHMARKS)
+    parser.add_argument('--threads', type=int, nargs='+', default=[torch.get_num_threads()])
+    parser.add_argument('--loras', type=int, nargs='+', default=[0, 1, 2])
+    parser.add_argument('--lora_mode', type=str, default='blend', choices=['blend', 'regional'])
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--n_timesteps', type=int, default=10)
+    parser.add_argument('--inversion_steps', type=int, default=20)
+    parser.add_argument('--train_steps', type=int, default=3)
+    parser.add_argument('--train_settings', type=str, nargs='+', default=list(TRAIN_SETTINGS), choices=list(TRAIN_SETTINGS))
+    parser.add_argument('--iters', type=int, default=5, help="timed repetitions of the short benchmarks")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', type=str, default=None, help="where the synthetic inputs go, a temp dir if not set")
+    parser.add_argument('--output', type=str, default='benchmarks/benchmark.json')
+    parser.add_argument('--compare', type=str, default=None, help="results file of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="slowdown reported as a regression")
+    opt = parser.parse_args()
+    regressions = run(opt)
+    if regressions:
+        raise SystemExit(1)
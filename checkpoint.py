@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import random
+import threading
+
+import numpy as np
+import torch
+
+# checkpoint / resume for the long sampling and inversion loops (preemptible machines)
+#
+# A checkpoint holds the index of the next step, the current latent, the scheduler state (the history of
+# multistep solvers), the RNG states, optional loop-specific state (`extra`) and a hash of the job definition.
+# It is written to a temporary file, fsynced and renamed over the previous one, so a preemption at any point
+# leaves either the old or the new checkpoint, never a partial one (atomic_write, also used for the result
+# images and metrics of preprocess.py and diffstyler.py). A relaunched job with the same hash continues from the last checkpoint
+# and produces the same result as an uninterrupted run; a checkpoint of a different job is ignored.
+
+SCHEDULER_STATE = ['model_outputs', 'lower_order_nums']
+
+
+def job_hash(job):
+    # stable hash of a json-serializable job description (config, inputs, step counts, ...)
+    return hashlib.sha256(json.dumps(job, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def rng_state():
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'random': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def scheduler_state(scheduler):
+    return {name: getattr(scheduler, name) for name in SCHEDULER_STATE if hasattr(scheduler, name)}
+
+
+def set_scheduler_state(scheduler, state, device):
+    for name, value in state.items():
+        if isinstance(value, list):
+            value = [v.to(device) if torch.is_tensor(v) else v for v in value]
+        setattr(scheduler, name, value)
+
+
+def atomic_write(path, write_fn, mode='wb'):
+    # write_fn(f) writes the file; it appears under `path` only once complete. The temporary name keeps the
+    # extension, for writers that pick the format from it (PIL)
+    root, ext = os.path.splitext(path)
+    tmp_path = f'{root}.tmp-{os.getpid()}-{threading.get_ident()}{ext}'
+    try:
+        with open(tmp_path, mode) as f:
+            write_fn(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def atomic_save(obj, path):
+    atomic_write(path, lambda f: torch.save(obj, f))
+
+
+class Checkpointer:
+    def __init__(self, directory, job, name='checkpoint', every=5):
+        # job: description of the run (see job_hash); every: checkpoint every N steps
+        self.path = os.path.join(directory, f'{name}.pt')
+        self.hash = job_hash(job)
+        self.every = every
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config, job, name='checkpoint'):
+        # `checkpoint` config entry: true, or {dir: ..., every: N}; None if not set
+        settings = config.get("checkpoint")
+        if not settings:
+            return None
+        settings = settings if isinstance(settings, dict) else {}
+        directory = settings.get('dir', os.path.join(config["output_path"], 'checkpoints'))
+        return cls(directory, job, name=name, every=settings.get('every', 5))
+
+    def load(self, device='cpu'):
+        # state of the last checkpoint of this job, or None
+        if not os.path.exists(self.path):
+            return None
+        state = torch.load(self.path, map_location='cpu')
+        if state.get('hash') != self.hash:
+            print(f'[WARN] ignoring {self.path}: it belongs to a different job')
+            return None
+        print(f'[INFO] resuming from {self.path} at step {state["step"]}')
+        state['latent'] = state['latent'].to(device)
+        if state.get('extra') is not None:
+            state['extra'] = {k: v.to(device) if torch.is_tensor(v) else v for k, v in state['extra'].items()}
+        return state
+
+    def restore(self, state, scheduler, device):
+        # scheduler and RNG state of a loaded checkpoint; returns the step index and latent to continue from
+        set_scheduler_state(scheduler, state['scheduler'], device)
+        set_rng_state(state['rng'])
+        return state['step'], state['latent']
+
+    def step(self, step, latent, scheduler, before_save=None, extra=None):
+        # call after every step with the number of steps done; saves every `every` steps. extra: state of the
+        # loop itself (e.g. the solver history of dpm_solver_inversion), back in the loaded state's 'extra'
+        if step % self.every:
+            return
+        if before_save is not None:
+            before_save()
+        if extra is not None:
+            extra = {k: v.detach().cpu() if torch.is_tensor(v) else v for k, v in extra.items()}
+        atomic_save({'hash': self.hash, 'step': step, 'latent': latent.detach().cpu(),
+                     'scheduler': scheduler_state(scheduler), 'rng': rng_state(), 'extra': extra}, self.path)
+
+    def clear(self):
+        # the job finished, a relaunch starts over
+        if os.path.exists(self.path):
+            os.remove(self.path)
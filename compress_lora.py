@@ -0,0 +1,141 @@
+import argparse
+import os
+from collections import defaultdict
+
+import torch
+from safetensors.torch import save_file
+
+from lora_registry import load_lora_state_dict
+from bench_utils import write_results
+
+# post-training rank reduction of a LoRA adapter
+#
+#   python compress_lora.py lora_models/lora_girl_c1.safetensors --energy 0.95
+#   python compress_lora.py lora_models/lora_girl_c1.safetensors --max_rank 4 --config_path configs/config-girl1.yaml
+#
+# Every LoRA layer's delta (up @ down) is decomposed with an SVD and truncated to the smallest rank that
+# keeps `energy` of its squared singular values, capped at `max_rank`. The four layers of an attention
+# processor (q, k, v, out) must share one rank when loaded, so each processor gets the largest rank its
+# layers need and the others are zero-padded. With --config_path the original and compressed adapters
+# are sampled with the same config and the image difference is reported.
+
+LAYERS = ['to_q_lora', 'to_k_lora', 'to_v_lora', 'to_out_lora']
+
+
+def factor_svd(up, down):
+    # singular values and vectors of up @ down ([out, r] @ [r, in]) without forming the full matrix
+    q_up, r_up = torch.linalg.qr(up.double())
+    q_down, r_down = torch.linalg.qr(down.double().T)
+    u, s, vh = torch.linalg.svd(r_up @ r_down.T)
+    return q_up @ u, s, vh @ q_down.T
+
+
+def select_rank(s, energy, max_rank):
+    total = (s ** 2).sum()
+    if total == 0:
+        return 1
+    kept = torch.cumsum(s ** 2, dim=0) / total
+    rank = int((kept < energy).sum().item()) + 1
+    return max(min(rank, max_rank or rank, len(s)), 1)
+
+
+def compress_state_dict(state_dict, energy=0.99, max_rank=None):
+    # returns the compressed state dict and per-layer statistics
+    processors = defaultdict(dict)
+    for key, value in state_dict.items():
+        # <processor name>.<layer>.<up|down>.weight
+        name, layer, part, _ = key.rsplit('.', 3)
+        processors[name][f'{layer}.{part}.weight'] = value
+
+    compressed = {}
+    stats = []
+    for name, weights in processors.items():
+        factors = {}
+        for layer in LAYERS:
+            up, down = weights[f'{layer}.up.weight'], weights[f'{layer}.down.weight']
+            u, s, vh = factor_svd(up, down)
+            rank = select_rank(s, energy, max_rank)
+            factors[layer] = (u, s, vh, rank, up.dtype)
+        processor_rank = max(rank for _, _, _, rank, _ in factors.values())
+        for layer, (u, s, vh, rank, dtype) in factors.items():
+            root = s[:rank].sqrt()
+            new_up = torch.zeros(u.shape[0], processor_rank, dtype=torch.float64)
+            new_down = torch.zeros(processor_rank, vh.shape[1], dtype=torch.float64)
+            new_up[:, :rank] = u[:, :rank] * root
+            new_down[:rank] = root[:, None] * vh[:rank]
+            compressed[f'{name}.{layer}.up.weight'] = new_up.to(dtype).contiguous()
+            compressed[f'{name}.{layer}.down.weight'] = new_down.to(dtype).contiguous()
+            energy_kept = ((s[:rank] ** 2).sum() / (s ** 2).sum().clamp_min(1e-30)).item()
+            stats.append({'layer': f'{name}.{layer}', 'rank': weights[f'{layer}.down.weight'].shape[0],
+                          'needed_rank': rank, 'stored_rank': processor_rank,
+                          'rel_error': (1 - energy_kept) ** 0.5})
+    return compressed, stats
+
+
+def n_params(state_dict):
+    return sum(value.numel() for value in state_dict.values())
+
+
+def sample_difference(config_path, original_path, compressed_path, n_timesteps=None):
+    # stylize the config once with each adapter and compare the images
+    import yaml
+    from diffstyler import PNP
+    from pnp_utils_combine import seed_everything
+    from lora_registry import resolve_weight_path
+    from bench_utils import image_metrics
+
+    with open(config_path, "r") as f:
+        config = yaml.safe_load(f)
+    if n_timesteps is not None:
+        config["n_timesteps"] = n_timesteps
+    images = []
+    for weight_path in [original_path, compressed_path]:
+        lora_configs = [dict(entry, weight_path=weight_path)
+                        if os.path.abspath(resolve_weight_path(entry['weight_path'])) == os.path.abspath(original_path)
+                        else entry for entry in config["lora_configs"]]
+        run_config = dict(config, lora_configs=lora_configs,
+                          output_path=os.path.join(config["output_path"], 'compress_lora'))
+        os.makedirs(run_config["output_path"], exist_ok=True)
+        seed_everything(run_config["seed"])
+        pnp = PNP(run_config)
+        pnp.init_pnp(conv_injection_t=int(config["n_timesteps"] * config["pnp_f_t"]),
+                     qk_injection_t=int(config["n_timesteps"] * config["pnp_attn_t"]))
+        images.append(pnp.sample_loop(pnp.eps))
+    return image_metrics(images[0], images[1])
+
+
+def run(opt):
+    state_dict = load_lora_state_dict(opt.path)
+    compressed, stats = compress_state_dict(state_dict, energy=opt.energy, max_rank=opt.max_rank)
+    output = opt.output or os.path.splitext(opt.path)[0] + '-compressed.safetensors'
+    save_file(compressed, output, metadata={'format': 'pt'})
+
+    ranks = [row['stored_rank'] for row in stats]
+    print(f'[INFO] {opt.path}: {n_params(state_dict) / 1e6:.2f}M params, {os.path.getsize(opt.path) / 2 ** 20:.1f} MB')
+    print(f'[INFO] {output}: {n_params(compressed) / 1e6:.2f}M params, {os.path.getsize(output) / 2 ** 20:.1f} MB, '
+          f'ranks {min(ranks)}-{max(ranks)} (mean {sum(ranks) / len(ranks):.1f})')
+    worst = max(stats, key=lambda row: row['rel_error'])
+    print(f'[INFO] largest relative delta error {worst["rel_error"]:.4f} in {worst["layer"]}')
+
+    meta = {'path': opt.path, 'output': output, 'energy': opt.energy, 'max_rank': opt.max_rank,
+            'params': n_params(state_dict), 'compressed_params': n_params(compressed),
+            'size_mb': os.path.getsize(opt.path) / 2 ** 20, 'compressed_size_mb': os.path.getsize(output) / 2 ** 20}
+    if opt.config_path:
+        metrics = sample_difference(opt.config_path, opt.path, output, n_timesteps=opt.n_timesteps)
+        print(f'[INFO] output difference on {opt.config_path}: ' + ', '.join(f'{k} {v:.4f}' for k, v in metrics.items()))
+        meta.update(config=opt.config_path, output_difference=metrics)
+    write_results(opt.report, stats, meta=meta)
+    return output
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', type=str, help="LoRA adapter (.safetensors or .ckpt)")
+    parser.add_argument('--energy', type=float, default=0.99, help="fraction of the squared singular values to keep")
+    parser.add_argument('--max_rank', type=int, default=None, help="per-layer rank budget")
+    parser.add_argument('--output', type=str, default=None, help="default: <path>-compressed.safetensors")
+    parser.add_argument('--config_path', type=str, default=None, help="config using the adapter, to measure the output difference")
+    parser.add_argument('--n_timesteps', type=int, default=None)
+    parser.add_argument('--report', type=str, default='benchmarks/compress_lora.json', help="per-layer ranks and errors")
+    opt = parser.parse_args()
+    run(opt)
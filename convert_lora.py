@@ -0,0 +1,47 @@
+import argparse
+import glob
+import os
+import torch
+from safetensors.torch import save_file, load_file
+
+# convert pickled LoRA checkpoints (lora_models/*.ckpt) to safetensors next to them
+#
+#   python convert_lora.py                      # every lora_models/*.ckpt
+#   python convert_lora.py path/to/lora.ckpt --delete
+#
+# The configs may keep naming the .ckpt file, lora_registry.resolve_weight_path picks the .safetensors
+# copy once it exists.
+
+
+def convert(path, delete=False, overwrite=False):
+    target = os.path.splitext(path)[0] + '.safetensors'
+    if os.path.exists(target) and not overwrite:
+        print(f'[INFO] {target} exists, skipping')
+        return target
+    # only trusted checkpoints should be converted: weights_only keeps the unpickling to plain tensors
+    state_dict = torch.load(path, map_location='cpu', weights_only=True)
+    state_dict = {key: value.contiguous() for key, value in state_dict.items()}
+    save_file(state_dict, target, metadata={'format': 'pt'})
+
+    converted = load_file(target)
+    if converted.keys() != state_dict.keys() or any(not torch.equal(converted[k], state_dict[k]) for k in state_dict):
+        os.remove(target)
+        raise RuntimeError(f'{target} does not match {path} after conversion')
+    print(f'[INFO] {path} -> {target} ({os.path.getsize(path) / 2 ** 20:.1f} MB -> '
+          f'{os.path.getsize(target) / 2 ** 20:.1f} MB)')
+    if delete:
+        os.remove(path)
+    return target
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', type=str, nargs='*', help="checkpoints to convert (default: lora_models/*.ckpt)")
+    parser.add_argument('--delete', default=False, action='store_true', help="remove each .ckpt after a verified conversion")
+    parser.add_argument('--overwrite', default=False, action='store_true')
+    opt = parser.parse_args()
+    paths = opt.paths or sorted(glob.glob('lora_models/*.ckpt'))
+    if not paths:
+        print('[INFO] nothing to convert')
+    for path in paths:
+        convert(path, delete=opt.delete, overwrite=opt.overwrite)
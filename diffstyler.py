@@ -1,91 +1,156 @@
-import copy
-import glob
 import os
-from pathlib import Path
-import cv2
 import torch
 import torch.nn as nn
 import torchvision.transforms as T
 import argparse
+import time
 from PIL import Image
 import yaml
 from tqdm import tqdm
-from transformers import logging
-from diffusers import DDIMScheduler, StableDiffusionPipeline
 
 from pnp_utils_combine import *
-from diffusers.loaders import LoraLoaderMixin
-
-# suppress partial model loading warning
-logging.set_verbosity_error()
+from precision import get_device, resolve_precision, apply_precision
+from instrumentation import Profiler
+from runtime import apply_runtime
+from masks import load_mask_pyramid, validate_masks
+from lora_attention import register_regional_lora
+from lora_registry import LoRARegistry, parse_lora_configs
+from solvers import build_scheduler, reset_scheduler
+from checkpoint import Checkpointer, atomic_write
+from model_resolver import model_key, resolve_model
+from shared_weights import shared_models
+from token_merge import register_token_merge, token_merge_settings
+from feature_cache import feature_cache_branch, feature_cache_disabled, feature_cache_settings, register_feature_cache
 
 class PNP(nn.Module):
-    def __init__(self, config):
+    def __init__(self, config, models=None, source_latents=None):
+        # models: optional dict with vae, tokenizer, text_encoder, unet and scheduler to use instead of
+        # loading `sd_version` from the Hub (e.g. the small random models of tiny_models.py)
+        # source_latents: optional {timestep: latent} of the content image, instead of reading the latents
+        # saved by preprocess.py under `latents_path` (see set_source)
         super().__init__()
         self.config = config
-        self.device = config["device"]
-        sd_version = config["sd_version"]
-
-        if sd_version == '2.1':
-            model_key = "stabilityai/stable-diffusion-2-1-base"
-        elif sd_version == '2.0':
-            model_key = "stabilityai/stable-diffusion-2-base"
-        elif sd_version == '1.5':
-            model_key = "runwayml/stable-diffusion-v1-5"
-        else:
-            raise ValueError(f'Stable-diffusion version {sd_version} not supported.')
+        self.source_latents = source_latents
+        self.device = get_device(config["device"])
+        # named-span timings, enabled by the `profile` config entry
+        self.profiler = Profiler.from_config(config, self.device)
 
-        # Create SD models
-        print('Loading SD model')
+        # per-component dtypes from the `precision` config entry (fp32 if not set)
+        self.policy = resolve_precision(config.get("precision"), self.device)
 
-        if self.device == 'mps':
-            dtype = torch.float32
-        else:
-            dtype = torch.float16
+        # LoRA checkpoints start loading in the background right away, overlapping the SD model loading
+        self.lora_configs = parse_lora_configs(config)
+        self.lora_registry = LoRARegistry(self.lora_configs, self.device, max_workers=config.get("lora_load_workers", 4))
 
-        pipe = StableDiffusionPipeline.from_pretrained(model_key, torch_dtype=torch.float32).to(self.device) #.to("cuda")
-        # pipe.enable_xformers_memory_efficient_attention()
-
-        self.vae = pipe.vae
-        self.tokenizer = pipe.tokenizer
-        self.text_encoder = pipe.text_encoder
-        self.unet = pipe.unet
+        # Create SD models
+        print('Loading SD model')
 
-        self.scheduler = DDIMScheduler.from_pretrained(model_key, subfolder="scheduler")
+        with self.profiler.span('model_load'):
+            if models is None and config.get("shared_weights"):
+                # read-only frozen weights mapped from one export per host (see shared_weights.py)
+                models = shared_models(config["shared_weights"], config["sd_version"], self.policy, self.device,
+                                       self.load_models)
+            if models is None:
+                models = self.load_models(config["sd_version"])
+            for name in ['vae', 'text_encoder', 'unet']:
+                models[name].to(self.device)
+            apply_precision(self.policy, unet=models['unet'], vae=models['vae'], text_encoder=models['text_encoder'])
+
+        self.vae = models['vae']
+        self.tokenizer = models['tokenizer']
+        self.text_encoder = models['text_encoder']
+        self.unet = models['unet']
+
+        # `sampler`: 'ddim' (default) or 'dpmsolver++', on the noise schedule of the model's scheduler (solvers.py)
+        self.scheduler = build_scheduler(config.get("sampler", "ddim"), models['scheduler'])
         print(self.device)
         self.scheduler.set_timesteps(config["n_timesteps"], device=self.device)
         print('SD model loaded')
+        # a float, or one value per variant of a batched sweep ([V, 1, 1, 1] tensor, see sweep.py)
+        self.guidance_scale = config["guidance_scale"]
 
         # load image
-        self.image, self.eps = self.get_data()
+        with self.profiler.span('latent_load'):
+            self.image, self.eps = self.get_data()
 
-        self.text_embeds = self.get_text_embeds(config["prompt"], config["negative_prompt"])
-        # self.pnp_guidance_embeds = self.get_text_embeds("", "").chunk(2)[0]
-        self.pnp_guidance_embeds = self.get_text_embeds("", "")[:1]  # Shape [1, ...]
+        with self.profiler.span('prompt_encoding'):
+            self.text_embeds = self.get_text_embeds(config["prompt"], config["negative_prompt"])
+            # self.pnp_guidance_embeds = self.get_text_embeds("", "").chunk(2)[0]
+            self.pnp_guidance_embeds = self.get_text_embeds("", "")[:1]  # Shape [1, ...]
         
         self.unet_lora_list = []
 
-        self.load_lora_weights(config['lora_configs'])
+        with self.profiler.span('lora_load'):
+            self.load_lora_weights(self.lora_configs)
+
+        # opt-in token merging in the highest-resolution self-attention layers (see token_merge.py)
+        if config.get("token_merge"):
+            settings = token_merge_settings(config["token_merge"])
+            for unet in dict.fromkeys([self.unet] + [lora_model['unet'] for lora_model in self.lora_models]):
+                register_token_merge(unet, **settings)
+        # opt-in reuse of the deep UNet features across sampling steps (see feature_cache.py)
+        if config.get("feature_cache"):
+            settings = feature_cache_settings(config["feature_cache"])
+            for unet in dict.fromkeys([self.unet] + [lora_model['unet'] for lora_model in self.lora_models]):
+                register_feature_cache(unet, **settings)
+
+    @staticmethod
+    def load_models(sd_version):
+        # diffusers and transformers are only imported when the SD weights are actually loaded
+        from transformers import logging
+        from diffusers import DDIMScheduler, StableDiffusionPipeline
+
+        # suppress partial model loading warning
+        logging.set_verbosity_error()
+        # the local snapshot when the weights are cached (no Hub lookup), see model_resolver.py
+        model_path = resolve_model(model_key(sd_version))
+
+        pipe = StableDiffusionPipeline.from_pretrained(model_path, torch_dtype=torch.float32) #.to("cuda")
+        # pipe.enable_xformers_memory_efficient_attention()
+        scheduler = DDIMScheduler.from_pretrained(model_path, subfolder="scheduler")
+        return {'vae': pipe.vae, 'tokenizer': pipe.tokenizer, 'text_encoder': pipe.text_encoder,
+                'unet': pipe.unet, 'scheduler': scheduler}
 
     def load_lora_weights(self, lora_configs):
+        # lora_mode 'blend' (default): one UNet copy per LoRA, the noise predictions are blended by the masks
+        # lora_mode 'regional': the LoRAs are routed through the attention processors of the base UNet, so
+        # every step is a single UNet pass (see lora_attention.py)
+        regional = self.config.get("lora_mode", "blend") == "regional"
+        registry = self.lora_registry if lora_configs is self.lora_configs else LoRARegistry(lora_configs, self.device)
         self.lora_models = []
+        self.regional = None
+        regions = []
+        prompt_embeds = {}
         for config in lora_configs:
-            # Create a copy of the UNet model
-            unet_lora = copy.deepcopy(self.unet)
-            # Load the LoRA weights
-            lora_state_dict = torch.load(config['weight_path'], map_location=self.device)
-            # LoraLoaderMixin.load_lora_weights(unet_lora, lora_state_dict)
-            unet_lora.load_attn_procs(lora_state_dict)
-
-            # Load the mask
-            mask = Image.open(config['mask_path']).convert('L')
-            mask = mask.resize((64, 64), Image.BILINEAR)
-            mask = torch.tensor(np.array(mask) / 255.0, dtype=torch.float32).to(self.device)
-            mask = mask.unsqueeze(0).unsqueeze(0)
+            # Load the LoRA weights (each file once, see lora_registry.py)
+            lora_state_dict = registry.state_dict(config['weight_path'])
+            unet_lora = None
+            if not regional:
+                # Copy of the UNet with the adapter, shared by the entries using the same weights
+                unet_lora = registry.unet(config['weight_path'], self.unet,
+                                          setup=lambda unet: apply_precision(self.policy, unet=unet),
+                                          share_weights=bool(self.config.get("shared_weights")))
+
+            # Load the mask, one level per UNet resolution (cached across runs, see masks.py)
+            feather = config.get('mask_feather', self.config.get("mask_feather", 0.0))
+            mask_pyramid = load_mask_pyramid(config['mask_path'], self.eps.shape[-2:], feather=feather).to(self.device)
+            mask = mask_pyramid.latent
             # Get text embeddings for this style
-            text_embeds = self.get_text_embeds(config['prompt'], self.config["negative_prompt"])
+            if config['prompt'] not in prompt_embeds:
+                prompt_embeds[config['prompt']] = self.get_text_embeds(config['prompt'], self.config["negative_prompt"])
+            text_embeds = prompt_embeds[config['prompt']]
             # Store the model, mask, and text embeddings
-            self.lora_models.append({'unet': unet_lora, 'mask': mask, 'text_embeds': text_embeds})
+            regions.append({'unet': unet_lora, 'mask': mask, 'mask_pyramid': mask_pyramid,
+                            'text_embeds': text_embeds, 'state_dict': lora_state_dict if regional else None})
+        validate_masks([region['mask_pyramid'] for region in regions])
+
+        if not regional:
+            self.lora_models = regions
+            return
+        self.regional = register_regional_lora(
+            self.unet, [region['state_dict'] for region in regions], [region['mask_pyramid'] for region in regions],
+            [torch.cat([self.pnp_guidance_embeds, region['text_embeds']], dim=0) for region in regions])
+        apply_precision(self.policy, unet=self.unet)
 
     @torch.no_grad()
     def get_text_embeds(self, prompt, negative_prompt, batch_size=1):
@@ -103,22 +168,15 @@ class PNP(nn.Module):
         # Cat for final embeddings
         # text_embeddings = torch.cat([uncond_embeddings] * batch_size + [text_embeddings] * batch_size)
         text_embeddings = torch.cat([uncond_embeddings, text_embeddings], dim=0)
-        return text_embeddings
+        # the embeddings are only consumed by the UNets
+        return text_embeddings.to(self.policy['unet'])
         
 
     @torch.no_grad()
     def decode_latent(self, latents):
-        if self.device != 'mps':
-            # Use autocast only for 'cuda' or 'cpu'
-            with torch.autocast(device_type=self.device.type, dtype=torch.float16):
-                latents = 1 / 0.18215 * latents
-                imgs = self.vae.decode(latents).sample
-                imgs = (imgs / 2 + 0.5).clamp(0, 1)
-        else:
-            # Use float32 without autocast for 'mps'
-            latents = 1 / 0.18215 * latents
-            imgs = self.vae.decode(latents).sample
-            imgs = (imgs / 2 + 0.5).clamp(0, 1)
+        latents = 1 / 0.18215 * latents
+        imgs = self.vae.decode(latents.to(self.policy['vae'])).sample.float()
+        imgs = (imgs / 2 + 0.5).clamp(0, 1)
         return imgs
     # def decode_latent(self, latent):
     #     with torch.autocast(device_type=self.device.type, dtype=torch.float32):
@@ -134,10 +192,21 @@ class PNP(nn.Module):
         image = image.resize((512, 512), resample=Image.Resampling.LANCZOS)
         image = T.ToTensor()(image).to(self.device)
         # get noise
-        latents_path = os.path.join(self.config["latents_path"], os.path.splitext(os.path.basename(self.config["image_path"]))[0], f'noisy_latents_{self.scheduler.timesteps[0]}.pt')
-        noisy_latent = torch.load(latents_path).to(self.device)
+        noisy_latent = self.load_source_latents(self.scheduler.timesteps[0]).to(self.device, torch.float32)
         return image, noisy_latent
 
+    def load_source_latents(self, t):
+        if self.source_latents is not None:
+            return self.source_latents[int(t)]
+        return load_source_latents_t(t, os.path.join(self.config["latents_path"],
+                                                     os.path.splitext(os.path.basename(self.config["image_path"]))[0]))
+
+    def set_source(self, source_latents):
+        # switch to another content image of the same size (e.g. the next frame of a sequence), keeping the
+        # models, LoRAs, prompt embeddings and mask pyramids
+        self.source_latents = source_latents
+        self.eps = self.load_source_latents(self.scheduler.timesteps[0]).to(self.device, torch.float32)
+
     # @torch.no_grad()
     # def denoise_step(self, x, t):
     #     # register the time step and features in pnp injection modules
@@ -185,47 +254,58 @@ class PNP(nn.Module):
 
     def denoise_step(self, x, t):
         # Load source latents (used in PnP modules)
-        source_latents = load_source_latents_t(
-            t,
-            os.path.join(
-                self.config["latents_path"],
-                os.path.splitext(os.path.basename(self.config["image_path"]))[0]
-            )
-        ).to(self.device)
+        with self.profiler.span('latent_load'):
+            source_latents = self.load_source_latents(t).to(self.device, torch.float32)
 
         # Ensure source_latents has correct batch size
         if source_latents.dim() == 3:
             source_latents = source_latents.unsqueeze(0)  # Add batch dimension
-
-        # Register time and source_latents in PnP modules
-        register_time(self.unet, t.item(), source_latents)
-        for lora_model in self.lora_models:
-            register_time(lora_model['unet'], t.item(), source_latents)
+        # several samples of the same content image share its source latents
+        batch_size = x.shape[0]
+        if source_latents.shape[0] != batch_size:
+            source_latents = source_latents.expand(batch_size, -1, -1, -1)
+
+        # Register time and source_latents in PnP modules (the injection itself runs inside the UNet forwards
+        # and is part of unet_base / unet_lora)
+        with self.profiler.span('register_time'):
+            register_time(self.unet, t.item(), source_latents)
+            for lora_model in self.lora_models:
+                register_time(lora_model['unet'], t.item(), source_latents)
 
         # Prepare latent_model_input with batch size 3
         latent_model_input = torch.cat([source_latents, x, x], dim=0)  # Shape: [3, C, H, W]
+        latent_model_input = latent_model_input.to(self.policy['unet'])
 
         # Prepare text embeddings with batch size 3
         text_embeds = torch.cat([self.pnp_guidance_embeds, self.text_embeds], dim=0)  # Shape: [3, ...]
+        if batch_size > 1:
+            text_embeds = text_embeds.repeat_interleave(batch_size, dim=0)
 
         # Apply the denoising network
-        noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=text_embeds)['sample']
+        with self.profiler.span('unet_base'), feature_cache_branch(self.unet, 'base'):
+            noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=text_embeds)['sample'].float()
 
         # Apply the LoRA models
-        for lora_model in self.lora_models:
+        for i, lora_model in enumerate(self.lora_models):
             unet_lora = lora_model['unet']
             mask = lora_model['mask']
             lora_text_embeds = torch.cat([self.pnp_guidance_embeds, lora_model['text_embeds']], dim=0)  # Shape: [3, ...]
-            noise_pred_lora = unet_lora(latent_model_input, t, encoder_hidden_states=lora_text_embeds)['sample']
+            if batch_size > 1:
+                lora_text_embeds = lora_text_embeds.repeat_interleave(batch_size, dim=0)
+            # entries with the same weights share the UNet, not its cached features (see feature_cache.py)
+            with self.profiler.span('unet_lora', lora=i), feature_cache_branch(unet_lora, i):
+                noise_pred_lora = unet_lora(latent_model_input, t, encoder_hidden_states=lora_text_embeds)['sample'].float()
             # Blend the noise predictions based on the mask
-            noise_pred = noise_pred * (1 - mask) + noise_pred_lora * mask
+            with self.profiler.span('mask_blend'):
+                noise_pred = noise_pred * (1 - mask) + noise_pred_lora * mask
 
         # Perform guidance
         _, noise_pred_uncond, noise_pred_cond = noise_pred.chunk(3)
-        noise_pred = noise_pred_uncond + self.config["guidance_scale"] * (noise_pred_cond - noise_pred_uncond)
+        noise_pred = noise_pred_uncond + self.guidance_scale * (noise_pred_cond - noise_pred_uncond)
 
         # Compute the denoising step with the scheduler
-        denoised_latent = self.scheduler.step(noise_pred, t, x)['prev_sample']
+        with self.profiler.span('scheduler_step'):
+            denoised_latent = self.scheduler.step(noise_pred, t, x)['prev_sample']
         return denoised_latent
 
     @torch.no_grad()
@@ -271,31 +351,137 @@ class PNP(nn.Module):
     def init_pnp(self, conv_injection_t, qk_injection_t):
         self.qk_injection_timesteps = self.scheduler.timesteps[:qk_injection_t] if qk_injection_t >= 0 else []
         self.conv_injection_timesteps = self.scheduler.timesteps[:conv_injection_t] if conv_injection_t >= 0 else []
-        register_attention_control_efficient(self.unet, self.qk_injection_timesteps)
-        register_conv_control_efficient(self.unet, self.conv_injection_timesteps)
+        # compiled UNets need the tensor-gated injection so every step traces to the same graph
+        gated = self.config.get("compile", False)
+        # with regional LoRA routing the attention processors do the injection (see lora_attention.py)
+        register_attention_control_efficient(self.unet, self.qk_injection_timesteps, gated=gated,
+                                             use_processor=self.regional is not None)
+        register_conv_control_efficient(self.unet, self.conv_injection_timesteps, gated=gated)
+
+    def init_pnp_variants(self, conv_injection_ts, qk_injection_ts):
+        # one injection threshold per variant of a batched sampling loop; x then holds one row per variant
+        conv_schedules = [self.scheduler.timesteps[:t] if t >= 0 else [] for t in conv_injection_ts]
+        qk_schedules = [self.scheduler.timesteps[:t] if t >= 0 else [] for t in qk_injection_ts]
+        if not hasattr(self.unet.up_blocks[1].resnets[1], 'injection_gate'):
+            register_attention_control_efficient(self.unet, None, gated=True, use_processor=self.regional is not None)
+            register_conv_control_efficient(self.unet, None, gated=True)
+        register_variant_schedules(self.unet, conv_schedules, qk_schedules)
+
+    def set_lora_strengths(self, scales):
+        # scales: [V, n_loras] LoRA strengths, one row per sample of the batch denoise_step gets (x with V
+        # rows); None restores full strength. Needs lora_mode 'regional', where the adapters are scaled inside
+        # the attention processors (see strength_strip.py)
+        if self.regional is None:
+            raise ValueError("Per-sample LoRA strengths need lora_mode: regional.")
+        if scales is not None and len(scales[0]) != len(self.lora_configs):
+            raise ValueError(f'{len(scales[0])} strengths per sample for {len(self.lora_configs)} LoRAs.')
+        self.regional.set_scales(scales)
+
+    def quantize_unets(self):
+        # opt-in int8 UNets for CPU sampling, see quantization.py
+        from quantization import merge_lora_weights, quantize_dynamic_unet, quantize_static_unet
+
+        mode = self.config["quantize"]
+        if self.device.type != 'cpu' or self.policy['unet'] != torch.float32:
+            raise ValueError('int8 quantization needs device: cpu and an fp32 UNet precision.')
+        if self.config.get("shared_weights"):
+            raise ValueError('int8 quantization rewrites the UNet weights and cannot run on shared_weights.')
+        branches = [(self.unet, self.text_embeds)] + [(m['unet'], m['text_embeds']) for m in self.lora_models]
+        quantized = set()
+        for unet, text_embeds in branches:
+            # entries with the same weight file share one UNet, quantize it once
+            if id(unet) in quantized:
+                continue
+            quantized.add(id(unet))
+            # LoRA deltas are either folded into the base weights before quantization or kept in fp32
+            if self.config.get("quantize_lora", "keep") == "merge":
+                merge_lora_weights(unet)
+            if mode == 'dynamic':
+                quantize_dynamic_unet(unet)
+            elif mode == 'static':
+                # calibration sees every batch through the full UNet, not cached deep features
+                with feature_cache_disabled(unet):
+                    quantize_static_unet(unet, self.calibration_batches(text_embeds))
+            else:
+                raise ValueError(f'Quantization mode {mode} not supported.')
+
+    def calibration_batches(self, text_embeds):
+        # calibrate on the cached inversion latents of the content image at a spread of sampling timesteps
+        n_steps = self.config.get("quantize_calibration_steps", 8)
+        stride = max(len(self.scheduler.timesteps) // n_steps, 1)
+        for t in self.scheduler.timesteps[::stride][:n_steps]:
+            source_latents = self.load_source_latents(t).to(self.device, torch.float32)
+            latent_model_input = torch.cat([source_latents] * 3, dim=0)
+            yield latent_model_input, t, torch.cat([self.pnp_guidance_embeds, text_embeds], dim=0)
+
+    def compile_unets(self):
+        # opt-in torch.compile of the base UNet and every LoRA branch
+        mode = self.config.get("compile_mode", None)
+        cache_dir = self.config.get("compile_cache_dir", None)
+        self.unet = compile_unet(self.unet, mode=mode, cache_dir=cache_dir)
+        compiled = {}
+        for lora_model in self.lora_models:
+            # entries with the same weight file share one UNet, compile it once
+            if id(lora_model['unet']) not in compiled:
+                compiled[id(lora_model['unet'])] = compile_unet(lora_model['unet'], mode=mode, cache_dir=cache_dir)
+            lora_model['unet'] = compiled[id(lora_model['unet'])]
+        self.warmup_unets()
 
-    def run_pnp(self):
+    @torch.no_grad()
+    def warmup_unets(self):
+        # run every UNet once with the sampling shapes so compilation is not charged to the first step
+        start = time.perf_counter()
+        t = self.scheduler.timesteps[0]
+        latent_model_input = torch.cat([self.eps] * 3, dim=0).to(self.policy['unet'])
+        register_time(self.unet, t.item(), self.eps)
+        self.unet(latent_model_input, t, encoder_hidden_states=torch.cat([self.pnp_guidance_embeds, self.text_embeds], dim=0))
+        for lora_model in self.lora_models:
+            register_time(lora_model['unet'], t.item(), self.eps)
+            lora_text_embeds = torch.cat([self.pnp_guidance_embeds, lora_model['text_embeds']], dim=0)
+            lora_model['unet'](latent_model_input, t, encoder_hidden_states=lora_text_embeds)
+        print(f'[INFO] UNets compiled and warmed up in {time.perf_counter() - start:.1f}s')
+
+    def prepare_unets(self):
+        # the injection forwards with the `quantize` and `compile` settings of the config applied
+        # pnp_f_t / pnp_attn_t are fractions of the schedule, so they scale with n_timesteps (short solver schedules)
         pnp_f_t = int(self.config["n_timesteps"] * self.config["pnp_f_t"])
         pnp_attn_t = int(self.config["n_timesteps"] * self.config["pnp_attn_t"])
-        pnp_f_t = 50
-        pnp_attn_t = 50
+        # quantize before patching, the patched attention forwards capture their output projection
+        if self.config.get("quantize"):
+            self.quantize_unets()
         self.init_pnp(conv_injection_t=pnp_f_t, qk_injection_t=pnp_attn_t)
+        if self.config.get("compile", False):
+            self.compile_unets()
+
+    def run_pnp(self):
+        self.prepare_unets()
         edited_img = self.sample_loop(self.eps)
+        if self.profiler.enabled:
+            self.profiler.print_summary()
+            self.profiler.save()
 
     def sample_loop(self, x):
-        if self.device != 'mps':
-            # Use autocast only for 'cuda' or 'cpu'
-            with torch.autocast(device_type=self.device, dtype=torch.float16):
-                for i, t in enumerate(tqdm(self.scheduler.timesteps, desc="Sampling")):
-                    x = self.denoise_step(x, t)
-                decoded_latent = self.decode_latent(x)
-                T.ToPILImage()(decoded_latent[0]).save(f'{self.config["output_path"]}/output-{self.config["prompt"]}.png') 
-        else:
-            with torch.no_grad():
-                for i, t in enumerate(tqdm(self.scheduler.timesteps, desc="Sampling")):
+        # the networks already run in their policy dtype, latents stay in fp32
+        reset_scheduler(self.scheduler)
+        # with a `checkpoint` config entry the loop state is saved periodically and a relaunch resumes from it
+        checkpointer = Checkpointer.from_config(self.config, job={'config': self.config, 'loop': 'sample'})
+        start = 0
+        state = checkpointer.load(self.device) if checkpointer is not None else None
+        if state is not None:
+            start, x = checkpointer.restore(state, self.scheduler, self.device)
+        with torch.no_grad():
+            for i, t in enumerate(tqdm(self.scheduler.timesteps[start:], desc="Sampling"), start):
+                with self.profiler.span('step', t=t.item()):
                     x = self.denoise_step(x, t)
+                if checkpointer is not None:
+                    checkpointer.step(i + 1, x, self.scheduler)
+            with self.profiler.span('vae_decode'):
                 decoded_latent = self.decode_latent(x)
-                T.ToPILImage()(decoded_latent[0]).save(f'{self.config["output_path"]}/output-{self.config["prompt"]}.png') 
+            with self.profiler.span('save'):
+                atomic_write(f'{self.config["output_path"]}/output-{self.config["prompt"]}.png',
+                             T.ToPILImage()(decoded_latent[0]).save)
+        if checkpointer is not None:
+            checkpointer.clear()
         return decoded_latent
         # with torch.autocast(device_type='cuda', dtype=torch.float32):
         #     for i, t in enumerate(tqdm(self.scheduler.timesteps, desc="Sampling")):
@@ -313,25 +499,11 @@ class PNP(nn.Module):
     
     
     def load_lora(self):
-        self.mask_list = []
-        self.lora_list = []
-        self.lora_text_embeds_list = []
-        for lora_name in self.lora_name_list:
-            unet_lora_temp = copy.deepcopy(self.unet)
-            load_lora_paths = './lora_models/' + lora_name.strip() + '.ckpt'
-            lora = torch.load(load_lora_paths, map_location="mps")
-            unet_lora_temp.load_attn_procs(lora)
-            self.init_pnp_lora(unet_lora_temp,30,25)
-            self.lora_list.append(unet_lora_temp)
-        for mask_name in self.mask_name_list:
-            mask_path = 'mask/'+ mask_name.strip() + '.png'
-            mask = cv2.imread(mask_path)
-            mask = cv2.resize(mask,[64,64])
-            mask = np.array(mask, dtype = bool)[:,:,0]
-            self.mask_list.append(mask)
-        for prompts in self.prompt_gene_list:
-            text_embeds = self.get_text_embeds(prompts.strip(), config["negative_prompt"])
-            self.lora_text_embeds_list.append(text_embeds)
+        # lists used by denoise_step_all, taken from the adapters load_lora_weights already loaded
+        # (boolean masks for its hard replacement: any nonzero pixel is foreground, as with the former cv2 masks)
+        self.lora_list = [lora_model['unet'] for lora_model in self.lora_models]
+        self.mask_list = [lora_model['mask_pyramid'].binary(threshold=0) for lora_model in self.lora_models]
+        self.lora_text_embeds_list = [lora_model['text_embeds'] for lora_model in self.lora_models]
         return
 
 
@@ -344,12 +516,11 @@ if __name__ == '__main__':
     os.makedirs(config["output_path"], exist_ok=True)
     with open(os.path.join(config["output_path"], "config.yaml"), "w") as f:
         yaml.dump(config, f)
-    
+
+    # thread counts and cpu affinity from the `runtime` config section, before any torch work
+    runtime = apply_runtime(config.get("runtime"))
+    print(f'[INFO] {runtime["threads"]} threads, {runtime["interop_threads"]} interop threads')
     seed_everything(config["seed"])
     print(config)
     pnp = PNP(config)
-    pnp.prompt_gene_list = config['prompt_gene'].split(';')
-    pnp.lora_name_list = config['lora_name'].split(';')
-    pnp.mask_name_list = config['mask'].split(';')
-    pnp.load_lora()
     pnp.run_pnp()
\ No newline at end of file
@@ -0,0 +1,134 @@
+import contextlib
+
+# cross-step caching of the deep UNet blocks (DeepCache)
+#
+# Consecutive sampling steps produce almost the same low-resolution features. With an interval of k, every
+# k-th step runs the whole UNet and keeps the outputs of the deep blocks (down_blocks[1:], mid_block,
+# up_blocks[:-1]); the steps in between only run the shallow high-resolution path (conv_in, down_blocks[0],
+# up_blocks[3], conv_out) and take the deep features, i.e. the input of up_blocks[3], from the last full
+# step. `shallow_levels` moves the split deeper (2: down_blocks[:2] and up_blocks[2:] are recomputed).
+#
+# The deep blocks are still called on cached steps, they just return their cached output, so the UNet
+# forward, the time registration of the PnP modules and the injection in the recomputed blocks work as
+# usual. The injections inside the deep blocks (the conv features of up_blocks[1] and the attention of
+# up_blocks[1:3]) take effect on the full steps and are carried by their cached output in between.
+#
+# The cache is kept per branch, not per UNet: lora_configs entries with the same weights share one UNet copy
+# (LoRARegistry.unet) but have their own prompts, so denoise_step names the branch of every call
+# (feature_cache_branch). For each branch a new sampling loop (the timestep goes up) or a new batch shape
+# starts with a full step; repeated calls at the same timestep continue the count. Calls that are not steps
+# of a loop (quantization calibration) run uncached inside feature_cache_disabled.
+#
+# `feature_cache: 3` in a config (or {interval: 3, shallow_levels: 1}) enables it, see register_feature_cache.
+
+
+class FeatureCache:
+    def __init__(self, interval=3, shallow_levels=1):
+        if interval < 1:
+            raise ValueError(f'feature_cache interval must be at least 1, got {interval}.')
+        self.interval = interval
+        self.shallow_levels = shallow_levels
+        self.enabled = True
+        self.branch = None
+        self.branches = {}
+        self.refresh = True
+        self.stats = {'full': 0, 'cached': 0}
+
+    def begin(self, sample, t):
+        # called before every UNet forward: full step or cached step of the current branch
+        if not self.enabled:
+            self.refresh = True
+            return
+        t = float(t)
+        state = self.branches.setdefault(self.branch, {'outputs': {}, 'index': 0, 'last_t': None, 'shape': None})
+        if state['last_t'] is None or t > state['last_t'] or tuple(sample.shape) != state['shape']:
+            state['index'] = 0
+        self.refresh = state['index'] % self.interval == 0
+        self.stats['full' if self.refresh else 'cached'] += 1
+        state['index'] += 1
+        state['last_t'] = t
+        state['shape'] = tuple(sample.shape)
+
+    def wrap(self, name, forward):
+        def cached_forward(*args, **kwargs):
+            if not self.enabled:
+                return forward(*args, **kwargs)
+            outputs = self.branches[self.branch]['outputs']
+            if self.refresh or name not in outputs:
+                outputs[name] = forward(*args, **kwargs)
+            return outputs[name]
+        return cached_forward
+
+
+@contextlib.contextmanager
+def feature_cache_branch(model_unet, branch):
+    # UNet calls inside belong to `branch` (e.g. the index of a lora_configs entry)
+    cache = getattr(model_unet, 'feature_cache', None)
+    if cache is None:
+        yield
+        return
+    previous, cache.branch = cache.branch, branch
+    try:
+        yield
+    finally:
+        cache.branch = previous
+
+
+@contextlib.contextmanager
+def feature_cache_disabled(model_unet):
+    cache = getattr(model_unet, 'feature_cache', None)
+    if cache is None:
+        yield
+        return
+    previous, cache.enabled = cache.enabled, False
+    try:
+        yield
+    finally:
+        cache.enabled = previous
+
+
+def feature_cache_settings(setting):
+    # `feature_cache` config entry: an interval, or {interval, shallow_levels}
+    if isinstance(setting, dict):
+        return setting
+    return {'interval': int(setting)}
+
+
+def cached_blocks(model_unet, shallow_levels=1):
+    n_up = len(model_unet.up_blocks)
+    blocks = [(f'down_blocks.{i}', block) for i, block in enumerate(model_unet.down_blocks) if i >= shallow_levels]
+    blocks.append(('mid_block', model_unet.mid_block))
+    blocks += [(f'up_blocks.{i}', block) for i, block in enumerate(model_unet.up_blocks) if i < n_up - shallow_levels]
+    return blocks
+
+
+def register_feature_cache(model_unet, interval=3, shallow_levels=1):
+    remove_feature_cache(model_unet)
+    cache = FeatureCache(interval, shallow_levels=shallow_levels)
+
+    def begin(module, args, kwargs):
+        sample = args[0] if args else kwargs['sample']
+        timestep = args[1] if len(args) > 1 else kwargs['timestep']
+        cache.begin(sample, timestep)
+
+    model_unet.feature_cache_handle = model_unet.register_forward_pre_hook(begin, with_kwargs=True)
+    for name, block in cached_blocks(model_unet, shallow_levels):
+        # keep a forward patched on the instance, if any, to restore it in remove_feature_cache
+        block.uncached_forward = block.__dict__.get('forward')
+        block.forward = cache.wrap(name, block.forward)
+    model_unet.feature_cache = cache
+    return cache
+
+
+def remove_feature_cache(model_unet):
+    cache = getattr(model_unet, 'feature_cache', None)
+    if cache is None:
+        return
+    model_unet.feature_cache_handle.remove()
+    for _, block in cached_blocks(model_unet, cache.shallow_levels):
+        if block.uncached_forward is None:
+            del block.forward
+        else:
+            block.forward = block.uncached_forward
+        del block.uncached_forward
+    model_unet.feature_cache = None
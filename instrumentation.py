@@ -0,0 +1,95 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+from bench_utils import synchronize
+from checkpoint import atomic_write
+
+# lightweight named-span profiler for the stylization pipeline
+#
+#   profiler = Profiler.from_config(config, device)
+#   with profiler.span('unet_base'):
+#       ...
+#   profiler.save()  # <output_dir>/profile.json and <output_dir>/profile_trace.json (chrome://tracing)
+#
+# Spans synchronize the device on entry and exit so asynchronous kernels are charged to the right span.
+# A disabled profiler hands out one shared no-op context, so leaving spans in the hot path is cheap.
+
+_NULL_SPAN = contextlib.nullcontext()
+
+
+class Profiler:
+    def __init__(self, enabled=False, device='cpu', output_dir='.', sync=True):
+        self.enabled = enabled
+        self.device = device
+        self.output_dir = output_dir
+        self.sync = sync
+        self.events = []
+        self.origin = time.perf_counter()
+
+    @classmethod
+    def from_config(cls, config, device):
+        # `profile: true`, or `profile: {enabled: true, output_dir: ..., sync: false}`
+        profile = config.get("profile", False)
+        if not isinstance(profile, dict):
+            profile = {'enabled': bool(profile)}
+        return cls(enabled=profile.get('enabled', True), device=device,
+                   output_dir=profile.get('output_dir', config.get("output_path", '.')),
+                   sync=profile.get('sync', True))
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return _NULL_SPAN
+        return self._span(name, args)
+
+    @contextlib.contextmanager
+    def _span(self, name, args):
+        if self.sync:
+            synchronize(self.device)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync:
+                synchronize(self.device)
+            end = time.perf_counter()
+            self.events.append({'name': name, 'start': start - self.origin, 'duration': end - start,
+                                'tid': threading.get_ident(), 'args': args})
+
+    def summary(self):
+        # total / mean / min / max milliseconds per span name, in order of first appearance
+        stats = {}
+        for event in self.events:
+            ms = event['duration'] * 1000
+            entry = stats.setdefault(event['name'], {'count': 0, 'total_ms': 0.0, 'min_ms': ms, 'max_ms': ms})
+            entry['count'] += 1
+            entry['total_ms'] += ms
+            entry['min_ms'] = min(entry['min_ms'], ms)
+            entry['max_ms'] = max(entry['max_ms'], ms)
+        for entry in stats.values():
+            entry['mean_ms'] = entry['total_ms'] / entry['count']
+        return stats
+
+    def chrome_trace(self):
+        pid = os.getpid()
+        return {'traceEvents': [{'name': event['name'], 'ph': 'X', 'pid': pid, 'tid': event['tid'],
+                                 'ts': event['start'] * 1e6, 'dur': event['duration'] * 1e6,
+                                 'args': event['args']} for event in self.events],
+                'displayTimeUnit': 'ms'}
+
+    def print_summary(self):
+        for name, entry in self.summary().items():
+            print(f'[PROFILE] {name:<20} {entry["count"]:>5} x {entry["mean_ms"]:>9.2f} ms = {entry["total_ms"]:>10.1f} ms')
+
+    def save(self, output_dir=None):
+        if not self.enabled:
+            return
+        output_dir = output_dir or self.output_dir
+        os.makedirs(output_dir, exist_ok=True)
+        atomic_write(os.path.join(output_dir, 'profile.json'),
+                     lambda f: json.dump({'summary': self.summary(), 'events': self.events}, f, indent=2), mode='w')
+        atomic_write(os.path.join(output_dir, 'profile_trace.json'), lambda f: json.dump(self.chrome_trace(), f),
+                     mode='w')
+        print(f'[INFO] profile written to {output_dir}')
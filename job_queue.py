@@ -0,0 +1,305 @@
+import argparse
+import itertools
+import json
+import os
+import queue
+import random
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from bench_utils import print_table, write_results
+
+# local job scheduler with dynamic batching
+#
+#   python job_queue.py --configs configs/config-girl1.yaml --jobs 32 --rate 0.2 --max_batch 4 --max_wait 10
+#   python job_queue.py --simulate --jobs 200 --rate 4      # scheduling only, no models
+#   python job_queue.py --tiny --jobs 16                     # tiny random models, offline
+#
+# Jobs are config dicts (the schema of configs/*.yaml). Jobs that only differ in guidance_scale, pnp_attn_t,
+# pnp_f_t, output_path or job_name can share one sampling batch: same models, content image, prompts and
+# LoRAs, with per-sample guidance and injection gates (the batched path of sweep.py). The scheduler keeps
+# one queue per compatible group and hands a group to a free worker when it has max_batch jobs or when its
+# oldest job has waited max_wait seconds (the latency budget). While every worker is busy the jobs stay
+# pending, so a group keeps filling up until a worker can take it. Workers keep the PNP of the groups they
+# served resident, so a batch of a known group skips model loading. Queue wait, batch occupancy and
+# throughput are reported by JobScheduler.metrics().
+#
+# Without arguments besides --configs, the synthetic load generator submits --jobs jobs at --rate jobs/s
+# (Poisson arrivals), drawn from the given configs with varied guidance and thresholds.
+
+# entries that must be equal for jobs to share a batch (and a resident PNP: the model state is built from them)
+BATCH_KEYS = ['sd_version', 'device', 'n_timesteps', 'sampler', 'image_path', 'latents_path', 'prompt',
+              'negative_prompt', 'lora_configs', 'lora_name', 'mask', 'prompt_gene', 'lora_mode', 'mask_feather',
+              'precision', 'token_merge', 'feature_cache', 'compile', 'compile_mode', 'compile_cache_dir',
+              'quantize', 'quantize_lora', 'quantize_calibration_steps', 'shared_weights']
+
+
+def batch_key(config):
+    return json.dumps({key: config.get(key) for key in BATCH_KEYS}, sort_keys=True, default=str)
+
+
+class Job:
+    _ids = itertools.count()
+
+    def __init__(self, config):
+        self.id = next(Job._ids)
+        self.config = config
+        self.key = batch_key(config)
+        self.submitted = time.perf_counter()
+        self.dispatched = self.finished = None
+        self.result = self.error = None
+        self.done = threading.Event()
+
+    def wait(self, timeout=None):
+        # result of the job; a failure of its batch is raised here
+        if not self.done.wait(timeout):
+            raise TimeoutError(f'job {self.id} not done after {timeout} s')
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class JobScheduler:
+    def __init__(self, executor, n_workers=1, max_batch=4, max_wait=2.0):
+        # executor(worker_state, configs) runs one batch and returns one result per config; worker_state is a
+        # dict private to the worker thread, for resident models
+        self.executor = executor
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.pending = OrderedDict()
+        self.jobs = []
+        self.batch_stats = []
+        self.closed = False
+        self.idle = n_workers
+        self.lock = threading.Condition()
+        self.batches = queue.Queue()
+        self.dispatcher = threading.Thread(target=self._dispatch, name='dispatch', daemon=True)
+        self.workers = [threading.Thread(target=self._work, args=(i,), name=f'worker-{i}', daemon=True)
+                        for i in range(n_workers)]
+        self.dispatcher.start()
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, config):
+        job = Job(config)
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('the scheduler is closed')
+            self.pending.setdefault(job.key, []).append(job)
+            self.jobs.append(job)
+            self.lock.notify()
+        return job
+
+    def _ready(self, jobs, now):
+        return len(jobs) >= self.max_batch or now - jobs[0].submitted >= self.max_wait or self.closed
+
+    def _dispatch(self):
+        with self.lock:
+            while True:
+                now = time.perf_counter()
+                # oldest group first, one batch per free worker
+                for key in sorted(self.pending, key=lambda key: self.pending[key][0].submitted):
+                    while self.idle and key in self.pending and self._ready(self.pending[key], now):
+                        jobs = self.pending[key]
+                        batch, rest = jobs[:self.max_batch], jobs[self.max_batch:]
+                        if rest:
+                            self.pending[key] = rest
+                        else:
+                            del self.pending[key]
+                        for job in batch:
+                            job.dispatched = now
+                        self.idle -= 1
+                        self.batches.put(batch)
+                if self.closed and not self.pending:
+                    break
+                # sleep until the next group reaches its latency budget, a job arrives or a worker is free
+                deadlines = [jobs[0].submitted + self.max_wait for jobs in self.pending.values()]
+                self.lock.wait(max(min(deadlines) - now, 0) if deadlines and self.idle else None)
+        for _ in self.workers:
+            self.batches.put(None)
+
+    def _work(self, worker_id):
+        state = {}
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                break
+            start = time.perf_counter()
+            results, error = [None] * len(batch), None
+            try:
+                results = self.executor(state, [job.config for job in batch])
+            except Exception as e:
+                error = e
+                print(f'[WARN] worker {worker_id}: batch of {len(batch)} jobs failed: {e!r}')
+            end = time.perf_counter()
+            with self.lock:
+                self.batch_stats.append({'worker': worker_id, 'size': len(batch), 'seconds': end - start,
+                                         'group': batch[0].key, 'error': None if error is None else repr(error)})
+                self.idle += 1
+                self.lock.notify()
+            for job, result in zip(batch, results):
+                job.finished, job.result, job.error = end, result, error
+                job.done.set()
+
+    def close(self):
+        # dispatch what is still queued, wait for the workers to finish it
+        with self.lock:
+            self.closed = True
+            self.lock.notify()
+        self.dispatcher.join()
+        for worker in self.workers:
+            worker.join()
+
+    def metrics(self):
+        with self.lock:
+            done = [job for job in self.jobs if job.finished is not None]
+            batches = list(self.batch_stats)
+        if not done:
+            return {'jobs': 0}
+        waits = sorted(job.dispatched - job.submitted for job in done)
+        latencies = sorted(job.finished - job.submitted for job in done)
+        span = max(job.finished for job in done) - min(job.submitted for job in done)
+        mean_batch = sum(batch['size'] for batch in batches) / len(batches)
+        return {'jobs': len(done), 'failed': sum(job.error is not None for job in done), 'batches': len(batches),
+                'groups': len({batch['group'] for batch in batches}), 'mean_batch': mean_batch,
+                'occupancy': mean_batch / self.max_batch,
+                'queue_wait_mean_s': sum(waits) / len(waits), 'queue_wait_p95_s': _p95(waits),
+                'latency_mean_s': sum(latencies) / len(latencies), 'latency_p95_s': _p95(latencies),
+                'throughput_per_min': len(done) / span * 60 if span > 0 else None}
+
+
+def _p95(values):
+    return values[min(int(0.95 * len(values)), len(values) - 1)]
+
+
+class PNPExecutor:
+    # runs a batch on a PNP of its group, kept resident in the worker (at most max_resident groups per
+    # worker, the least recently used one is dropped)
+    def __init__(self, models_fn=None, max_resident=1):
+        # models_fn: optional callable returning the models dict for PNP (e.g. tiny_models.build_tiny_models)
+        self.models_fn = models_fn
+        self.max_resident = max_resident
+
+    def build(self, pnp_cls, config):
+        # the PNP of a group with the model settings of its config applied as in PNP.run_pnp: int8 UNets
+        # before the injection forwards are patched in, compilation after (the gated forwards of the batched
+        # path, registered here with the thresholds of the first job; every batch sets its own schedules)
+        pnp = pnp_cls(config, models=self.models_fn() if self.models_fn is not None else None)
+        if config.get("quantize"):
+            pnp.quantize_unets()
+        if config.get("compile", False):
+            n_timesteps = config["n_timesteps"]
+            pnp.init_pnp_variants(conv_injection_ts=[int(n_timesteps * config["pnp_f_t"])],
+                                  qk_injection_ts=[int(n_timesteps * config["pnp_attn_t"])])
+            pnp.compile_unets()
+        return pnp
+
+    def __call__(self, state, configs):
+        from diffstyler import PNP
+        from pnp_utils_combine import seed_everything
+        from sweep import sample_variants, variant_label
+        import torchvision.transforms as T
+
+        resident = state.setdefault('pnp', OrderedDict())
+        key = batch_key(configs[0])
+        if key in resident:
+            resident.move_to_end(key)
+        else:
+            while len(resident) >= self.max_resident:
+                resident.popitem(last=False)
+            seed_everything(configs[0]["seed"])
+            resident[key] = self.build(PNP, configs[0])
+        images = sample_variants(resident[key], configs)
+
+        paths = []
+        for config, image in zip(configs, images.float().cpu()):
+            os.makedirs(config["output_path"], exist_ok=True)
+            path = os.path.join(config["output_path"], f'output-{config.get("job_name") or variant_label(config)}.png')
+            T.ToPILImage()(image).save(path)
+            paths.append(path)
+        return paths
+
+
+class SimulatedExecutor:
+    # sleeps for a modelled batch time instead of sampling: setup_s to load a group a worker has not seen
+    # yet, then n_timesteps steps whose cost grows by `marginal` per extra sample in the batch
+    def __init__(self, setup_s=5.0, step_s=0.05, marginal=0.6):
+        self.setup_s = setup_s
+        self.step_s = step_s
+        self.marginal = marginal
+
+    def __call__(self, state, configs):
+        seen = state.setdefault('groups', set())
+        key = batch_key(configs[0])
+        seconds = 0.0 if key in seen else self.setup_s
+        seen.add(key)
+        seconds += configs[0].get("n_timesteps", 50) * self.step_s * (1 + self.marginal * (len(configs) - 1))
+        time.sleep(seconds)
+        return [None] * len(configs)
+
+
+def generate_load(scheduler, base_configs, n_jobs, rate, seed=0, guidance_scales=(7.5, 10.5, 15.0),
+                  attn_ts=(0.3, 0.5), f_ts=(0.5, 0.8)):
+    # synthetic client: Poisson arrivals at `rate` jobs/s (0: all at once) of varied configs; returns the jobs
+    rng = random.Random(seed)
+    jobs = []
+    for i in range(n_jobs):
+        config = dict(rng.choice(base_configs), guidance_scale=rng.choice(guidance_scales),
+                      pnp_attn_t=rng.choice(attn_ts), pnp_f_t=rng.choice(f_ts), job_name=f'job{i}')
+        jobs.append(scheduler.submit(config))
+        if rate:
+            time.sleep(rng.expovariate(rate))
+    return jobs
+
+
+def run(opt):
+    import yaml
+
+    if opt.tiny:
+        from tiny_models import build_tiny_models, build_tiny_workspace
+        workdir = tempfile.mkdtemp(prefix='diffstyler-queue-')
+        base_configs = [build_tiny_workspace(workdir, build_tiny_models(seed=opt.seed), n_loras=1, seed=opt.seed)]
+        executor = PNPExecutor(models_fn=lambda: build_tiny_models(seed=opt.seed), max_resident=opt.max_resident)
+    else:
+        base_configs = []
+        for config_path in opt.configs:
+            with open(config_path, "r") as f:
+                base_configs.append(yaml.safe_load(f))
+        if opt.simulate:
+            executor = SimulatedExecutor(setup_s=opt.setup_s, step_s=opt.step_s)
+        else:
+            executor = PNPExecutor(max_resident=opt.max_resident)
+
+    scheduler = JobScheduler(executor, n_workers=opt.workers, max_batch=opt.max_batch, max_wait=opt.max_wait)
+    jobs = generate_load(scheduler, base_configs, opt.jobs, opt.rate, seed=opt.seed)
+    scheduler.close()
+    failed = [job.id for job in jobs if job.error is not None]
+    metrics = scheduler.metrics()
+    print_table([metrics], list(metrics))
+    write_results(opt.output, scheduler.batch_stats, meta=dict(metrics, max_batch=opt.max_batch, max_wait=opt.max_wait,
+                                                               workers=opt.workers, rate=opt.rate,
+                                                               simulate=opt.simulate, tiny=opt.tiny))
+    if failed:
+        print(f'[WARN] {len(failed)} jobs failed')
+    return metrics
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--configs', type=str, nargs='+', default=['configs/config-girl1.yaml'])
+    parser.add_argument('--jobs', type=int, default=16, help="jobs submitted by the load generator")
+    parser.add_argument('--rate', type=float, default=0.5, help="arrival rate in jobs/s (0: all at once)")
+    parser.add_argument('--max_batch', type=int, default=4)
+    parser.add_argument('--max_wait', type=float, default=5.0, help="seconds a job may wait for its batch to fill")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--max_resident', type=int, default=1, help="groups whose models a worker keeps loaded")
+    parser.add_argument('--simulate', default=False, action='store_true', help="model the batch time, no models")
+    parser.add_argument('--setup_s', type=float, default=5.0, help="simulated model loading time")
+    parser.add_argument('--step_s', type=float, default=0.05, help="simulated time of one sampling step")
+    parser.add_argument('--tiny', default=False, action='store_true', help="tiny random models (offline)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default='benchmarks/job_queue.json')
+    opt = parser.parse_args()
+    run(opt)
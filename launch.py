@@ -0,0 +1,112 @@
+import argparse
+import multiprocessing as mp
+import os
+import time
+import yaml
+
+from runtime import apply_runtime, format_cpus, split_cpus
+
+# split the host into N worker processes, each pinned to its own cpus, and run the stylization of a set of
+# configs on them (round-robin, each worker goes through its share one after the other)
+#
+#   python launch.py --configs configs/config-*.yaml --workers 4 --numa
+#
+# The workers' thread settings override the `runtime` section of the configs. bench_threads.py measures
+# which split gives the best throughput on a host. With --shared_weights the frozen SD weights are exported
+# once before the workers start and every worker maps the same copy (see shared_weights.py).
+
+
+def plan_workers(n_workers, numa=False, threads=None, interop_threads=1):
+    # one `runtime` section per worker; threads defaults to the worker's cpu count
+    return [{'cpus': cpus, 'threads': threads or len(cpus), 'interop_threads': interop_threads}
+            for cpus in split_cpus(n_workers, numa=numa)]
+
+
+def _worker_main(worker_id, runtime, target, args, results):
+    runtime = apply_runtime(runtime)
+    print(f'[INFO] worker {worker_id} (pid {os.getpid()}): cpus {format_cpus(runtime["cpus"])}, '
+          f'{runtime["threads"]} threads, {runtime["interop_threads"]} interop threads')
+    results[worker_id] = {'runtime': runtime, 'result': target(*args)}
+
+
+def run_workers(target, worker_args, runtimes):
+    # target(*worker_args[i]) in a spawned process with runtimes[i] applied; returns the per-worker results
+    ctx = mp.get_context('spawn')
+    with ctx.Manager() as manager:
+        results = manager.dict()
+        workers = [ctx.Process(target=_worker_main, args=(i, runtime, target, args, results))
+                   for i, (runtime, args) in enumerate(zip(runtimes, worker_args))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        failed = [i for i, worker in enumerate(workers) if worker.exitcode != 0]
+        if failed:
+            raise RuntimeError(f'workers {failed} failed')
+        return [results[i] for i in range(len(workers))]
+
+
+def stylize_configs(config_paths, shared_weights=None):
+    from diffstyler import PNP
+    from pnp_utils_combine import seed_everything
+
+    timings = []
+    for config_path in config_paths:
+        with open(config_path, "r") as f:
+            config = yaml.safe_load(f)
+        if shared_weights:
+            config["shared_weights"] = shared_weights
+        os.makedirs(config["output_path"], exist_ok=True)
+        with open(os.path.join(config["output_path"], "config.yaml"), "w") as f:
+            yaml.dump(config, f)
+        start = time.perf_counter()
+        seed_everything(config["seed"])
+        pnp = PNP(config)
+        pnp.run_pnp()
+        timings.append({'config': config_path, 'seconds': time.perf_counter() - start})
+    return timings
+
+
+def export_shared_weights(config_paths, shared_weights):
+    # one export per sd_version / precision of the cpu configs, written before the workers start
+    from diffstyler import PNP
+    from precision import get_device, resolve_precision
+    from shared_weights import ensure_export
+
+    for config_path in config_paths:
+        with open(config_path, "r") as f:
+            config = yaml.safe_load(f)
+        device = get_device(config["device"])
+        if device.type == 'cpu':
+            ensure_export(shared_weights, config["sd_version"], resolve_precision(config.get("precision"), device),
+                          PNP.load_models)
+
+
+def run(opt):
+    n_workers = min(opt.workers, len(opt.configs))
+    runtimes = plan_workers(n_workers, numa=opt.numa, threads=opt.threads, interop_threads=opt.interop_threads)
+    start = time.perf_counter()
+    shared_weights = (opt.shared_dir or True) if opt.shared_weights else None
+    if shared_weights:
+        export_shared_weights(opt.configs, shared_weights)
+    results = run_workers(stylize_configs, [(opt.configs[i::n_workers], shared_weights) for i in range(n_workers)],
+                          runtimes)
+    elapsed = time.perf_counter() - start
+    for worker_id, result in enumerate(results):
+        for timing in result['result']:
+            print(f'[INFO] worker {worker_id}: {timing["config"]} in {timing["seconds"]:.1f}s')
+    print(f'[INFO] {len(opt.configs)} configs on {n_workers} workers in {elapsed:.1f}s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--configs', type=str, nargs='+', required=True)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--numa', default=False, action='store_true', help="spread the workers over the NUMA nodes")
+    parser.add_argument('--threads', type=int, default=None, help="intra-op threads per worker (default: its cpu count)")
+    parser.add_argument('--interop_threads', type=int, default=1, help="inter-op threads per worker")
+    parser.add_argument('--shared_weights', default=False, action='store_true',
+                        help="map one read-only copy of the frozen SD weights into every worker")
+    parser.add_argument('--shared_dir', type=str, default=None, help="export directory (default: /dev/shm/diffstyler)")
+    opt = parser.parse_args()
+    run(opt)
@@ -0,0 +1,175 @@
+from collections import defaultdict
+
+import torch
+import torch.nn as nn
+
+from pnp_utils_combine import qk_injection
+
+# attention-level regional LoRA routing
+#
+# Instead of one full UNet per LoRA whose noise prediction is blended by the region mask, every attention
+# layer of the base UNet gets a RegionalLoRAAttnProcessor holding the LoRA layers of all regions:
+#
+#   self-attention:  q/k/v/out = base projection + sum_i mask_i * lora_i(x)   (one attention)
+#   cross-attention: same low-rank updates, and region i attends to its own prompt; the outputs are
+#                    blended by the token masks like the noise predictions in blend mode
+#
+# The masks can be scaled per sample (RegionalContext.set_scales), which gives one LoRA strength per
+# sample of a batch, or an interpolation between two adapters given the same mask.
+#
+# The masks come from the mask pyramids (masks.py), at the resolution of each attention layer. The source
+# rows of the [source, uncond, cond] batch stay untouched, so the PnP features injected from them are
+# the same as in blend mode. One UNet pass per step instead of N + 1.
+
+
+def load_lora_processors(state_dict):
+    # LoRAAttnProcessor per attention processor name, from a checkpoint saved by lora_train.py
+    from diffusers.models.attention_processor import LoRAAttnProcessor
+
+    grouped = defaultdict(dict)
+    for key, value in state_dict.items():
+        if key.startswith('unet.'):
+            key = key[len('unet.'):]
+        name, sub_key = ".".join(key.split(".")[:-3]), ".".join(key.split(".")[-3:])
+        grouped[name][sub_key] = value
+    processors = {}
+    for name, weights in grouped.items():
+        processor = LoRAAttnProcessor(hidden_size=weights["to_k_lora.up.weight"].shape[0],
+                                      cross_attention_dim=weights["to_k_lora.down.weight"].shape[1],
+                                      rank=weights["to_k_lora.down.weight"].shape[0])
+        processor.load_state_dict(weights)
+        processors[name] = processor
+    return processors
+
+
+class RegionalContext:
+    # per-run state shared by all regional processors: the region masks and prompts
+    def __init__(self, mask_pyramids, text_embeds):
+        # mask_pyramids: one MaskPyramid per region; text_embeds: one [3, seq, dim] tensor per region
+        # ([pnp guidance, uncond, cond] rows, expanded to the sampling batch on use)
+        self.mask_pyramids = mask_pyramids
+        self.text_embeds = text_embeds
+        self.scales = None
+        self._masks = {}
+        self._embeds = {}
+
+    def set_scales(self, scales):
+        # per-sample LoRA strengths: [V, regions] for a batch of V samples ([source x V, uncond x V, cond x V]
+        # rows), sample v scales the update of region i by scales[v, i]; None applies every LoRA fully
+        self.scales = None if scales is None else torch.as_tensor(scales, dtype=torch.float32).cpu()
+        self._masks = {}
+
+    def row_masks(self, rows):
+        # [rows, 1, 1] strength of every region per batch row, zero on the source rows
+        if self.scales is None:
+            row_mask = torch.ones(rows, 1)
+            row_mask[:rows // 3] = 0
+            return [row_mask.view(rows, 1, 1)] * len(self.mask_pyramids)
+        if rows != 3 * self.scales.shape[0]:
+            raise ValueError(f'LoRA strengths are set for {self.scales.shape[0]} samples, the batch has {rows // 3}.')
+        scales = torch.cat([torch.zeros_like(self.scales), self.scales, self.scales])
+        return [scales[:, i].view(rows, 1, 1) for i in range(len(self.mask_pyramids))]
+
+    def token_masks(self, rows, n_tokens, dtype):
+        # one [rows, n_tokens, 1] mask per region, scaled by the per-row strengths
+        key = (rows, n_tokens, dtype)
+        if key not in self._masks:
+            self._masks[key] = [(row_mask.to(pyramid.latent.device) * pyramid.tokens(n_tokens)).to(dtype)
+                                for row_mask, pyramid in zip(self.row_masks(rows), self.mask_pyramids)]
+        return self._masks[key]
+
+    def region_embeds(self, rows):
+        if rows not in self._embeds:
+            self._embeds[rows] = [embeds.repeat_interleave(rows // embeds.shape[0], dim=0) for embeds in self.text_embeds]
+        return self._embeds[rows]
+
+
+class RegionalLoRAAttnProcessor(nn.Module):
+    def __init__(self, loras, context):
+        # loras: the LoRAAttnProcessor of this layer for every region
+        super().__init__()
+        self.loras = nn.ModuleList(loras)
+        self.context = context
+
+    def _project(self, base, name, hidden_states, masks):
+        out = base(hidden_states)
+        for lora, mask in zip(self.loras, masks):
+            out = out + mask * getattr(lora, name)(hidden_states)
+        return out
+
+    def _attend(self, attn, query, key, value, attention_mask):
+        key = attn.head_to_batch_dim(key)
+        value = attn.head_to_batch_dim(value)
+        attention_probs = attn.get_attention_scores(query, key, attention_mask)
+        return attn.batch_to_head_dim(torch.bmm(attention_probs, value))
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, temb=None):
+        residual = hidden_states
+        input_ndim = hidden_states.ndim
+        if input_ndim == 4:
+            batch_size, channel, height, width = hidden_states.shape
+            hidden_states = hidden_states.view(batch_size, channel, height * width).transpose(1, 2)
+
+        rows, n_tokens, _ = hidden_states.shape
+        sequence_length = n_tokens if encoder_hidden_states is None else encoder_hidden_states.shape[1]
+        attention_mask = attn.prepare_attention_mask(attention_mask, sequence_length, rows)
+        if attn.group_norm is not None:
+            hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
+
+        # with token merging (token_merge.py) the masks are merged like the tokens they weight
+        token_merge = getattr(attn, 'token_merge', None)
+        if token_merge is None:
+            masks = self.context.token_masks(rows, n_tokens, hidden_states.dtype)
+        else:
+            masks = [token_merge.merge(mask.expand(rows, -1, -1))
+                     for mask in self.context.token_masks(rows, token_merge.n_tokens, hidden_states.dtype)]
+        query = self._project(attn.to_q, 'to_q_lora', hidden_states, masks)
+
+        if encoder_hidden_states is None:
+            key = self._project(attn.to_k, 'to_k_lora', hidden_states, masks)
+            value = self._project(attn.to_v, 'to_v_lora', hidden_states, masks)
+            # PnP injection of the source queries/keys, where init_pnp scheduled it for this layer
+            query, key = qk_injection(attn, query, key)
+            hidden_states = self._attend(attn, attn.head_to_batch_dim(query), key, value, attention_mask)
+        else:
+            if attn.norm_cross:
+                encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
+            key = attn.to_k(encoder_hidden_states)
+            query, key = qk_injection(attn, query, key)
+            query = attn.head_to_batch_dim(query)
+            base_states = self._attend(attn, query, key, attn.to_v(encoder_hidden_states), attention_mask)
+            hidden_states = base_states
+            # every region attends to its own prompt with its own key/value update; the regions add their
+            # difference to the base output, so strengths of regions sharing a mask interpolate linearly
+            region_embeds = self.context.region_embeds(rows)
+            for lora, mask, embeds in zip(self.loras, masks, region_embeds):
+                embeds = embeds.to(encoder_hidden_states.dtype)
+                if attn.norm_cross:
+                    embeds = attn.norm_encoder_hidden_states(embeds)
+                _, key = qk_injection(attn, None, attn.to_k(embeds) + lora.to_k_lora(embeds))
+                value = attn.to_v(embeds) + lora.to_v_lora(embeds)
+                region_states = self._attend(attn, query, key, value, attention_mask)
+                hidden_states = hidden_states + mask * (region_states - base_states)
+
+        hidden_states = self._project(attn.to_out[0], 'to_out_lora', hidden_states, masks)
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if input_ndim == 4:
+            hidden_states = hidden_states.transpose(-1, -2).reshape(batch_size, channel, height, width)
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+        return hidden_states / attn.rescale_output_factor
+
+
+def register_regional_lora(model_unet, lora_state_dicts, mask_pyramids, text_embeds):
+    # route every LoRA through the attention processors of model_unet, restricted to its mask
+    context = RegionalContext(mask_pyramids, text_embeds)
+    region_processors = [load_lora_processors(state_dict) for state_dict in lora_state_dicts]
+    processors = {}
+    for name in model_unet.attn_processors:
+        missing = [i for i, region in enumerate(region_processors) if name not in region]
+        if missing:
+            raise ValueError(f'LoRA checkpoints {missing} have no weights for {name}.')
+        processors[name] = RegionalLoRAAttnProcessor([region[name] for region in region_processors], context)
+    model_unet.set_attn_processor(processors)
+    return context
@@ -0,0 +1,85 @@
+import copy
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+# one place that knows which LoRA adapters a config uses and loads each of them once
+#
+# Both config styles are understood: the `lora_configs` list, and the older `lora_name` / `mask` /
+# `prompt_gene` strings (';'-separated, resolved to lora_models/<name>.safetensors and mask/<name>.png).
+# Weight paths are resolved to the .safetensors file of the same name when there is one, and fall back
+# to a pickled .ckpt (see convert_lora.py to convert those).
+# Checkpoint files are read concurrently on a thread pool as soon as the registry is created, so they
+# load while the SD models are still loading. Identical weight paths are read once, and a UNet copy is
+# only made for an adapter when the sampling path asks for one (blend mode), once per weight file.
+
+
+LORA_EXTENSIONS = ['.safetensors', '.ckpt']
+
+
+def resolve_weight_path(path):
+    # prefer the safetensors copy of a checkpoint, whichever of the two the config names
+    stem, ext = os.path.splitext(path)
+    if ext in LORA_EXTENSIONS:
+        for candidate in [stem + extension for extension in LORA_EXTENSIONS]:
+            if os.path.exists(candidate):
+                return candidate
+    return path
+
+
+def parse_lora_configs(config):
+    if config.get("lora_configs"):
+        return [dict(entry, weight_path=resolve_weight_path(entry['weight_path'])) for entry in config["lora_configs"]]
+    if not config.get("lora_name"):
+        return []
+    names = [name.strip() for name in config["lora_name"].split(';')]
+    masks = [name.strip() for name in config["mask"].split(';')]
+    prompts = [prompt.strip() for prompt in config["prompt_gene"].split(';')]
+    if not len(names) == len(masks) == len(prompts):
+        raise ValueError(f'lora_name, mask and prompt_gene list {len(names)}, {len(masks)} and {len(prompts)} entries.')
+    return [{'weight_path': resolve_weight_path(os.path.join('lora_models', f'{name}.safetensors')),
+             'mask_path': os.path.join('mask', f'{mask}.png'), 'prompt': prompt}
+            for name, mask, prompt in zip(names, masks, prompts)]
+
+
+def load_lora_state_dict(path, device='cpu'):
+    # safetensors files are memory-mapped and loaded straight to `device`; pickled checkpoints are only
+    # unpickled as plain tensors (weights_only), never as arbitrary objects
+    if path.endswith('.safetensors'):
+        from safetensors.torch import load_file
+        return load_file(path, device=str(device))
+    return torch.load(path, map_location=device, weights_only=True)
+
+
+class LoRARegistry:
+    def __init__(self, lora_configs, device='cpu', max_workers=4):
+        self.lora_configs = lora_configs
+        self.device = device
+        self.paths = list(dict.fromkeys(entry['weight_path'] for entry in lora_configs))
+        self._unets = {}
+        self._pool = ThreadPoolExecutor(max_workers=max(min(max_workers, len(self.paths)), 1),
+                                        thread_name_prefix='lora-load')
+        self._futures = {path: self._pool.submit(load_lora_state_dict, path, device) for path in self.paths}
+        self._pool.shutdown(wait=False)
+
+    def state_dict(self, path):
+        # blocks until the file is loaded; a failed load is raised here
+        return self._futures[path].result()
+
+    def unet(self, path, base_unet, setup=None, share_weights=False):
+        # a copy of base_unet with the adapter of `path` loaded, shared by every entry using that file;
+        # with share_weights the copy reuses the frozen base parameters and buffers, only the LoRA
+        # processors are new (the base weights must then never be modified in place)
+        if path not in self._unets:
+            memo = {id(tensor): tensor for tensor in list(base_unet.parameters()) + list(base_unet.buffers())} \
+                if share_weights else {}
+            unet_lora = copy.deepcopy(base_unet, memo)
+            unet_lora.load_attn_procs(self.state_dict(path))
+            if setup is not None:
+                setup(unet_lora)
+            self._unets[path] = unet_lora
+        return self._unets[path]
+
+    def stats(self):
+        return {'entries': len(self.lora_configs), 'files': len(self.paths), 'unet_copies': len(self._unets)}
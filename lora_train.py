@@ -1,52 +1,25 @@
-from timeit import default_timer as timer
-from datetime import timedelta
 from PIL import Image
 import os
 import numpy as np
-from einops import rearrange
 import torch
 import torch.nn.functional as F
 from torchvision import transforms
-import transformers
-from accelerate import Accelerator
-from accelerate.utils import set_seed
-from packaging import version
-from PIL import Image
 import tqdm
 import argparse
-from transformers import AutoTokenizer, PretrainedConfig
-from torchvision import models
 import torchvision.transforms as T
 
-import diffusers
-from diffusers import (
-    AutoencoderKL,
-    DDPMScheduler,
-    DiffusionPipeline,
-    DPMSolverMultistepScheduler,
-    StableDiffusionPipeline,
-    UNet2DConditionModel,
-)
-from diffusers.loaders import AttnProcsLayers, LoraLoaderMixin
-from diffusers.models.attention_processor import (
-    AttnAddedKVProcessor,
-    AttnAddedKVProcessor2_0,
-    LoRAAttnAddedKVProcessor,
-    LoRAAttnProcessor,
-    LoRAAttnProcessor2_0,
-    SlicedAttnAddedKVProcessor,
-)
-from diffusers.optimization import get_scheduler
-from diffusers.utils import check_min_version
-from diffusers.utils.import_utils import is_xformers_available
-
-import matplotlib.pyplot as plt
 import time
+import json
+from precision import get_device, resolve_precision, apply_precision, autocast
+from runtime import apply_runtime, peak_memory_mb
+from model_resolver import resolve_model
 
-# Will error if the minimal version of diffusers is not installed. Remove at your own risks.
-check_min_version("0.17.0")
+# accelerate, transformers, diffusers, matplotlib and the VGG weights are imported in the functions that use
+# them, so `--help` and importing create_lora_attn_procs / load_lora stay fast
 
 def get_feature_extractor(device):
+    from torchvision import models
+
     # Load a pre-trained VGG19 model
     vgg = models.vgg19(pretrained=True).features.to(device).eval()
 
@@ -82,6 +55,8 @@ def compute_style_loss(gen_features, style_grams, style_weights):
 
 
 def import_model_class_from_model_name_or_path(pretrained_model_name_or_path: str, revision: str):
+    from transformers import PretrainedConfig
+
     text_encoder_config = PretrainedConfig.from_pretrained(
         pretrained_model_name_or_path,
         subfolder="text_encoder",
@@ -136,6 +111,43 @@ def encode_prompt(text_encoder, input_ids, attention_mask, text_encoder_use_atte
 
     return prompt_embeds
 
+def create_lora_attn_procs(unet, lora_rank):
+    # one LoRA attention processor per attention layer of the UNet
+    from diffusers.models.attention_processor import (
+        AttnAddedKVProcessor,
+        AttnAddedKVProcessor2_0,
+        LoRAAttnAddedKVProcessor,
+        LoRAAttnProcessor,
+        LoRAAttnProcessor2_0,
+        SlicedAttnAddedKVProcessor,
+    )
+
+    unet_lora_attn_procs = {}
+    for name, attn_processor in unet.attn_processors.items():
+        cross_attention_dim = None if name.endswith("attn1.processor") else unet.config.cross_attention_dim
+        if name.startswith("mid_block"):
+            hidden_size = unet.config.block_out_channels[-1]
+        elif name.startswith("up_blocks"):
+            block_id = int(name[len("up_blocks.")])
+            hidden_size = list(reversed(unet.config.block_out_channels))[block_id]
+        elif name.startswith("down_blocks"):
+            block_id = int(name[len("down_blocks.")])
+            hidden_size = unet.config.block_out_channels[block_id]
+        else:
+            raise NotImplementedError("name must start with up_blocks, mid_blocks, or down_blocks")
+
+        if isinstance(attn_processor, (AttnAddedKVProcessor, SlicedAttnAddedKVProcessor, AttnAddedKVProcessor2_0)):
+            lora_attn_processor_class = LoRAAttnAddedKVProcessor
+        else:
+            lora_attn_processor_class = (
+                LoRAAttnProcessor2_0 if hasattr(F, "scaled_dot_product_attention") else LoRAAttnProcessor
+            )
+        unet_lora_attn_procs[name] = lora_attn_processor_class(
+            hidden_size=hidden_size, 
+            cross_attention_dim=cross_attention_dim, rank=lora_rank
+        )
+    return unet_lora_attn_procs
+
 # model_path: path of the model
 # image: input image, have not been pre-processed
 # save_lora_dir: the path to save the lora
@@ -144,7 +156,20 @@ def encode_prompt(text_encoder, input_ids, attention_mask, text_encoder_use_atte
 # lora_lr: learning rate of lora training
 # lora_rank: the rank of lora
 # def train_lora(image, prompt, save_lora_dir, model_path=None, tokenizer=None, text_encoder=None, vae=None, unet=None, noise_scheduler=None, lora_steps=200, lora_lr=2e-4, lora_rank=16, weight_name=None, safe_serialization=False, progress=tqdm):
-def train_lora(image, prompt, save_lora_dir, model_path=None, tokenizer=None, text_encoder=None, vae=None, unet=None, noise_scheduler=None, lora_steps=200, lora_lr=2e-4, lora_rank=16, weight_name=None, safe_serialization=False, progress=tqdm, style_image=None, style_weights=None, style_weight=1e5): #, color_weight=1e5):
+def train_lora(image, prompt, save_lora_dir, model_path=None, tokenizer=None, text_encoder=None, vae=None, unet=None, noise_scheduler=None, lora_steps=200, lora_lr=2e-4, lora_rank=16, weight_name=None, safe_serialization=True, progress=tqdm, style_image=None, style_weights=None, style_weight=1e5, device=None, mixed_precision='no', gradient_checkpointing=False, feature_extractor=None): #, color_weight=1e5):
+    from accelerate import Accelerator
+    from accelerate.utils import set_seed
+    from transformers import AutoTokenizer
+    from diffusers import AutoencoderKL, DDPMScheduler, UNet2DConditionModel
+    from diffusers.loaders import AttnProcsLayers, LoraLoaderMixin
+    from diffusers.optimization import get_scheduler
+    from diffusers.utils import check_min_version
+
+    # Will error if the minimal version of diffusers is not installed. Remove at your own risks.
+    check_min_version("0.17.0")
+    # the local snapshot when the weights are cached (no Hub lookup), see model_resolver.py
+    if model_path is not None:
+        model_path = resolve_model(model_path, subfolders=['tokenizer', 'text_encoder', 'vae', 'unet', 'scheduler'])
 
     # initialize accelerator
     accelerator = Accelerator(
@@ -179,7 +204,12 @@ def train_lora(image, prompt, save_lora_dir, model_path=None, tokenizer=None, te
         )
 
     # set device and dtype
-    device = torch.device("mps")#("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    device = get_device(device)
+    # the UNet keeps fp32 weights for its trainable LoRA layers and runs under autocast,
+    # the frozen VAE and text encoder are cast to the policy dtype directly
+    policy = resolve_precision('fp32' if mixed_precision == 'no' else mixed_precision, device)
+    autocast_ctx = autocast(policy, device, 'unet')
+    print(f'[INFO] training on {device} with mixed precision: {mixed_precision}')
 
     vae.requires_grad_(False)
     text_encoder.requires_grad_(False)
@@ -188,35 +218,18 @@ def train_lora(image, prompt, save_lora_dir, model_path=None, tokenizer=None, te
     unet.to(device)
     vae.to(device)
     text_encoder.to(device)
+    apply_precision(policy, vae=vae, text_encoder=text_encoder)
+    if policy['channels_last']:
+        unet.to(memory_format=torch.channels_last)
 
     # initialize UNet LoRA
-    unet_lora_attn_procs = {}
-    for name, attn_processor in unet.attn_processors.items():
-        cross_attention_dim = None if name.endswith("attn1.processor") else unet.config.cross_attention_dim
-        if name.startswith("mid_block"):
-            hidden_size = unet.config.block_out_channels[-1]
-        elif name.startswith("up_blocks"):
-            block_id = int(name[len("up_blocks.")])
-            hidden_size = list(reversed(unet.config.block_out_channels))[block_id]
-        elif name.startswith("down_blocks"):
-            block_id = int(name[len("down_blocks.")])
-            hidden_size = unet.config.block_out_channels[block_id]
-        else:
-            raise NotImplementedError("name must start with up_blocks, mid_blocks, or down_blocks")
-
-        if isinstance(attn_processor, (AttnAddedKVProcessor, SlicedAttnAddedKVProcessor, AttnAddedKVProcessor2_0)):
-            lora_attn_processor_class = LoRAAttnAddedKVProcessor
-        else:
-            lora_attn_processor_class = (
-                LoRAAttnProcessor2_0 if hasattr(F, "scaled_dot_product_attention") else LoRAAttnProcessor
-            )
-        unet_lora_attn_procs[name] = lora_attn_processor_class(
-            hidden_size=hidden_size, 
-            cross_attention_dim=cross_attention_dim, rank=lora_rank
-        )
-    unet.set_attn_processor(unet_lora_attn_procs)
+    unet.set_attn_processor(create_lora_attn_procs(unet, lora_rank))
     unet_lora_layers = AttnProcsLayers(unet.attn_processors)
 
+    # recompute UNet block activations in the backward pass instead of storing them
+    if gradient_checkpointing:
+        unet.enable_gradient_checkpointing()
+
     # Optimizer creation
     params_to_optimize = (unet_lora_layers.parameters())
     optimizer = torch.optim.AdamW(
@@ -249,7 +262,7 @@ def train_lora(image, prompt, save_lora_dir, model_path=None, tokenizer=None, te
             text_inputs.input_ids,
             text_inputs.attention_mask,
             text_encoder_use_attention_mask=False
-        )
+        ).float()
 
     if type(image) == np.ndarray:
         image = Image.fromarray(image)
@@ -268,7 +281,7 @@ def train_lora(image, prompt, save_lora_dir, model_path=None, tokenizer=None, te
     image = image.unsqueeze(dim=0)
 
     # Load the feature extractor
-    vgg = get_feature_extractor(device)
+    vgg = feature_extractor.to(device) if feature_extractor is not None else get_feature_extractor(device)
 
     # Define the layers to use for style representation
     if style_weights is None:
@@ -297,8 +310,10 @@ def train_lora(image, prompt, save_lora_dir, model_path=None, tokenizer=None, te
     # Compute Gram matrices for style features
     style_grams = {layer: gram_matrix(style_features[layer]) for layer in style_features}
 
-    
-    latents_dist = vae.encode(image).latent_dist
+
+    # the latent distribution of the content image is fixed, so encode it once up front
+    with torch.no_grad(), autocast_ctx:
+        latents_dist = vae.encode(image.to(vae.dtype)).latent_dist
 
     loss_values = []
     time_values = []
@@ -309,7 +324,7 @@ def train_lora(image, prompt, save_lora_dir, model_path=None, tokenizer=None, te
         start_time = time.time()
 
         unet.train()
-        model_input = latents_dist.sample() * vae.config.scaling_factor
+        model_input = latents_dist.sample().float() * vae.config.scaling_factor
         # ... existing code to add noise and compute model_pred ...
 
         noise = torch.randn_like(model_input)
@@ -324,8 +339,14 @@ def train_lora(image, prompt, save_lora_dir, model_path=None, tokenizer=None, te
         # (this is the forward diffusion process)
         noisy_model_input = noise_scheduler.add_noise(model_input, noise, timesteps)
 
+        # checkpointed blocks only propagate gradients when their inputs require grad,
+        # and every UNet weight outside the LoRA layers is frozen
+        if gradient_checkpointing:
+            noisy_model_input.requires_grad_(True)
+
         # Predict the noise residual
-        model_pred = unet(noisy_model_input, timesteps, text_embedding).sample
+        with autocast_ctx:
+            model_pred = unet(noisy_model_input, timesteps, text_embedding).sample
 
         if noise_scheduler.config.prediction_type == "epsilon":
             target = noise
@@ -338,9 +359,9 @@ def train_lora(image, prompt, save_lora_dir, model_path=None, tokenizer=None, te
         loss = F.mse_loss(model_pred.float(), target.float(), reduction="mean")
 
         # Generate the image from the current latents
-        with torch.no_grad():
+        with torch.no_grad(), autocast_ctx:
             latents = model_input / vae.config.scaling_factor
-            recon_images = vae.decode(latents).sample
+            recon_images = vae.decode(latents.to(vae.dtype)).sample.float()
 
         # Preprocess generated images for VGG
         gen_image = F.interpolate(recon_images, size=(512, 512), mode='bilinear', align_corners=False)
@@ -348,10 +369,11 @@ def train_lora(image, prompt, save_lora_dir, model_path=None, tokenizer=None, te
         # Extract features from generated images
         gen_features = {}
         x = gen_image
-        for name, layer in vgg._modules.items():
-            x = layer(x)
-            if name in style_weights:
-                gen_features[name] = x
+        with torch.no_grad(), autocast_ctx:
+            for name, layer in vgg._modules.items():
+                x = layer(x)
+                if name in style_weights:
+                    gen_features[name] = x.float()
 
         # Compute style loss
         style_loss = compute_style_loss(gen_features, style_grams, style_weights)
@@ -422,6 +444,8 @@ def train_lora(image, prompt, save_lora_dir, model_path=None, tokenizer=None, te
         safe_serialization=safe_serialization
     )  
 
+    import matplotlib.pyplot as plt
+
     plt.figure(figsize=(10, 5))
     plt.plot(loss_values, label='Training Loss')
     plt.xlabel('Iterations')
@@ -451,6 +475,24 @@ def train_lora(image, prompt, save_lora_dir, model_path=None, tokenizer=None, te
     plt.legend()
     plt.savefig(os.path.join(save_lora_dir, 'cumulative_time.png'))
     plt.close()
+
+    # memory/time summary so runs with different precision settings can be compared
+    stats = {
+        'device': str(device),
+        'mixed_precision': mixed_precision,
+        'gradient_checkpointing': gradient_checkpointing,
+        'lora_steps': lora_steps,
+        'lora_rank': lora_rank,
+        'total_time_s': cumulative_time,
+        'mean_iter_time_s': cumulative_time / max(len(time_values), 1),
+        'peak_memory_mb': peak_memory_mb(device),
+        'final_loss': loss_values[-1] if loss_values else None,
+    }
+    # one file per LoRA, several LoRAs are trained into the same directory
+    stats_name = f'{os.path.splitext(weight_name)[0]}_training_stats.json' if weight_name else 'training_stats.json'
+    with open(os.path.join(save_lora_dir, stats_name), 'w') as f:
+        json.dump(stats, f, indent=2)
+    print(f'[INFO] training stats: {stats}')
     
 def load_lora(unet, lora_0, lora_1, alpha):
     lora = {}
@@ -461,6 +503,7 @@ def load_lora(unet, lora_0, lora_1, alpha):
 
 
 def main(args):
+    apply_runtime({'cpus': args.cpus, 'threads': args.threads, 'interop_threads': args.interop_threads})
     image = Image.open(args.image_path).convert("RGB")
     style_image = Image.open(args.style_image_path).convert('RGB')
     lora_steps = 200
@@ -469,11 +512,13 @@ def main(args):
     style_weight = 1e4
 
     if not os.path.exists(args.save_lora_dir): os.mkdir(args.save_lora_dir)
-    weight_name = 'lora_' + os.path.splitext(os.path.basename(args.image_path))[0] + '.ckpt'
+    weight_name = 'lora_' + os.path.splitext(os.path.basename(args.image_path))[0] + '.safetensors'
 
     train_lora(image, args.prompt, args.save_lora_dir, args.model_key, None, None,
                None, None, None, lora_steps, lora_lr, lora_rank, weight_name=weight_name,
-               style_image=style_image, style_weights=None, style_weight=style_weight)
+               style_image=style_image, style_weights=None, style_weight=style_weight,
+               device=args.device, mixed_precision=args.mixed_precision,
+               gradient_checkpointing=args.gradient_checkpointing)
     return
 
 
@@ -484,5 +529,13 @@ if __name__ == '__main__':
     parser.add_argument('--prompt', type=str, default='cartoon image, woman')
     parser.add_argument('--model_key', type=str, default='stabilityai/stable-diffusion-2-1-base')
     parser.add_argument('--save_lora_dir', type=str, default='lora_models')
+    parser.add_argument('--device', type=str, default=None, help='mps, cuda or cpu; picked automatically if not set')
+    parser.add_argument('--mixed_precision', type=str, default='no', choices=['no', 'bf16', 'fp16'],
+                        help='autocast dtype for the UNet/VAE/VGG forward passes (use bf16 on CPU)')
+    parser.add_argument('--gradient_checkpointing', default=False, action='store_true',
+                        help='trade compute for memory by recomputing UNet activations in backward')
+    parser.add_argument('--threads', type=int, default=None, help='intra-op threads (default: torch default)')
+    parser.add_argument('--interop_threads', type=int, default=None, help='inter-op threads')
+    parser.add_argument('--cpus', type=str, default=None, help="cpus to pin the process to, e.g. '0-7'")
     args = parser.parse_args()
     main(args)
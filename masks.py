@@ -0,0 +1,100 @@
+import os
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torchvision.transforms.functional as TF
+from PIL import Image
+
+# region masks for the LoRA branches
+#
+# A mask image is decoded once and turned into a pyramid with one soft mask per UNet resolution
+# (latent size, /2, /4, /8 -> 64/32/16/8 for SD at 512px). The latent level blends noise predictions,
+# the coarser levels line up with the spatial tokens of the attention layers for regional control.
+# Pyramids are cached per (file, modification time, settings), so repeated runs in one process and
+# several configs sharing a mask decode it only once.
+
+_CACHE = {}
+
+
+class MaskPyramid:
+    def __init__(self, levels, path=None):
+        # levels: [1, 1, h, w] float tensors in [0, 1], finest first
+        self.levels = levels
+        self.path = path
+
+    @property
+    def latent(self):
+        return self.levels[0]
+
+    def at(self, height, width):
+        for level in self.levels:
+            if level.shape[-2:] == (height, width):
+                return level
+        raise KeyError(f'No mask level of size {height}x{width} in {self.sizes()}')
+
+    def tokens(self, n_tokens):
+        # [1, n_tokens, 1] mask for an attention layer with n_tokens spatial tokens (row-major h*w)
+        for level in self.levels:
+            if level.shape[-2] * level.shape[-1] == n_tokens:
+                return level.flatten(2).transpose(1, 2)
+        raise KeyError(f'No mask level with {n_tokens} tokens in {self.sizes()}')
+
+    def binary(self, threshold=0.5):
+        return self.latent[0, 0] > threshold
+
+    def sizes(self):
+        return [tuple(level.shape[-2:]) for level in self.levels]
+
+    def to(self, *args, **kwargs):
+        return MaskPyramid([level.to(*args, **kwargs) for level in self.levels], self.path)
+
+
+def build_pyramid(mask, latent_size, n_levels=4, feather=0.0):
+    # mask: PIL image; latent_size: (height, width) of the latent grid; feather: gaussian sigma in latent pixels
+    height, width = latent_size
+    # bilinear PIL resize for the latent level, as the noise blending always did
+    latent = mask.convert('L').resize((width, height), Image.BILINEAR)
+    latent = torch.tensor(np.array(latent) / 255.0, dtype=torch.float32)[None, None]
+    if feather > 0:
+        kernel_size = 2 * int(3 * feather) + 1
+        latent = TF.gaussian_blur(latent, kernel_size=[kernel_size, kernel_size], sigma=[feather, feather])
+    levels = [latent]
+    for _ in range(n_levels - 1):
+        # area averaging keeps the covered fraction of each coarse cell
+        levels.append(F.interpolate(levels[-1], scale_factor=0.5, mode='area'))
+    return MaskPyramid(levels)
+
+
+def load_mask_pyramid(path, latent_size, n_levels=4, feather=0.0):
+    key = (os.path.abspath(path), os.path.getmtime(path), tuple(latent_size), n_levels, float(feather))
+    if key not in _CACHE:
+        with Image.open(path) as mask:
+            pyramid = build_pyramid(mask, latent_size, n_levels=n_levels, feather=feather)
+        pyramid.path = path
+        _CACHE[key] = pyramid
+    return _CACHE[key]
+
+
+def clear_mask_cache():
+    _CACHE.clear()
+
+
+def validate_masks(pyramids, min_coverage=1e-3):
+    # every mask has to cover part of the latent grid at every level, otherwise its LoRA branch is computed
+    # for nothing (or drops out of the attention-level routing); returns the coverage of each mask and of
+    # their union at the latent level
+    coverages = []
+    for pyramid in pyramids:
+        for level in pyramid.levels:
+            coverage = level.mean().item()
+            if coverage < min_coverage:
+                raise ValueError(f'Mask {pyramid.path} covers {coverage:.2%} of the {level.shape[-2]}x{level.shape[-1]} '
+                                 f'grid, it is too small for this resolution.')
+        coverages.append(pyramid.latent.mean().item())
+    union = 0.0
+    if pyramids:
+        union = torch.stack([pyramid.latent for pyramid in pyramids]).amax(dim=0).mean().item()
+    overlap = sum(coverages) - union
+    if overlap > min_coverage:
+        print(f'[WARN] masks overlap on {overlap:.2%} of the latent grid, their LoRAs are mixed there')
+    return {'coverage': coverages, 'union': union}
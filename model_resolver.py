@@ -0,0 +1,100 @@
+import json
+import os
+
+# Stable Diffusion versions and offline resolution of their weights
+#
+# resolve_model() turns a Hub model id into a local directory whenever the weights are already on disk, so
+# from_pretrained() reads them directly instead of going through the Hub client (no network round trips, and
+# it works without network at all). Lookup order:
+#
+#   1. the argument itself, if it is a local directory
+#   2. $DIFFSTYLER_MODEL_DIR/<org>--<name> or $DIFFSTYLER_MODEL_DIR/<name> (a local mirror)
+#   3. the snapshot of the Hugging Face cache ($HUGGINGFACE_HUB_CACHE, $HF_HOME/hub or ~/.cache/huggingface/hub)
+#
+# A mirror or cache snapshot is only used when it holds the components the caller loads (`subfolders`, by
+# default every component of its model_index.json) with their config and, for networks, weight files; the
+# Hub cache fills a snapshot one file at a time, so e.g. a snapshot with only the scheduler config does not
+# count. Otherwise the id is returned unchanged and downloaded as before, unless HF_HUB_OFFLINE is set, in
+# which case a missing model is an error right away.
+
+CONFIG_FILES = ['config.json', 'scheduler_config.json', 'tokenizer_config.json', 'preprocessor_config.json']
+WEIGHT_EXTENSIONS = ('.safetensors', '.bin')
+
+SD_VERSIONS = {
+    '2.1': 'stabilityai/stable-diffusion-2-1-base',
+    '2.0': 'stabilityai/stable-diffusion-2-base',
+    '1.5': 'runwayml/stable-diffusion-v1-5',
+    'depth': 'stabilityai/stable-diffusion-2-depth',
+}
+
+
+def model_key(sd_version):
+    if sd_version not in SD_VERSIONS:
+        raise ValueError(f'Stable-diffusion version {sd_version} not supported.')
+    return SD_VERSIONS[sd_version]
+
+
+def hub_cache_dir():
+    if os.environ.get('HUGGINGFACE_HUB_CACHE'):
+        return os.environ['HUGGINGFACE_HUB_CACHE']
+    hf_home = os.environ.get('HF_HOME', os.path.join(os.path.expanduser('~'), '.cache', 'huggingface'))
+    return os.path.join(hf_home, 'hub')
+
+
+def cached_snapshot(repo_id, cache_dir=None, revision='main'):
+    # directory of the cached snapshot of repo_id at `revision` (a branch name or commit hash), or None
+    repo_dir = os.path.join(cache_dir or hub_cache_dir(), 'models--' + repo_id.replace('/', '--'))
+    ref_path = os.path.join(repo_dir, 'refs', revision)
+    commit = revision
+    if os.path.exists(ref_path):
+        with open(ref_path) as f:
+            commit = f.read().strip()
+    snapshot = os.path.join(repo_dir, 'snapshots', commit)
+    return snapshot if os.path.isdir(snapshot) else None
+
+
+def missing_components(directory, subfolders=None):
+    # components of a pipeline directory that are absent or incomplete (no config, or a network without weights)
+    if subfolders is None:
+        index_path = os.path.join(directory, 'model_index.json')
+        if not os.path.exists(index_path):
+            return ['model_index.json']
+        with open(index_path) as f:
+            index = json.load(f)
+        subfolders = [name for name, value in index.items()
+                      if not name.startswith('_') and isinstance(value, list) and value[0] is not None]
+    missing = []
+    for name in subfolders:
+        folder = os.path.join(directory, name)
+        files = os.listdir(folder) if os.path.isdir(folder) else []
+        # os.path.exists follows the cache symlinks, a blob still downloading does not count
+        configs = [f for f in CONFIG_FILES if os.path.exists(os.path.join(folder, f))]
+        weights = [f for f in files if f.endswith(WEIGHT_EXTENSIONS) and os.path.exists(os.path.join(folder, f))]
+        if not configs or ('config.json' in configs and not weights):
+            missing.append(name)
+    return missing
+
+
+def resolve_model(name_or_path, subfolders=None, cache_dir=None, revision='main'):
+    # subfolders: the components the caller loads, default every component of the pipeline
+    if os.path.isdir(name_or_path):
+        return name_or_path
+    candidates = []
+    mirror = os.environ.get('DIFFSTYLER_MODEL_DIR')
+    if mirror:
+        candidates += [os.path.join(mirror, name) for name in [name_or_path.replace('/', '--'), name_or_path.split('/')[-1]]
+                       if os.path.isdir(os.path.join(mirror, name))]
+    snapshot = cached_snapshot(name_or_path, cache_dir=cache_dir, revision=revision)
+    if snapshot is not None:
+        candidates.append(snapshot)
+    incomplete = {}
+    for candidate in candidates:
+        missing = missing_components(candidate, subfolders)
+        if not missing:
+            return candidate
+        incomplete[candidate] = missing
+    if os.environ.get('HF_HUB_OFFLINE', '0') not in ('', '0'):
+        details = ''.join(f'; {path} lacks {missing}' for path, missing in incomplete.items())
+        raise FileNotFoundError(f'{name_or_path} is not in the local model cache ({cache_dir or hub_cache_dir()}) '
+                                f'and HF_HUB_OFFLINE is set{details}.')
+    return name_or_path
@@ -19,6 +19,7 @@ def register_time(model_unet, t, source_latents=None):
     conv_module = model_unet.up_blocks[1].resnets[1]
     setattr(conv_module, 't', t)
     setattr(conv_module, 'source_batch_size', model_unet.source_batch_size)
+    update_injection_gate(conv_module, t)
 
     # Set 't' and 'source_batch_size' on attention modules
     down_res_dict = {0: [0, 1], 1: [0, 1], 2: [0, 1]}
@@ -30,6 +31,7 @@ def register_time(model_unet, t, source_latents=None):
             for module in [module_attn1, module_attn2]:
                 setattr(module, 't', t)
                 setattr(module, 'source_batch_size', model_unet.source_batch_size)
+                update_injection_gate(module, t)
     for res in down_res_dict:
         for block in down_res_dict[res]:
             module_attn1 = model_unet.down_blocks[res].attentions[block].transformer_blocks[0].attn1
@@ -37,6 +39,7 @@ def register_time(model_unet, t, source_latents=None):
             for module in [module_attn1, module_attn2]:
                 setattr(module, 't', t)
                 setattr(module, 'source_batch_size', model_unet.source_batch_size)
+                update_injection_gate(module, t)
     module_attn1 = model_unet.mid_block.attentions[0].transformer_blocks[0].attn1
     module_attn2 = model_unet.mid_block.attentions[0].transformer_blocks[0].attn2
     for module in [module_attn1, module_attn2]:
@@ -70,13 +73,80 @@ def register_time(model_unet, t, source_latents=None):
     # module = model_unet.mid_block.attentions[0].transformer_blocks[0].attn2
     # setattr(module, 't', t)
 
+def add_injection_gate(module, injection_schedule):
+    # the gated forwards read the injection decision from a buffer instead of branching on
+    # `self.t in self.injection_schedule`, so the traced graph is identical at every step
+    device = next(module.parameters()).device
+    setattr(module, 'injection_schedule', injection_schedule)
+    module.register_buffer('injection_gate', torch.zeros(1, dtype=torch.bool, device=device), persistent=False)
+
+
+def update_injection_gate(module, t):
+    gate = getattr(module, 'injection_gate', None)
+    if gate is None:
+        return
+    variant_schedules = getattr(module, 'variant_schedules', None)
+    if variant_schedules is not None:
+        gate.copy_(torch.tensor([schedule is not None and (t in schedule or t == 1000)
+                                 for schedule in variant_schedules]))
+    else:
+        schedule = module.injection_schedule
+        gate.fill_(schedule is not None and (t in schedule or t == 1000))
+
+
+def register_variant_schedules(model_unet, conv_schedules, qk_schedules):
+    # one injection schedule per variant of a batch laid out [source x V, uncond x V, cond x V]; the gate
+    # of every injection module grows to V entries, so it needs the gated forwards
+    conv_module = model_unet.up_blocks[1].resnets[1]
+    for module in model_unet.modules():
+        gate = getattr(module, 'injection_gate', None)
+        if gate is None:
+            continue
+        schedules = conv_schedules if module is conv_module else qk_schedules
+        module.variant_schedules = schedules
+        module.injection_gate = torch.zeros(len(schedules), dtype=torch.bool, device=gate.device)
+
+
+def gated_inject(hidden_states, gate):
+    # out-of-place equivalent of copying the source rows into the unconditional and conditional rows
+    source_batch_size = hidden_states.shape[0] // 3
+    source = hidden_states[:source_batch_size]
+    injected = source.repeat(3, *([1] * (hidden_states.dim() - 1)))
+    rows = gate.repeat(hidden_states.shape[0] // gate.shape[0]).view(-1, *([1] * (hidden_states.dim() - 1)))
+    return torch.where(rows, injected, hidden_states)
+
+
+def qk_injection(module, q, k):
+    # PnP injection for attention processors that do it themselves (see lora_attention.py), on modules
+    # whose forward init_pnp left unpatched: the source rows of q and k are copied to the unconditional
+    # and conditional rows where the schedule says so; q or k may be None
+    gate = getattr(module, 'injection_gate', None)
+    if gate is None:
+        schedule = getattr(module, 'injection_schedule', None)
+        if schedule is None or not (module.t in schedule or module.t == 1000):
+            return q, k
+        gate = torch.ones(1, dtype=torch.bool, device=(q if q is not None else k).device)
+    return tuple(x if x is None else gated_inject(x, gate) for x in (q, k))
+
+
+def compile_unet(model_unet, mode=None, cache_dir=None):
+    # inductor compiled UNet; the kernel cache is kept on disk so later runs skip most of the compilation
+    if cache_dir is not None:
+        os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.expanduser(cache_dir)
+        import torch._inductor.config as inductor_config
+        if hasattr(inductor_config, 'fx_graph_cache'):
+            inductor_config.fx_graph_cache = True
+    return torch.compile(model_unet, mode=mode, dynamic=False)
+
+
 def load_source_latents_t(t, latents_path):
     latents_t_path = os.path.join(latents_path, f'noisy_latents_{t}.pt')
     assert os.path.exists(latents_t_path), f'Missing latents at t {t} path {latents_t_path}'
     latents = torch.load(latents_t_path)
     return latents
 
-def register_attention_control_efficient(model_unet, injection_schedule):
+def register_attention_control_efficient(model_unet, injection_schedule, gated=False, use_processor=False):
+    # use_processor: keep the attention processors (they call qk_injection), only register the schedule
     def sa_forward(self):
         to_out = self.to_out
         if type(to_out) is torch.nn.modules.container.ModuleList:
@@ -132,17 +202,60 @@ def register_attention_control_efficient(model_unet, injection_schedule):
 
         return forward
 
+    def sa_forward_gated(self):
+        to_out = self.to_out
+        if type(to_out) is torch.nn.modules.container.ModuleList:
+            to_out = self.to_out[0]
+        else:
+            to_out = self.to_out
+
+        def forward(x, encoder_hidden_states=None, attention_mask=None):
+            batch_size, sequence_length, dim = x.shape
+            h = self.heads
+
+            is_cross = encoder_hidden_states is not None
+            encoder_hidden_states = encoder_hidden_states if is_cross else x
+            q = gated_inject(self.to_q(x), self.injection_gate)
+            k = gated_inject(self.to_k(encoder_hidden_states), self.injection_gate)
+            q = self.head_to_batch_dim(q)
+            k = self.head_to_batch_dim(k)
+
+            v = self.to_v(encoder_hidden_states)
+            v = self.head_to_batch_dim(v)
+
+            sim = torch.einsum("b i d, b j d -> b i j", q, k) * self.scale
+
+            if attention_mask is not None:
+                attention_mask = attention_mask.reshape(batch_size, -1)
+                max_neg_value = -torch.finfo(sim.dtype).max
+                attention_mask = attention_mask[:, None, :].repeat(h, 1, 1)
+                sim = sim.masked_fill(~attention_mask, max_neg_value)
+
+            attn = sim.softmax(dim=-1)
+            out = torch.einsum("b i j, b j d -> b i d", attn, v)
+            out = self.batch_to_head_dim(out)
+
+            return to_out(out)
+
+        return forward
+
     res_dict = {1: [1, 2], 2: [0, 1, 2], 3: [0, 1, 2]}  # we are injecting attention in blocks 4 - 11 of the decoder, so not in the first block of the lowest resolution
     for res in res_dict:
         for block in res_dict[res]:
-            module = model_unet.up_blocks[res].attentions[block].transformer_blocks[0].attn1
-            module.forward = sa_forward(module)
-            setattr(module, 'injection_schedule', injection_schedule)
-            module = model_unet.up_blocks[res].attentions[block].transformer_blocks[0].attn2
-            module.forward = sa_forward(module)
-            setattr(module, 'injection_schedule', injection_schedule)
-
-def register_conv_control_efficient(model_unet, injection_schedule):
+            for module in [model_unet.up_blocks[res].attentions[block].transformer_blocks[0].attn1,
+                           model_unet.up_blocks[res].attentions[block].transformer_blocks[0].attn2]:
+                if use_processor:
+                    setattr(module, 'injection_schedule', injection_schedule)
+                    if gated:
+                        add_injection_gate(module, injection_schedule)
+                elif gated:
+                    module.forward = sa_forward_gated(module)
+                    add_injection_gate(module, injection_schedule)
+                else:
+                    module.forward = sa_forward(module)
+                    setattr(module, 'injection_schedule', injection_schedule)
+
+def register_conv_control_efficient(model_unet, injection_schedule, gated=False):
     def conv_forward(self):
         def forward(input_tensor, temb):
             hidden_states = input_tensor
@@ -202,6 +315,56 @@ def register_conv_control_efficient(model_unet, injection_schedule):
 
         return forward
 
+    def conv_forward_gated(self):
+        def forward(input_tensor, temb):
+            # the legacy forward injects into input_tensor in place, so the residual sees it too
+            input_tensor = gated_inject(input_tensor, self.injection_gate)
+            hidden_states = input_tensor
+
+            if self.upsample is not None:
+                # upsample_nearest_nhwc fails with large batch sizes. see https://github.com/huggingface/diffusers/issues/984
+                if hidden_states.shape[0] >= 64:
+                    input_tensor = input_tensor.contiguous()
+                    hidden_states = hidden_states.contiguous()
+                input_tensor = self.upsample(input_tensor)
+                hidden_states = self.upsample(hidden_states)
+            elif self.downsample is not None:
+                input_tensor = self.downsample(input_tensor)
+                hidden_states = self.downsample(hidden_states)
+
+            hidden_states = self.conv1(hidden_states)
+
+            if temb is not None:
+                temb = self.time_emb_proj(self.nonlinearity(temb))[:, :, None, None]
+
+            if temb is not None and self.time_embedding_norm == "default":
+                hidden_states = hidden_states + temb
+
+            hidden_states = self.norm2(hidden_states)
+
+            if temb is not None and self.time_embedding_norm == "scale_shift":
+                scale, shift = torch.chunk(temb, 2, dim=1)
+                hidden_states = hidden_states * (1 + scale) + shift
+
+            hidden_states = self.nonlinearity(hidden_states)
+
+            hidden_states = self.dropout(hidden_states)
+            hidden_states = self.conv2(hidden_states)
+            hidden_states = gated_inject(hidden_states, self.injection_gate)
+
+            if self.conv_shortcut is not None:
+                input_tensor = self.conv_shortcut(input_tensor)
+
+            output_tensor = (input_tensor + hidden_states) / self.output_scale_factor
+
+            return output_tensor
+
+        return forward
+
     conv_module = model_unet.up_blocks[1].resnets[1]
-    conv_module.forward = conv_forward(conv_module)
-    setattr(conv_module, 'injection_schedule', injection_schedule)
\ No newline at end of file
+    if gated:
+        conv_module.forward = conv_forward_gated(conv_module)
+        add_injection_gate(conv_module, injection_schedule)
+    else:
+        conv_module.forward = conv_forward(conv_module)
+        setattr(conv_module, 'injection_schedule', injection_schedule)
\ No newline at end of file
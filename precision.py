@@ -0,0 +1,85 @@
+import contextlib
+import torch
+
+# precision policy shared by diffstyler.py, preprocess.py and lora_train.py
+#
+# A policy is a dict with one dtype per component plus a channels_last flag:
+#   {'unet': torch.bfloat16, 'vae': torch.float32, 'text_encoder': torch.float32, 'channels_last': False}
+# It is built from the `precision` config entry, which is either a preset name
+# ('fp32', 'bf16', 'fp16') or a dict with per-component presets and 'channels_last'.
+# Latents, masks and scheduler math always stay in fp32; only the networks run in the policy dtype.
+
+DTYPES = {
+    'fp32': torch.float32,
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
+
+COMPONENTS = ('unet', 'vae', 'text_encoder')
+
+
+def get_device(device=None):
+    # explicit device wins, otherwise pick the best available backend
+    if device is not None:
+        return torch.device(device)
+    if torch.backends.mps.is_available():
+        return torch.device("mps")
+    elif torch.cuda.is_available():
+        return torch.device("cuda")
+    return torch.device("cpu")
+
+
+def _supported_dtype(name, device):
+    if name not in DTYPES:
+        raise ValueError(f'Precision {name} not supported, expected one of {list(DTYPES)}.')
+    if name == 'fp16' and device.type == 'cpu':
+        print('[INFO] fp16 is slow or unsupported on cpu, using bf16 instead.')
+        name = 'bf16'
+    if name == 'bf16' and device.type == 'mps':
+        print('[INFO] bf16 is not supported on mps, using fp32 instead.')
+        name = 'fp32'
+    return DTYPES[name]
+
+
+def resolve_precision(precision=None, device=None):
+    device = get_device(device)
+    if precision is None:
+        precision = 'fp32'
+    if isinstance(precision, str):
+        precision = {component: precision for component in COMPONENTS}
+    policy = {}
+    for component in COMPONENTS:
+        policy[component] = _supported_dtype(precision.get(component, 'fp32'), device)
+    policy['channels_last'] = bool(precision.get('channels_last', False))
+    return policy
+
+
+def policy_name(policy):
+    inv = {dtype: name for name, dtype in DTYPES.items()}
+    name = '-'.join(f'{component}:{inv[policy[component]]}' for component in COMPONENTS)
+    if policy['channels_last']:
+        name += '-channels_last'
+    return name
+
+
+def apply_precision(policy, unet=None, vae=None, text_encoder=None):
+    # cast the frozen networks in place to their policy dtype
+    if unet is not None:
+        unet.to(dtype=policy['unet'])
+        if policy['channels_last']:
+            unet.to(memory_format=torch.channels_last)
+    if vae is not None:
+        vae.to(dtype=policy['vae'])
+        if policy['channels_last']:
+            vae.to(memory_format=torch.channels_last)
+    if text_encoder is not None:
+        text_encoder.to(dtype=policy['text_encoder'])
+
+
+def autocast(policy, device, component='unet'):
+    # autocast for modules whose weights must stay in fp32 (e.g. a UNet with trainable LoRA layers)
+    device = get_device(device)
+    dtype = policy[component]
+    if dtype == torch.float32 or device.type == 'mps':
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=dtype)
@@ -1,19 +1,26 @@
-from transformers import CLIPTextModel, CLIPTokenizer, logging
-from diffusers import AutoencoderKL, UNet2DConditionModel, DDIMScheduler
-
-# suppress partial model loading warning
-logging.set_verbosity_error()
-
 import os
 from PIL import Image
 from tqdm import tqdm, trange
 import torch
 import torch.nn as nn
 import argparse
+import glob
+import json
+import time
+import multiprocessing as mp
 from pathlib import Path
 from pnp_utils_combine import *
+from precision import get_device, resolve_precision, apply_precision
+from async_writer import AsyncWriter
+from bench_utils import synchronize
+from runtime import split_cpus, apply_runtime, format_cpus
+from checkpoint import Checkpointer, atomic_write
+from solvers import SAMPLERS, build_scheduler, dpm_solver_inversion, reset_scheduler
+from model_resolver import model_key as sd_model_key, resolve_model
 import torchvision.transforms as T
 
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
 
 def get_timesteps(scheduler, num_inference_steps, strength, device_type):
     # get the original timestep using init_timestep
@@ -26,47 +33,69 @@ def get_timesteps(scheduler, num_inference_steps, strength, device_type):
 
 
 class Preprocess(nn.Module):
-    def __init__(self, device, sd_version='2.0', hf_key=None):
+    def __init__(self, device, sd_version='2.0', hf_key=None, precision=None, models=None, sampler='ddim'):
+        # models: optional dict with vae, tokenizer, text_encoder, unet and scheduler to use instead of
+        # loading from the Hub (e.g. the small random models of tiny_models.py)
+        # sampler: 'ddim' or 'dpmsolver++', the latents are inverted on that sampler's schedule (solvers.py)
         super().__init__()
 
         self.device = device
         self.sd_version = sd_version
         self.use_depth = False
 
+        # per-component dtypes, see precision.py
+        self.policy = resolve_precision(precision, self.device)
+
+        if models is None:
+            models = self.load_models(hf_key)
+        else:
+            models = dict(models)
+            for name in ['vae', 'text_encoder', 'unet']:
+                models[name] = models[name].to(self.device)
+
+        self.vae = models['vae']
+        self.tokenizer = models['tokenizer']
+        self.text_encoder = models['text_encoder']
+        self.unet = models['unet']
+        apply_precision(self.policy, unet=self.unet, vae=self.vae, text_encoder=self.text_encoder)
+        self.sampler = sampler
+        self.scheduler = build_scheduler(sampler, models['scheduler'])
+
+        self.inversion_func = self.ddim_inversion if sampler == 'ddim' else self.dpm_inversion
+        # optional AsyncWriter, latents and images are then written in the background
+        self.writer = None
+        # optional checkpoint.Checkpointer of the current inversion, set per image batch by run_worker
+        self.checkpointer = None
+        self.timings = {}
+
+    def load_models(self, hf_key=None):
+        # diffusers and transformers are only imported when the SD weights are actually loaded
+        from transformers import CLIPTextModel, CLIPTokenizer, logging
+        from diffusers import AutoencoderKL, UNet2DConditionModel, DDIMScheduler
+
+        # suppress partial model loading warning
+        logging.set_verbosity_error()
         print(f'[INFO] loading stable diffusion...')
         if hf_key is not None:
             print(f'[INFO] using hugging face custom model key: {hf_key}')
             model_key = hf_key
-        elif self.sd_version == '2.1':
-            model_key = "stabilityai/stable-diffusion-2-1-base"
-        elif self.sd_version == '2.0':
-            model_key = "stabilityai/stable-diffusion-2-base"
-        elif self.sd_version == '1.5':
-            model_key = "runwayml/stable-diffusion-v1-5"
-        elif self.sd_version == 'depth':
-            model_key = "stabilityai/stable-diffusion-2-depth"
-            self.use_depth = True
-        else:
-            raise ValueError(f'Stable-diffusion version {self.sd_version} not supported.')
-        
-        # Determine the appropriate data type
-        if self.device.type == 'mps':
-            dtype = torch.float32
         else:
-            dtype = torch.float16
+            model_key = sd_model_key(self.sd_version)
+            self.use_depth = self.sd_version == 'depth'
+        # the local snapshot when the weights are cached (no Hub lookup), see model_resolver.py
+        model_key = resolve_model(model_key, subfolders=['vae', 'tokenizer', 'text_encoder', 'unet', 'scheduler'])
 
         # Create model
-        self.vae = AutoencoderKL.from_pretrained(model_key, subfolder="vae", revision="fp16",
-                                                 torch_dtype=torch.float32).to(self.device)
-        self.tokenizer = CLIPTokenizer.from_pretrained(model_key, subfolder="tokenizer")
-        self.text_encoder = CLIPTextModel.from_pretrained(model_key, subfolder="text_encoder", revision="fp16",
-                                                          torch_dtype=torch.float32).to(self.device)
-        self.unet = UNet2DConditionModel.from_pretrained(model_key, subfolder="unet", revision="fp16",
-                                                         torch_dtype=torch.float32).to(self.device)
-        self.scheduler = DDIMScheduler.from_pretrained(model_key, subfolder="scheduler")
+        vae = AutoencoderKL.from_pretrained(model_key, subfolder="vae",
+                                            torch_dtype=self.policy['vae']).to(self.device)
+        tokenizer = CLIPTokenizer.from_pretrained(model_key, subfolder="tokenizer")
+        text_encoder = CLIPTextModel.from_pretrained(model_key, subfolder="text_encoder",
+                                                     torch_dtype=self.policy['text_encoder']).to(self.device)
+        unet = UNet2DConditionModel.from_pretrained(model_key, subfolder="unet",
+                                                    torch_dtype=self.policy['unet']).to(self.device)
+        scheduler = DDIMScheduler.from_pretrained(model_key, subfolder="scheduler")
         print(f'[INFO] loaded stable diffusion!')
-
-        self.inversion_func = self.ddim_inversion
+        return {'vae': vae, 'tokenizer': tokenizer, 'text_encoder': text_encoder, 'unet': unet, 'scheduler': scheduler}
 
     @torch.no_grad()
     def get_text_embeds(self, prompt, negative_prompt, device_type):
@@ -77,146 +106,205 @@ class Preprocess(nn.Module):
                                       return_tensors='pt')
         uncond_embeddings = self.text_encoder(uncond_input.input_ids.to(self.device))[0]
         text_embeddings = torch.cat([uncond_embeddings, text_embeddings])
-        return text_embeddings
+        return text_embeddings.to(self.policy['unet'])
 
     @torch.no_grad()
     def decode_latents(self, latents):
-        if self.device.type != 'mps':
-            # Use autocast only for 'cuda' or 'cpu'
-            with torch.autocast(device_type=self.device.type, dtype=torch.float16):
-                latents = 1 / 0.18215 * latents
-                imgs = self.vae.decode(latents).sample
-                imgs = (imgs / 2 + 0.5).clamp(0, 1)
-        else:
-            # Use float32 without autocast for 'mps'
-            latents = 1 / 0.18215 * latents
-            imgs = self.vae.decode(latents).sample
-            imgs = (imgs / 2 + 0.5).clamp(0, 1)
+        latents = 1 / 0.18215 * latents
+        imgs = self.vae.decode(latents.to(self.policy['vae'])).sample.float()
+        imgs = (imgs / 2 + 0.5).clamp(0, 1)
         return imgs
 
     def load_img(self, image_path):
+        # a list of paths (all of the same size) is stacked into one batch
+        if isinstance(image_path, (list, tuple)):
+            return torch.cat([self.load_img(path) for path in image_path], dim=0)
         image_pil = T.Resize(512)(Image.open(image_path).convert("RGB"))
-        image = T.ToTensor()(image_pil).unsqueeze(0).to(device)
+        image = T.ToTensor()(image_pil).unsqueeze(0).to(self.device)
         return image
 
+    def save_latents(self, latent, save_path, t):
+        # save_path is one directory for the whole batch, a list with one directory per image, or a dict
+        # that collects the latents in memory by timestep
+        if isinstance(save_path, dict):
+            save_path[int(t)] = latent.detach().clone()
+            return
+        if isinstance(save_path, (list, tuple)):
+            items = list(zip(save_path, latent.split(1)))
+        else:
+            items = [(save_path, latent)]
+        for path, chunk in items:
+            target = os.path.join(path, f'noisy_latents_{t}.pt')
+            if self.writer is not None:
+                # the writer saves a copy, so every file holds only its own image
+                self.writer.save_tensor(chunk, target)
+            else:
+                # clone so the file does not hold the storage of the whole batch
+                torch.save(chunk.clone() if len(items) > 1 else chunk, target)
+
     @torch.no_grad()
     def encode_imgs(self, imgs):
-        if self.device.type != 'mps':
-            # Use autocast only for 'cuda' or 'cpu'
-            with torch.autocast(device_type=self.device.type, dtype=torch.float16):
-                imgs = 2 * imgs - 1
-                posterior = self.vae.encode(imgs).latent_dist
-                latents = posterior.mean * 0.18215
-        else:
-            # Use float32 without autocast for 'mps'
-            imgs = 2 * imgs - 1
-            posterior = self.vae.encode(imgs).latent_dist
-            latents = posterior.mean * 0.18215
+        imgs = 2 * imgs - 1
+        posterior = self.vae.encode(imgs.to(self.policy['vae'])).latent_dist
+        latents = posterior.mean.float() * 0.18215
         return latents
 
     @torch.no_grad()
-    def ddim_inversion(self, cond, latent, save_path, save_latents=True, timesteps_to_save=None):
-        timesteps = reversed(self.scheduler.timesteps)
-        if self.device.type != 'mps':
-            # Use autocast only for 'cuda' or 'cpu'
-            with torch.autocast(device_type=self.device.type, dtype=torch.float16):
-                for i, t in enumerate(tqdm(timesteps)):
-                    cond_batch = cond.repeat(latent.shape[0], 1, 1)
-
-                    alpha_prod_t = self.scheduler.alphas_cumprod[t]
-                    alpha_prod_t_prev = (
-                        self.scheduler.alphas_cumprod[timesteps[i - 1]]
-                        if i > 0 else self.scheduler.final_alpha_cumprod
-                    )
-
-                    mu = alpha_prod_t ** 0.5
-                    mu_prev = alpha_prod_t_prev ** 0.5
-                    sigma = (1 - alpha_prod_t) ** 0.5
-                    sigma_prev = (1 - alpha_prod_t_prev) ** 0.5
-
-                    eps = self.unet(latent, t, encoder_hidden_states=cond_batch).sample
-
-                    pred_x0 = (latent - sigma_prev * eps) / mu_prev
-                    latent = mu * pred_x0 + sigma * eps
-                    if save_latents:
-                        torch.save(latent, os.path.join(save_path, f'noisy_latents_{t}.pt'))
-        else:
-            # Use float32 without autocast for 'mps'
-            with torch.no_grad():
-                for i, t in enumerate(tqdm(timesteps)):
-                    cond_batch = cond.repeat(latent.shape[0], 1, 1)
-
-                    alpha_prod_t = self.scheduler.alphas_cumprod[t]
-                    alpha_prod_t_prev = (
-                        self.scheduler.alphas_cumprod[timesteps[i - 1]]
-                        if i > 0 else self.scheduler.final_alpha_cumprod
-                    )
-
-                    mu = alpha_prod_t ** 0.5
-                    mu_prev = alpha_prod_t_prev ** 0.5
-                    sigma = (1 - alpha_prod_t) ** 0.5
-                    sigma_prev = (1 - alpha_prod_t_prev) ** 0.5
-
-                    eps = self.unet(latent, t, encoder_hidden_states=cond_batch).sample
-
-                    pred_x0 = (latent - sigma_prev * eps) / mu_prev
-                    latent = mu * pred_x0 + sigma * eps
-                    if save_latents:
-                        torch.save(latent, os.path.join(save_path, f'noisy_latents_{t}.pt'))
-        torch.save(latent, os.path.join(save_path, f'noisy_latents_{t}.pt'))
+    def ddim_inversion(self, cond, latent, save_path, save_latents=True, timesteps_to_save=None, n_steps=None):
+        # the UNet runs in its policy dtype, the inversion itself is carried out in fp32
+        # n_steps: only invert up to the n_steps-th timestep of the schedule (the rest is warm-started, see
+        # stylize_sequence.py)
+        timesteps = reversed(self.scheduler.timesteps)[:n_steps]
+        start = time.perf_counter()
+        writer_stats = dict(self.writer.stats) if self.writer is not None else None
+        compute_s = save_s = 0.0
+        # resume a preempted inversion of the same job (see checkpoint.py); the latents it already saved are
+        # on disk, the writer is flushed before every checkpoint
+        checkpointer = self.checkpointer
+        first = 0
+        state = checkpointer.load(self.device) if checkpointer is not None else None
+        if state is not None:
+            first, latent = checkpointer.restore(state, self.scheduler, self.device)
+        for i, t in enumerate(tqdm(timesteps[first:]), first):
+            cond_batch = cond.repeat(latent.shape[0], 1, 1)
+
+            alpha_prod_t = self.scheduler.alphas_cumprod[t]
+            alpha_prod_t_prev = (
+                self.scheduler.alphas_cumprod[timesteps[i - 1]]
+                if i > 0 else self.scheduler.final_alpha_cumprod
+            )
+
+            mu = alpha_prod_t ** 0.5
+            mu_prev = alpha_prod_t_prev ** 0.5
+            sigma = (1 - alpha_prod_t) ** 0.5
+            sigma_prev = (1 - alpha_prod_t_prev) ** 0.5
+
+            step_start = time.perf_counter()
+            eps = self.unet(latent.to(self.policy['unet']), t, encoder_hidden_states=cond_batch).sample.float()
+            synchronize(self.device)
+            compute_s += time.perf_counter() - step_start
+
+            pred_x0 = (latent - sigma_prev * eps) / mu_prev
+            latent = mu * pred_x0 + sigma * eps
+            if save_latents:
+                save_start = time.perf_counter()
+                self.save_latents(latent, save_path, t)
+                save_s += time.perf_counter() - save_start
+            if checkpointer is not None:
+                checkpointer.step(i + 1, latent, self.scheduler,
+                                  before_save=self.writer.flush if self.writer is not None else None)
+        # the fully inverted latent is kept even without save_latents; callers that only time or use the
+        # result (benchmark.py) pass no save_path
+        if save_path is not None:
+            self.save_latents(latent, save_path, timesteps[-1])
+        if checkpointer is not None:
+            checkpointer.clear()
+        self.record_timings(start, compute_s, save_s, writer_stats)
         return latent
 
     @torch.no_grad()
-    def ddim_sample(self, x, cond, save_path, save_latents=False, timesteps_to_save=None):
-        timesteps = self.scheduler.timesteps
-        if self.device.type != 'mps':
-            # Use autocast only for 'cuda' or 'cpu'
-            with torch.autocast(device_type=self.device.type, dtype=torch.float16):
-                for i, t in enumerate(tqdm(timesteps)):
-                    cond_batch = cond.repeat(x.shape[0], 1, 1)
-                    alpha_prod_t = self.scheduler.alphas_cumprod[t]
-                    alpha_prod_t_prev = (
-                        self.scheduler.alphas_cumprod[timesteps[i + 1]]
-                        if i < len(timesteps) - 1
-                        else self.scheduler.final_alpha_cumprod
-                    )
-                    mu = alpha_prod_t ** 0.5
-                    sigma = (1 - alpha_prod_t) ** 0.5
-                    mu_prev = alpha_prod_t_prev ** 0.5
-                    sigma_prev = (1 - alpha_prod_t_prev) ** 0.5
-
-                    eps = self.unet(x, t, encoder_hidden_states=cond_batch).sample
-
-                    pred_x0 = (x - sigma * eps) / mu
-                    x = mu_prev * pred_x0 + sigma_prev * eps
-        else:
-            # Use float32 without autocast for 'mps'
-            with torch.no_grad():
-                for i, t in enumerate(tqdm(timesteps)):
-                    cond_batch = cond.repeat(x.shape[0], 1, 1)
-                    alpha_prod_t = self.scheduler.alphas_cumprod[t]
-                    alpha_prod_t_prev = (
-                        self.scheduler.alphas_cumprod[timesteps[i + 1]]
-                        if i < len(timesteps) - 1
-                        else self.scheduler.final_alpha_cumprod
-                    )
-                    mu = alpha_prod_t ** 0.5
-                    sigma = (1 - alpha_prod_t) ** 0.5
-                    mu_prev = alpha_prod_t_prev ** 0.5
-                    sigma_prev = (1 - alpha_prod_t_prev) ** 0.5
-
-                    eps = self.unet(x, t, encoder_hidden_states=cond_batch).sample
-
-                    pred_x0 = (x - sigma * eps) / mu
-                    x = mu_prev * pred_x0 + sigma_prev * eps
+    def dpm_inversion(self, cond, latent, save_path, save_latents=True, timesteps_to_save=None, n_steps=None):
+        # DPM-Solver++(2M) inversion on the sampling schedule, a latent is saved at every sampling timestep
+        start = time.perf_counter()
+        writer_stats = dict(self.writer.stats) if self.writer is not None else None
+        timings = {'compute_s': 0.0, 'save_s': 0.0}
+        timesteps = self.scheduler.timesteps[-n_steps:] if n_steps else self.scheduler.timesteps
+        progress = tqdm(total=len(timesteps))
+        # resume a preempted inversion of the same job with the solver history of its checkpoint
+        checkpointer = self.checkpointer
+        first, solver_state = 0, None
+        state = checkpointer.load(self.device) if checkpointer is not None else None
+        if state is not None:
+            first, latent = checkpointer.restore(state, self.scheduler, self.device)
+            solver_state = state['extra']
+            progress.update(first)
+
+        def model_fn(x, t):
+            step_start = time.perf_counter()
+            eps = self.unet(x.to(self.policy['unet']), t, encoder_hidden_states=cond.repeat(x.shape[0], 1, 1)).sample.float()
+            synchronize(self.device)
+            timings['compute_s'] += time.perf_counter() - step_start
+            return eps
+
+        def save(x, t):
+            progress.update()
+            if save_latents:
+                save_start = time.perf_counter()
+                self.save_latents(x, save_path, t)
+                timings['save_s'] += time.perf_counter() - save_start
+
+        def checkpoint(steps_done, x, solver_state):
+            checkpointer.step(steps_done, x, self.scheduler, extra=solver_state,
+                              before_save=self.writer.flush if self.writer is not None else None)
+
+        latent = dpm_solver_inversion(model_fn, latent, timesteps, self.scheduler.alphas_cumprod,
+                                      order=self.scheduler.config.solver_order, callback=save, start=first,
+                                      solver_state=solver_state,
+                                      step_callback=checkpoint if checkpointer is not None else None)
+        progress.close()
+        if checkpointer is not None:
+            checkpointer.clear()
+        self.record_timings(start, timings['compute_s'], timings['save_s'], writer_stats)
+        return latent
+
+    def record_timings(self, start, compute_s, save_s, writer_stats):
+        # compute vs i/o share of the inversion; with a writer the saves only cost the enqueue
+        # (plus any backpressure stall) and the writes themselves overlap with the UNet
+        self.timings = {'inversion_s': time.perf_counter() - start, 'unet_compute_s': compute_s, 'save_s': save_s}
+        if writer_stats is not None:
+            self.timings['background_write_s'] = self.writer.stats['write_s'] - writer_stats['write_s']
+            self.timings['backpressure_s'] = self.writer.stats['blocked_s'] - writer_stats['blocked_s']
+        print('[INFO] inversion timings: ' + ', '.join(f'{k} {v:.1f}' for k, v in self.timings.items()))
+
+    @torch.no_grad()
+    def ddim_sample(self, x, cond, save_path, save_latents=False, timesteps_to_save=None, timesteps=None):
+        # timesteps defaults to the inversion schedule, a shorter one gives a cheaper reconstruction
+        if timesteps is None:
+            timesteps = self.scheduler.timesteps
+        if self.sampler != 'ddim':
+            return self.solver_sample(x, cond, save_path, save_latents, timesteps)
+        for i, t in enumerate(tqdm(timesteps)):
+            cond_batch = cond.repeat(x.shape[0], 1, 1)
+            alpha_prod_t = self.scheduler.alphas_cumprod[t]
+            alpha_prod_t_prev = (
+                self.scheduler.alphas_cumprod[timesteps[i + 1]]
+                if i < len(timesteps) - 1
+                else self.scheduler.final_alpha_cumprod
+            )
+            mu = alpha_prod_t ** 0.5
+            sigma = (1 - alpha_prod_t) ** 0.5
+            mu_prev = alpha_prod_t_prev ** 0.5
+            sigma_prev = (1 - alpha_prod_t_prev) ** 0.5
+
+            eps = self.unet(x.to(self.policy['unet']), t, encoder_hidden_states=cond_batch).sample.float()
+
+            pred_x0 = (x - sigma * eps) / mu
+            x = mu_prev * pred_x0 + sigma_prev * eps
 
         if save_latents:
-            torch.save(x, os.path.join(save_path, f'noisy_latents_{t}.pt'))
+            self.save_latents(x, save_path, t)
+        return x
+
+    @torch.no_grad()
+    def solver_sample(self, x, cond, save_path, save_latents=False, timesteps=None):
+        # reconstruction with the multistep solver itself, on a copy so the inversion schedule is kept
+        scheduler = build_scheduler(self.sampler, self.scheduler)
+        scheduler.set_timesteps(len(timesteps), device=x.device)
+        reset_scheduler(scheduler)
+        for t in tqdm(scheduler.timesteps):
+            eps = self.unet(x.to(self.policy['unet']), t, encoder_hidden_states=cond.repeat(x.shape[0], 1, 1)).sample.float()
+            x = scheduler.step(eps, t, x).prev_sample
+        if save_latents:
+            self.save_latents(x, save_path, t)
         return x
 
     @torch.no_grad()
     def extract_latents(self, num_steps, data_path, save_path, timesteps_to_save,
-                        inversion_prompt='', extract_reverse=False):
+                        inversion_prompt='', extract_reverse=False, recon='full', recon_steps=None):
+        # recon: 'full' samples back from the inverted noise and decodes it, 'latent' only compares
+        # latents (no VAE decode), 'none' skips the check; recon_steps shortens the sampling pass
+        if extract_reverse and (recon != 'full' or recon_steps is not None):
+            raise ValueError('--extract-reverse saves latents during the full reconstruction pass.')
         self.scheduler.set_timesteps(num_steps)
 
         # cond = self.get_text_embeds(inversion_prompt, "")[1].unsqueeze(0)
@@ -228,60 +316,141 @@ class Preprocess(nn.Module):
         inverted_x = self.inversion_func(cond, latent, save_path, save_latents=not extract_reverse,
                                          timesteps_to_save=timesteps_to_save)
         #inverted_x = torch.load('./latents_forward/photo_w1/noisy_latents_999.pt')
+        if recon == 'none':
+            return None, [{'recon': recon} for _ in range(latent.shape[0])]
+
+        timesteps = None
+        if recon_steps is not None:
+            recon_scheduler = build_scheduler(self.sampler, self.scheduler)
+            recon_scheduler.set_timesteps(recon_steps)
+            timesteps = recon_scheduler.timesteps
         latent_reconstruction = self.ddim_sample(inverted_x, cond, save_path, save_latents=extract_reverse,
-                                                 timesteps_to_save=timesteps_to_save)
+                                                 timesteps_to_save=timesteps_to_save, timesteps=timesteps)
+        latent_mse = ((latent_reconstruction - latent) ** 2).mean(dim=(1, 2, 3))
+        metrics = [{'recon': recon, 'recon_steps': len(timesteps if timesteps is not None else self.scheduler.timesteps),
+                    'latent_mse': mse.item()} for mse in latent_mse]
+        if recon == 'latent':
+            return None, metrics
+
         rgb_reconstruction = self.decode_latents(latent_reconstruction)
+        pixel_mse = ((rgb_reconstruction - image) ** 2).mean(dim=(1, 2, 3))
+        for item, mse in zip(metrics, pixel_mse):
+            item['pixel_mse'] = mse.item()
+            item['psnr_db'] = 10 * torch.log10(1.0 / mse.clamp_min(1e-10)).item()
+
+        return rgb_reconstruction, metrics  # , latent_reconstruction
 
-        return rgb_reconstruction  # , latent_reconstruction
+
+def save_image(image, path):
+    atomic_write(path, T.ToPILImage()(image).save)
+
+
+def save_json(data, path):
+    atomic_write(path, lambda f: json.dump(data, f, indent=2), mode='w')
+
+
+def get_data_paths(opt):
+    # a manifest (one image path per line), every image of a directory, or the single --data_path
+    if opt.manifest is not None:
+        with open(opt.manifest) as f:
+            return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    if opt.data_dir is not None:
+        return sorted(path for path in glob.glob(os.path.join(opt.data_dir, '*'))
+                      if path.lower().endswith(IMAGE_EXTENSIONS))
+    return [opt.data_path]
+
+
+def get_save_path(opt, data_path):
+    extraction_path_prefix = "_reverse" if opt.extract_reverse else "_forward"
+    return os.path.join(opt.save_dir + extraction_path_prefix, os.path.splitext(os.path.basename(data_path))[0])
+
+
+def batches_by_size(data_paths, batch_size):
+    # only images of the same size can share an inversion batch
+    groups = {}
+    for path in data_paths:
+        with Image.open(path) as image:
+            groups.setdefault(image.size, []).append(path)
+    for paths in groups.values():
+        for i in range(0, len(paths), batch_size):
+            yield paths[i:i + batch_size]
+
+
+def run_worker(opt, data_paths, timesteps_to_save, cpus=None):
+    runtime = apply_runtime({'cpus': cpus, 'threads': opt.threads, 'interop_threads': opt.interop_threads})
+    print(f'[INFO] worker {os.getpid()}: cpus {format_cpus(runtime["cpus"])}, {runtime["threads"]} threads, '
+          f'{len(data_paths)} images')
+
+    seed_everything(opt.seed)
+
+    precision = {'unet': opt.precision, 'vae': opt.precision, 'text_encoder': opt.precision,
+                 'channels_last': opt.channels_last}
+    model = Preprocess(opt.device, sd_version=opt.sd_version, hf_key=None, precision=precision, sampler=opt.sampler)
+
+    with AsyncWriter(max_pending=opt.writer_queue) as writer:
+        model.writer = writer
+        for batch in batches_by_size(data_paths, opt.batch_size):
+            save_paths = [get_save_path(opt, data_path) for data_path in batch]
+            for save_path in save_paths:
+                os.makedirs(save_path, exist_ok=True)
+
+            if opt.checkpoint_every:
+                job = {'data_path': batch, 'steps': opt.steps, 'sampler': opt.sampler, 'sd_version': opt.sd_version,
+                       'precision': precision, 'inversion_prompt': opt.inversion_prompt, 'seed': opt.seed}
+                model.checkpointer = Checkpointer(save_paths[0], job, name='inversion_checkpoint',
+                                                  every=opt.checkpoint_every)
+            recon_image, metrics = model.extract_latents(data_path=batch if len(batch) > 1 else batch[0],
+                                                         num_steps=opt.steps,
+                                                         save_path=save_paths if len(batch) > 1 else save_paths[0],
+                                                         timesteps_to_save=timesteps_to_save,
+                                                         inversion_prompt=opt.inversion_prompt,
+                                                         extract_reverse=opt.extract_reverse,
+                                                         recon=opt.recon,
+                                                         recon_steps=opt.recon_steps)
+
+            for i, save_path in enumerate(save_paths):
+                if recon_image is not None:
+                    writer.submit(save_image, recon_image[i].cpu(), os.path.join(save_path, f'recon.jpg'))
+                writer.submit(save_json, dict(metrics[i], timings=model.timings),
+                              os.path.join(save_path, 'recon_metrics.json'))
+            # barrier: this batch's latents are written (and synced with --fsync) before the next one starts
+            writer.flush(fsync=opt.fsync)
 
 
 def run(opt):
+    from diffusers import DDIMScheduler
+
     # timesteps to save
-    if opt.sd_version == '2.1':
-        model_key = "stabilityai/stable-diffusion-2-1-base"
-    elif opt.sd_version == '2.0':
-        model_key = "stabilityai/stable-diffusion-2-base"
-    elif opt.sd_version == '1.5':
-        model_key = "runwayml/stable-diffusion-v1-5"
-    elif opt.sd_version == 'depth':
-        model_key = "stabilityai/stable-diffusion-2-depth"
-    toy_scheduler = DDIMScheduler.from_pretrained(model_key, subfolder="scheduler")
+    toy_scheduler = DDIMScheduler.from_pretrained(resolve_model(sd_model_key(opt.sd_version), subfolders=['scheduler']),
+                                                   subfolder="scheduler")
     toy_scheduler.set_timesteps(opt.save_steps)
     timesteps_to_save, num_inference_steps = get_timesteps(toy_scheduler, num_inference_steps=opt.save_steps,
                                                            strength=1.0,
                                                            device_type=opt.device.type)
 
-    seed_everything(opt.seed)
-
-    extraction_path_prefix = "_reverse" if opt.extract_reverse else "_forward"
-    save_path = os.path.join(opt.save_dir + extraction_path_prefix, os.path.splitext(os.path.basename(opt.data_path))[0])
-    os.makedirs(save_path, exist_ok=True)
-
-    model = Preprocess(opt.device, sd_version=opt.sd_version, hf_key=None)
-
-    recon_image = model.extract_latents(data_path=opt.data_path,
-                                         num_steps=opt.steps,
-                                         save_path=save_path,
-                                         timesteps_to_save=timesteps_to_save,
-                                         inversion_prompt=opt.inversion_prompt,
-                                         extract_reverse=opt.extract_reverse)
-
-    T.ToPILImage()(recon_image[0]).save(os.path.join(save_path, f'recon.jpg'))
+    data_paths = get_data_paths(opt)
+    num_workers = min(opt.num_workers, len(data_paths))
+    if num_workers <= 1:
+        run_worker(opt, data_paths, timesteps_to_save)
+        return
+
+    # one process per shard, each pinned to its own slice of a NUMA node
+    cpu_splits = split_cpus(num_workers, numa=opt.numa)
+    ctx = mp.get_context('spawn')
+    workers = [ctx.Process(target=run_worker, args=(opt, data_paths[i::num_workers], timesteps_to_save, cpu_splits[i]))
+               for i in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    failed = [worker.pid for worker in workers if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError(f'preprocessing workers {failed} failed')
 
 
 if __name__ == "__main__":
     # device = 'cuda'
 
-    if torch.backends.mps.is_available():
-        device = torch.device("mps")
-        print("[INFO] Using MPS device for computation.")
-    elif torch.cuda.is_available():
-        device = torch.device("cuda")
-        print("[INFO] Using CUDA device for computation.")
-    else:
-        device = torch.device("cpu")
-        print("[INFO] Using CPU for computation.")
-
     parser = argparse.ArgumentParser()
     parser.add_argument('--data_path', type=str,
                         default='data/girl1.jpg')
@@ -290,10 +459,32 @@ if __name__ == "__main__":
                         help="stable diffusion version")
     parser.add_argument('--seed', type=int, default=1)
     parser.add_argument('--steps', type=int, default=999) 
+    parser.add_argument('--sampler', type=str, default='ddim', choices=SAMPLERS,
+                        help="invert on this sampler's schedule; use the config's sampler and n_timesteps as --steps")
     parser.add_argument('--save-steps', type=int, default=1000)
     parser.add_argument('--inversion_prompt', type=str, default='')
     parser.add_argument('--extract-reverse', default=False, action='store_true', help="extract features during the denoising process")
+    parser.add_argument('--device', type=str, default=None, help='mps, cuda or cpu; picked automatically if not set')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'],
+                        help="dtype for the UNet, VAE and text encoder, see precision.py")
+    parser.add_argument('--channels_last', default=False, action='store_true')
+    parser.add_argument('--data_dir', type=str, default=None, help="invert every image of this directory")
+    parser.add_argument('--manifest', type=str, default=None, help="text file with one image path per line")
+    parser.add_argument('--batch_size', type=int, default=1, help="images of the same size inverted together")
+    parser.add_argument('--num_workers', type=int, default=1, help="worker processes, each pinned to its own cpus")
+    parser.add_argument('--numa', default=False, action='store_true', help="spread the workers over the NUMA nodes")
+    parser.add_argument('--threads', type=int, default=None, help="intra-op threads per worker (default: its cpu count)")
+    parser.add_argument('--interop_threads', type=int, default=None, help="inter-op threads per worker")
+    parser.add_argument('--recon', type=str, default='full', choices=['full', 'latent', 'none'],
+                        help="reconstruction check: decoded recon.jpg, latent-space error only, or skipped")
+    parser.add_argument('--recon_steps', type=int, default=None, help="sampling steps of the reconstruction check")
+    parser.add_argument('--writer_queue', type=int, default=32,
+                        help="latents waiting to be written before the inversion loop blocks (0: unbounded)")
+    parser.add_argument('--checkpoint_every', type=int, default=0,
+                        help="checkpoint the inversion every N steps; a relaunch resumes it (0: off)")
+    parser.add_argument('--fsync', default=False, action='store_true', help="fsync the written latents after every batch")
     opt = parser.parse_args()
-    opt.device = device
+    opt.device = get_device(opt.device)
+    print(f"[INFO] Using {opt.device} for computation.")
     run(opt)
 
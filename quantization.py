@@ -0,0 +1,103 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.ao.nn.quantized as nnq
+from torch.ao.quantization import QConfig, MinMaxObserver, default_dynamic_qconfig, default_per_channel_weight_observer, quantize_dynamic
+from diffusers.models.attention_processor import AttnProcessor, AttnProcessor2_0
+
+# int8 inference for the SD UNet on CPU
+#
+# dynamic: nn.Linear layers get int8 weights and per-call activation quantization
+# static:  nn.Linear and nn.Conv2d layers get int8 weights and activation ranges calibrated
+#          on real inputs; each layer is wrapped in quantize -> int8 op -> dequantize
+# LoRA layers live inside the attention processors and are skipped, so they stay in fp32
+# unless merge_lora_weights() folds them into the base projections first.
+
+QUANTIZABLE = (nn.Linear, nn.Conv2d)
+
+STATIC_QCONFIG = QConfig(
+    activation=MinMaxObserver.with_args(dtype=torch.quint8, reduce_range=True),
+    weight=default_per_channel_weight_observer,
+)
+
+
+def quantizable_modules(model):
+    # plain Linear/Conv2d layers of the model, without the LoRA layers of the attention processors
+    for name, module in model.named_modules():
+        if type(module) in QUANTIZABLE and '.processor.' not in name:
+            yield name, module
+
+
+def merge_lora_weights(model_unet):
+    # fold every LoRA delta into its base projection and switch back to the default attention processor
+    default_processor = AttnProcessor2_0() if hasattr(F, "scaled_dot_product_attention") else AttnProcessor()
+    processors = {}
+    for name, processor in model_unet.attn_processors.items():
+        if hasattr(processor, 'to_q_lora'):
+            attn = model_unet.get_submodule(name[:-len('.processor')])
+            pairs = [(attn.to_q, processor.to_q_lora), (attn.to_k, processor.to_k_lora),
+                     (attn.to_v, processor.to_v_lora), (attn.to_out[0], processor.to_out_lora)]
+            with torch.no_grad():
+                for proj, lora in pairs:
+                    delta = lora.up.weight.float() @ lora.down.weight.float()
+                    network_alpha = getattr(lora, 'network_alpha', None)
+                    if network_alpha is not None:
+                        delta = delta * network_alpha / lora.rank
+                    proj.weight += delta.to(proj.weight.dtype)
+            processor = default_processor
+        processors[name] = processor
+    model_unet.set_attn_processor(processors)
+    return model_unet
+
+
+def quantize_dynamic_unet(model_unet):
+    qconfig_spec = {name: default_dynamic_qconfig for name, module in quantizable_modules(model_unet)
+                    if type(module) is nn.Linear}
+    return quantize_dynamic(model_unet, qconfig_spec=qconfig_spec, dtype=torch.qint8, inplace=True)
+
+
+class StaticQuantLayer(nn.Module):
+    # int8 Linear/Conv2d with fixed input quantization parameters, fp32 in and out
+    def __init__(self, module, input_scale, input_zero_point):
+        super().__init__()
+        self.quant = nnq.Quantize(input_scale, input_zero_point, torch.quint8)
+        self.module = module
+        self.dequant = nnq.DeQuantize()
+
+    def forward(self, x):
+        return self.dequant(self.module(self.quant(x.float())))
+
+
+@torch.no_grad()
+def quantize_static_unet(model_unet, calibration_batches):
+    # calibration_batches yields (latent_model_input, t, encoder_hidden_states) for the UNet
+    modules = dict(quantizable_modules(model_unet))
+    input_observers = {}
+    handles = []
+    for name, module in modules.items():
+        module.qconfig = STATIC_QCONFIG
+        module.activation_post_process = STATIC_QCONFIG.activation()
+        input_observers[name] = STATIC_QCONFIG.activation()
+        handles.append(module.register_forward_pre_hook(
+            lambda module, inputs, observer=input_observers[name]: observer(inputs[0].float())))
+        handles.append(module.register_forward_hook(
+            lambda module, inputs, output: module.activation_post_process(output.float())))
+
+    n_batches = 0
+    for latent_model_input, t, encoder_hidden_states in calibration_batches:
+        model_unet(latent_model_input, t, encoder_hidden_states=encoder_hidden_states)
+        n_batches += 1
+    for handle in handles:
+        handle.remove()
+    if n_batches == 0:
+        raise ValueError('Static quantization needs at least one calibration batch.')
+
+    for name, module in modules.items():
+        quantized_cls = nnq.Linear if type(module) is nn.Linear else nnq.Conv2d
+        scale, zero_point = input_observers[name].calculate_qparams()
+        layer = StaticQuantLayer(quantized_cls.from_float(module), float(scale), int(zero_point))
+        parent_name, _, child_name = name.rpartition('.')
+        parent = model_unet.get_submodule(parent_name) if parent_name else model_unet
+        setattr(parent, child_name, layer)
+    print(f'[INFO] statically quantized {len(modules)} layers from {n_batches} calibration batches')
+    return model_unet
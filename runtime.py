@@ -0,0 +1,94 @@
+import glob
+import os
+import re
+import resource
+import torch
+
+# CPU topology helpers for pinning worker processes, the thread settings of the `runtime` config section and
+# the peak memory of a process
+
+
+def parse_cpulist(text):
+    # '0-3,8-11' -> [0, 1, 2, 3, 8, 9, 10, 11]
+    cpus = []
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def numa_nodes():
+    # cpus of every NUMA node usable by this process, a single node if the topology is not exposed
+    available = set(os.sched_getaffinity(0))
+    nodes = []
+    paths = glob.glob('/sys/devices/system/node/node[0-9]*/cpulist')
+    for path in sorted(paths, key=lambda p: int(re.search(r'node(\d+)', p).group(1))):
+        with open(path) as f:
+            cpus = [cpu for cpu in parse_cpulist(f.read()) if cpu in available]
+        if cpus:
+            nodes.append(cpus)
+    return nodes or [sorted(available)]
+
+
+def split_cpus(n_workers, numa=True):
+    # spread workers round-robin over the NUMA nodes and give each an equal share of its node's cpus
+    nodes = numa_nodes() if numa else [sorted(os.sched_getaffinity(0))]
+    workers_per_node = [list(range(node, n_workers, len(nodes))) for node in range(len(nodes))]
+    splits = [None] * n_workers
+    for node_cpus, workers in zip(nodes, workers_per_node):
+        if not workers:
+            continue
+        share = max(len(node_cpus) // len(workers), 1)
+        for i, worker in enumerate(workers):
+            start = (i * share) % len(node_cpus)
+            splits[worker] = node_cpus[start:start + share]
+    return splits
+
+
+def format_cpus(cpus):
+    # [0, 1, 2, 3, 8, 9] -> '0-3,8-9'
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(f'{start}-{end}' if start != end else str(start) for start, end in ranges)
+
+
+def apply_runtime(runtime=None):
+    # the `runtime` config section: {cpus: '0-7', threads: 8, interop_threads: 1}; unset entries keep the
+    # torch defaults, `threads` defaults to the number of pinned cpus
+    runtime = runtime or {}
+    cpus = runtime.get('cpus')
+    if cpus is not None:
+        cpus = parse_cpulist(str(cpus)) if isinstance(cpus, (str, int)) else list(cpus)
+        os.sched_setaffinity(0, cpus)
+    threads = runtime.get('threads') or (len(cpus) if cpus else None)
+    if threads:
+        torch.set_num_threads(threads)
+    interop_threads = runtime.get('interop_threads')
+    if interop_threads:
+        # only possible before the first inter-op parallel work of the process (get_num_interop_threads
+        # already counts as such, so it is not queried first)
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            print(f'[WARN] interop threads already in use, keeping {torch.get_num_interop_threads()}')
+    return {'cpus': sorted(os.sched_getaffinity(0)), 'threads': torch.get_num_threads(),
+            'interop_threads': torch.get_num_interop_threads()}
+
+
+def peak_memory_mb(device='cpu'):
+    # peak resident set size of this process (ru_maxrss is KiB on Linux, bytes on macOS)
+    device = torch.device(device)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss_mb = rss / 1024 ** 2 if os.uname().sysname == 'Darwin' else rss / 1024
+    if device.type == 'cuda':
+        return max(rss_mb, torch.cuda.max_memory_allocated(device) / 1024 ** 2)
+    return rss_mb
@@ -0,0 +1,211 @@
+import argparse
+import importlib
+import json
+import os
+import shutil
+import tempfile
+import warnings
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from precision import apply_precision, get_device, policy_name, resolve_precision
+
+# frozen SD weights shared by every process of a host
+#
+# `shared_weights: true` in a config (or {dir: ...}) makes PNP attach to a read-only, memory-mapped export of
+# the UNet, VAE and text encoder instead of loading its own copy. The export is one flat file per network, in
+# the dtype and memory layout of the precision policy, under /dev/shm/diffstyler (tmpfs; the system temp
+# directory where there is no /dev/shm). Every process maps the same pages, so N workers hold the frozen
+# weights once; only the LoRA processors, latents and activations are private. In blend mode the per-LoRA UNet
+# copies share the base parameters as well (see LoRARegistry.unet).
+#
+# The first process that needs an export writes it (to a temporary directory renamed into place, so others
+# never see a partial one); launch.py --shared_weights writes it once in the parent before the workers start,
+# and `python shared_weights.py --sd_version 2.1 --precision bf16` does so up front. Exports stay until removed
+# (--remove) or the host reboots. CPU only: on other devices the weights are copied to the device anyway.
+#
+#   <dir>/sd-<version>-<policy>/{unet,vae,text_encoder}/config.json   model config
+#                                                       weights.json  class and {name: dtype, shape, stride, offset}
+#                                                       weights.bin   raw tensor bytes, 64-byte aligned
+#                              /tokenizer, /scheduler                 save_pretrained copies (small)
+
+SHARED_COMPONENTS = ['unet', 'vae', 'text_encoder']
+ALIGNMENT = 64
+
+
+def default_root():
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm/diffstyler'
+    return os.path.join(tempfile.gettempdir(), 'diffstyler-shared')
+
+
+def export_dir(setting, sd_version, policy):
+    # `shared_weights` config entry: true, a directory, or {dir: ...}
+    if isinstance(setting, dict):
+        root = setting.get('dir') or default_root()
+    elif isinstance(setting, str):
+        root = setting
+    else:
+        root = default_root()
+    return os.path.join(root, f'sd-{sd_version}-{policy_name(policy).replace(":", "_")}')
+
+
+def is_exported(directory):
+    return all(os.path.exists(os.path.join(directory, name, 'weights.json')) for name in SHARED_COMPONENTS)
+
+
+def _raw_layout(tensor):
+    # the tensor in its own memory layout (plain or channels_last) as a contiguous buffer, and its strides
+    if tensor.dim() == 4 and not tensor.is_contiguous() and tensor.is_contiguous(memory_format=torch.channels_last):
+        return tensor.permute(0, 2, 3, 1).contiguous(), tensor.stride()
+    tensor = tensor.contiguous()
+    return tensor, tensor.stride()
+
+
+def export_module(module, directory):
+    os.makedirs(directory, exist_ok=True)
+    library = type(module).__module__.split('.')[0]
+    if library == 'diffusers':
+        module.save_config(directory)
+    else:
+        module.config.save_pretrained(directory)
+    tensors, offsets = {}, {}
+    offset = 0
+    with open(os.path.join(directory, 'weights.bin'), 'wb') as f:
+        named = [(name, tensor, True) for name, tensor in module.named_parameters(remove_duplicate=False)]
+        named += [(name, tensor, False) for name, tensor in module.named_buffers(remove_duplicate=False)]
+        for name, tensor, is_param in named:
+            # tied tensors are stored once
+            if id(tensor) not in offsets:
+                data, stride = _raw_layout(tensor.detach().cpu())
+                padding = -offset % ALIGNMENT
+                f.write(b'\0' * padding)
+                offset += padding
+                raw = data.reshape(-1).view(torch.uint8).numpy()
+                raw.tofile(f)
+                offsets[id(tensor)] = {'dtype': str(tensor.dtype).split('.')[-1], 'shape': list(tensor.shape),
+                                       'stride': list(stride), 'offset': offset, 'nbytes': raw.size}
+                offset += raw.size
+            tensors[name] = dict(offsets[id(tensor)], param=is_param)
+        f.flush()
+        os.fsync(f.fileno())
+    manifest = {'library': library, 'module': type(module).__module__, 'class': type(module).__name__,
+                'tensors': tensors}
+    with open(os.path.join(directory, 'weights.json'), 'w') as f:
+        json.dump(manifest, f)
+
+
+def export_models(models, directory):
+    # write the networks of a models dict (tokenizer, scheduler and the SHARED_COMPONENTS), as they are
+    if is_exported(directory):
+        return directory
+    os.makedirs(os.path.dirname(directory), exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(directory) + '.tmp-', dir=os.path.dirname(directory))
+    try:
+        for name in SHARED_COMPONENTS:
+            export_module(models[name], os.path.join(tmp_dir, name))
+        models['tokenizer'].save_pretrained(os.path.join(tmp_dir, 'tokenizer'))
+        models['scheduler'].save_pretrained(os.path.join(tmp_dir, 'scheduler'))
+        os.rename(tmp_dir, directory)
+        print(f'[INFO] shared weights exported to {directory}')
+    except OSError:
+        # another process exported it first
+        if not is_exported(directory):
+            raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return directory
+
+
+def _set_tensor(module, name, tensor):
+    owner_name, _, attr = name.rpartition('.')
+    owner = module.get_submodule(owner_name)
+    if isinstance(tensor, nn.Parameter):
+        owner._parameters[attr] = tensor
+    else:
+        owner._buffers[attr] = tensor
+
+
+def attach_module(directory):
+    # the network of an export, with every parameter and buffer a read-only view of the mapped file
+    from accelerate import init_empty_weights
+
+    with open(os.path.join(directory, 'weights.json')) as f:
+        manifest = json.load(f)
+    cls = getattr(importlib.import_module(manifest['module']), manifest['class'])
+    # the module is built without allocating its weights, they all come from the file
+    with init_empty_weights():
+        if manifest['library'] == 'diffusers':
+            module = cls.from_config(cls.load_config(directory))
+        else:
+            module = cls(cls.config_class.from_pretrained(directory))
+    with warnings.catch_warnings():
+        # torch warns that the array is not writable: that is the point
+        warnings.simplefilter('ignore', UserWarning)
+        flat = torch.from_numpy(np.memmap(os.path.join(directory, 'weights.bin'), dtype=np.uint8, mode='r'))
+    shared = {}
+    for name, entry in manifest['tensors'].items():
+        # tied tensors get the same object again (empty tensors can share an offset, hence the whole key)
+        key = (entry['offset'], entry['nbytes'], entry['dtype'], tuple(entry['shape']), entry['param'])
+        if key not in shared:
+            raw = flat[entry['offset']:entry['offset'] + entry['nbytes']]
+            tensor = raw.view(getattr(torch, entry['dtype'])).as_strided(entry['shape'], entry['stride'])
+            shared[key] = nn.Parameter(tensor, requires_grad=False) if entry['param'] else tensor
+        _set_tensor(module, name, shared[key])
+    missing = [name for name, tensor in list(module.named_parameters()) + list(module.named_buffers())
+               if tensor.is_meta]
+    if missing:
+        raise ValueError(f'{directory} has no weights for {missing[:5]} (exported from another model version?).')
+    return module.eval()
+
+
+def attach_models(directory):
+    from transformers import AutoTokenizer
+    from diffusers import DDIMScheduler
+
+    models = {name: attach_module(os.path.join(directory, name)) for name in SHARED_COMPONENTS}
+    models['tokenizer'] = AutoTokenizer.from_pretrained(os.path.join(directory, 'tokenizer'))
+    models['scheduler'] = DDIMScheduler.from_pretrained(os.path.join(directory, 'scheduler'))
+    return models
+
+
+def ensure_export(setting, sd_version, policy, load_fn):
+    # directory of the export of sd_version / policy, written from load_fn(sd_version) if it does not exist yet
+    directory = export_dir(setting, sd_version, policy)
+    if not is_exported(directory):
+        models = load_fn(sd_version)
+        apply_precision(policy, unet=models['unet'], vae=models['vae'], text_encoder=models['text_encoder'])
+        export_models(models, directory)
+    return directory
+
+
+def shared_models(setting, sd_version, policy, device, load_fn):
+    # models dict attached to the shared export (None on devices other than cpu); a process that has to write
+    # the export drops its private copy afterwards and maps the file like every other one
+    if get_device(device).type != 'cpu':
+        print(f'[WARN] shared_weights only applies to device: cpu, loading private weights on {device}')
+        return None
+    directory = ensure_export(setting, sd_version, policy, load_fn)
+    print(f'[INFO] attaching shared weights from {directory}')
+    return attach_models(directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sd_version', type=str, default='2.1', choices=['1.5', '2.0', '2.1'])
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'])
+    parser.add_argument('--channels_last', default=False, action='store_true')
+    parser.add_argument('--dir', type=str, default=None, help="default: /dev/shm/diffstyler")
+    parser.add_argument('--remove', default=False, action='store_true', help="delete the export instead")
+    opt = parser.parse_args()
+    policy = resolve_precision({'unet': opt.precision, 'vae': opt.precision, 'text_encoder': opt.precision,
+                                'channels_last': opt.channels_last}, 'cpu')
+    directory = export_dir(opt.dir, opt.sd_version, policy)
+    if opt.remove:
+        shutil.rmtree(directory, ignore_errors=True)
+        print(f'[INFO] removed {directory}')
+    else:
+        from diffstyler import PNP
+        ensure_export(opt.dir, opt.sd_version, policy, PNP.load_models)
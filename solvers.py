@@ -0,0 +1,73 @@
+import math
+
+import torch
+
+# sampler selection and the matching inversion
+#
+# 'ddim' is the original first-order sampler. 'dpmsolver++' is the second-order multistep DPM-Solver++(2M),
+# which reaches DDIM-50 quality in roughly 15-25 steps. Both reuse the noise schedule of the model's
+# scheduler. Source latents have to exist at every sampling timestep: the DPM-Solver schedule of N steps
+# (999, ..., round(999 / N)) differs from the DDIM one of the same length, so preprocess.py inverts on the
+# sampler's own schedule with dpm_solver_inversion, which saves a latent at each of those timesteps.
+# (Latents from a full 999-step DDIM inversion cover every timestep and work with either sampler.)
+
+SAMPLERS = ['ddim', 'dpmsolver++']
+
+
+def build_scheduler(sampler, scheduler):
+    # new scheduler of the given sampler with the noise schedule of `scheduler`
+    from diffusers import DDIMScheduler, DPMSolverMultistepScheduler
+
+    if sampler == 'ddim':
+        return DDIMScheduler.from_config(scheduler.config)
+    if sampler == 'dpmsolver++':
+        return DPMSolverMultistepScheduler.from_config(scheduler.config, algorithm_type='dpmsolver++',
+                                                       solver_order=2, lower_order_final=True)
+    raise ValueError(f'Sampler {sampler} not supported, use one of {SAMPLERS}.')
+
+
+def reset_scheduler(scheduler):
+    # multistep solvers keep the model outputs of previous steps; start a new sampling loop from scratch
+    if hasattr(scheduler, 'model_outputs'):
+        scheduler.model_outputs = [None] * scheduler.config.solver_order
+        scheduler.lower_order_nums = 0
+    return scheduler
+
+
+def _alpha_sigma(alphas_cumprod, t):
+    alpha_prod = alphas_cumprod[t].item()
+    return math.sqrt(alpha_prod), math.sqrt(1 - alpha_prod)
+
+
+@torch.no_grad()
+def dpm_solver_inversion(model_fn, latent, timesteps, alphas_cumprod, order=2, callback=None, start=0,
+                         solver_state=None, step_callback=None):
+    # DPM-Solver++ run backwards along the sampling schedule: from the clean latent (timestep 0, where the
+    # sampler's last step lands) up to timesteps[0]. model_fn(x, t) returns the noise prediction; as in the
+    # DDIM inversion it is evaluated at the target timestep. callback(x, t) gets the latent at every
+    # timestep of the schedule. With order=1 this is exactly the DDIM inversion.
+    # step_callback(steps_done, x, solver_state) gets the solver history after every step; passing a latent
+    # with its `start` and `solver_state` back in resumes the inversion there (see checkpoint.py)
+    path = [0] + [int(t) for t in reversed(timesteps)]
+    prev_x0, prev_h = (solver_state['prev_x0'], solver_state['prev_h']) if solver_state else (None, None)
+    for i, (s, t) in enumerate(zip(path[:-1], path[1:])):
+        if i < start:
+            continue
+        alpha_s, sigma_s = _alpha_sigma(alphas_cumprod, s)
+        alpha_t, sigma_t = _alpha_sigma(alphas_cumprod, t)
+        h = math.log(alpha_t / sigma_t) - math.log(alpha_s / sigma_s)
+
+        eps = model_fn(latent, t)
+        x0 = (latent - sigma_s * eps) / alpha_s
+        if order == 2 and prev_x0 is not None:
+            r = prev_h / h
+            d = (1 + 1 / (2 * r)) * x0 - 1 / (2 * r) * prev_x0
+        else:
+            d = x0
+        latent = (sigma_t / sigma_s) * latent - alpha_t * math.expm1(-h) * d
+        prev_x0, prev_h = x0, h
+        if callback is not None:
+            callback(latent, t)
+        if step_callback is not None:
+            step_callback(i + 1, latent, {'prev_x0': prev_x0, 'prev_h': prev_h})
+    return latent
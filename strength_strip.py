@@ -0,0 +1,88 @@
+import argparse
+import json
+import os
+import torch
+import torchvision.transforms as T
+import yaml
+from tqdm import tqdm
+
+from diffstyler import PNP
+from pnp_utils_combine import seed_everything
+from runtime import apply_runtime
+from solvers import reset_scheduler
+from sweep import contact_sheet
+
+# LoRA strength strip for one config, all strengths sampled in one batch
+#
+#   python strength_strip.py --config_path configs/config-girl1.yaml --scales 0 0.25 0.5 0.75 1
+#   python strength_strip.py --config_path configs/config-girl1.yaml --interpolate lora_models/lora_girl1.safetensors \
+#       --scales 0 0.5 1
+#
+# The LoRAs run in regional mode (lora_attention.py), where each sample of the batch gets its own strength
+# inside the attention processors; the models, prompts and source latents are loaded once.
+# --scales alone scales every LoRA of the config. With --interpolate, the first LoRA entry is blended
+# towards the given adapter (same mask and prompt): strength a gives (1 - a) * first + a * other, so the
+# ends of the strip match load_lora(unet, first, other, 0) and (..., 1).
+# Writes one image per strength, strip.png and strengths.json to <output_path>/strength.
+
+
+def strength_rows(n_loras, scales, interpolate):
+    # [V, n_loras] strengths, one row per sample
+    if interpolate:
+        return [[1 - a, a] + [1.0] * (n_loras - 2) for a in scales]
+    return [[s] * n_loras for s in scales]
+
+
+@torch.no_grad()
+def sample_strengths(pnp, strengths):
+    pnp.set_lora_strengths(strengths)
+    reset_scheduler(pnp.scheduler)
+    x = pnp.eps.repeat(len(strengths), 1, 1, 1)
+    for t in tqdm(pnp.scheduler.timesteps, desc=f"Sampling {len(strengths)} strengths"):
+        x = pnp.denoise_step(x, t)
+    return pnp.decode_latent(x)
+
+
+def run(opt):
+    with open(opt.config_path, "r") as f:
+        config = yaml.safe_load(f)
+    apply_runtime(config.get("runtime"))
+    config = dict(config, lora_mode='regional')
+    if opt.interpolate:
+        from lora_registry import parse_lora_configs
+        lora_configs = parse_lora_configs(config)
+        config["lora_configs"] = [lora_configs[0], dict(lora_configs[0], weight_path=opt.interpolate)] + lora_configs[1:]
+    output_dir = os.path.join(config["output_path"], 'strength')
+    os.makedirs(output_dir, exist_ok=True)
+
+    seed_everything(config["seed"])
+    pnp = PNP(config)
+    pnp.init_pnp(conv_injection_t=int(config["n_timesteps"] * config["pnp_f_t"]),
+                 qk_injection_t=int(config["n_timesteps"] * config["pnp_attn_t"]))
+    strengths = strength_rows(len(pnp.lora_configs), opt.scales, opt.interpolate)
+
+    images = []
+    for start in range(0, len(strengths), opt.batch_size):
+        decoded = sample_strengths(pnp, strengths[start:start + opt.batch_size])
+        images += [T.ToPILImage()(image) for image in decoded.float().cpu()]
+    pnp.set_lora_strengths(None)
+
+    labels = [f'{"alpha" if opt.interpolate else "scale"} {s:g}' for s in opt.scales]
+    for image, s in zip(images, opt.scales):
+        image.save(os.path.join(output_dir, f'strength_{s:g}.png'))
+    contact_sheet(images, labels, columns=len(images)).save(os.path.join(output_dir, 'strip.png'))
+    with open(os.path.join(output_dir, 'strengths.json'), 'w') as f:
+        json.dump({'interpolate': opt.interpolate, 'loras': [entry['weight_path'] for entry in pnp.lora_configs],
+                   'strengths': [{'value': s, 'lora_scales': row, 'image': f'strength_{s:g}.png'}
+                                 for s, row in zip(opt.scales, strengths)]}, f, indent=2)
+    print(f'[INFO] strength strip written to {output_dir}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config_path', type=str, default='configs/config-girl1.yaml')
+    parser.add_argument('--scales', type=float, nargs='+', default=[0.0, 0.25, 0.5, 0.75, 1.0])
+    parser.add_argument('--interpolate', type=str, default=None, help="adapter to blend the first LoRA towards")
+    parser.add_argument('--batch_size', type=int, default=5, help="strengths sampled together")
+    opt = parser.parse_args()
+    run(opt)
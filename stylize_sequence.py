@@ -0,0 +1,203 @@
+import argparse
+import copy
+import json
+import math
+import os
+import queue
+import threading
+import time
+import torch
+import torchvision.transforms as T
+import yaml
+from tqdm import tqdm
+
+from async_writer import AsyncWriter
+from checkpoint import atomic_write
+from diffstyler import PNP
+from pnp_utils_combine import seed_everything
+from precision import get_device, resolve_precision
+from preprocess import IMAGE_EXTENSIONS, Preprocess
+from runtime import apply_runtime
+from shared_weights import shared_models
+from solvers import reset_scheduler
+
+# stylize an image sequence (e.g. extracted video frames) with one config
+#
+#   python stylize_sequence.py --config_path configs/config-girl1.yaml --frames data/frames --warm_steps 15
+#
+# The SD models, LoRAs, prompt embeddings and mask pyramids are loaded once for the whole sequence (the
+# inversion and the sampling share the same SD weights), and the source latents stay in memory. Each frame is inverted on the sampling schedule itself (n_timesteps steps
+# of the config's sampler), so there are no per-timestep files.
+#
+# Warm start: consecutive frames share most of their noisy trajectory. Only the first --warm_steps
+# (low-noise) inversion steps are run for a frame; at the noisier timesteps its latents are the previous
+# frame's, shifted by the difference at the last inverted timestep w:
+#
+#   x_t = x'_t + sqrt(alpha_bar_t / alpha_bar_w) * (x_w - x'_w)
+#
+# (exact if both frames saw the same noise predictions above w). Every --keyframe_every frames the full
+# inversion is run again so errors do not accumulate. Sharing the noisy part of the trajectory also keeps
+# consecutive outputs consistent (less flicker).
+#
+# Three stages overlap: inversion (background thread, --queue_size frames ahead), sampling (main thread)
+# and encoding (PNG writes on an AsyncWriter). Per-frame timings and a flicker measure (mean absolute
+# change between consecutive outputs, next to the change between the input frames) go to sequence.json.
+
+
+def list_frames(path):
+    return sorted(os.path.join(path, name) for name in os.listdir(path) if name.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def warm_start(latents, previous, alphas_cumprod):
+    # fill the timesteps above the highest inverted one from the previous frame's trajectory
+    w = max(latents)
+    shift = latents[w] - previous[w]
+    for t, latent in previous.items():
+        if t > w:
+            latents[t] = latent + math.sqrt(alphas_cumprod[t].item() / alphas_cumprod[w].item()) * shift
+    return latents
+
+
+def load_models(config, device):
+    # the SD models of the config, for both the inversion and the PNP
+    if config.get("shared_weights"):
+        policy = resolve_precision(config.get("precision"), device)
+        models = shared_models(config["shared_weights"], config["sd_version"], policy, device, PNP.load_models)
+        if models is not None:
+            return models
+    return PNP.load_models(config["sd_version"])
+
+
+class FrameInverter:
+    def __init__(self, config, models, warm_steps=None, keyframe_every=0):
+        # models: the dict the PNP is built from. The inversion runs in its own thread while the PNP samples
+        # and patches its UNet (injection, token merging, ...), so it gets a UNet module of its own that
+        # shares the parameters and buffers of that one; VAE and text encoder are used as they are. Only int8
+        # quantization with quantize_lora: merge writes into the PNP's UNet weights, it then gets a full copy.
+        unet = models['unet']
+        merged = config.get("quantize") and config.get("quantize_lora", "keep") == "merge"
+        memo = {} if merged else {id(tensor): tensor for tensor in list(unet.parameters()) + list(unet.buffers())}
+        models = dict(models, unet=copy.deepcopy(unet, memo))
+        self.model = Preprocess(get_device(config["device"]), sd_version=config["sd_version"],
+                                precision=config.get("precision"), models=models,
+                                sampler=config.get("sampler", "ddim"))
+        self.model.scheduler.set_timesteps(config["n_timesteps"])
+        with torch.no_grad():
+            self.cond = self.model.get_text_embeds(config.get("inversion_prompt", ""), "",
+                                                   device_type=self.model.device.type)[1].unsqueeze(0)
+        self.warm_steps = warm_steps
+        self.keyframe_every = keyframe_every
+        self.previous = None
+        self.index = 0
+
+    @torch.no_grad()
+    def __call__(self, frame_path):
+        start = time.perf_counter()
+        image = self.model.load_img(frame_path)
+        latent = self.model.encode_imgs(image)
+        keyframe = (self.previous is None or not self.warm_steps
+                    or (self.keyframe_every and self.index % self.keyframe_every == 0))
+        latents = {}
+        self.model.inversion_func(self.cond, latent, latents, n_steps=None if keyframe else self.warm_steps)
+        if not keyframe:
+            latents = warm_start(latents, self.previous, self.model.scheduler.alphas_cumprod)
+        self.previous = latents
+        self.index += 1
+        return {'path': frame_path, 'image': image.cpu(), 'latents': latents, 'keyframe': keyframe,
+                'inversion_s': time.perf_counter() - start}
+
+
+def invert_frames(inverter, frame_paths, frames, errors):
+    # inversion stage: runs ahead of the sampling by at most the queue size
+    try:
+        for frame_path in frame_paths:
+            frames.put(inverter(frame_path))
+    except Exception as e:
+        errors.append(e)
+    frames.put(None)
+
+
+@torch.no_grad()
+def sample_frame(pnp, latents):
+    pnp.set_source(latents)
+    reset_scheduler(pnp.scheduler)
+    x = pnp.eps
+    for t in pnp.scheduler.timesteps:
+        x = pnp.denoise_step(x, t)
+    return pnp.decode_latent(x)
+
+
+def save_frame(image, path):
+    atomic_write(path, T.ToPILImage()(image).save)
+
+
+def run(opt):
+    with open(opt.config_path, "r") as f:
+        config = yaml.safe_load(f)
+    apply_runtime(config.get("runtime"))
+    frame_paths = list_frames(opt.frames)
+    if not frame_paths:
+        raise ValueError(f'No frames in {opt.frames}.')
+    output_dir = opt.output_dir or os.path.join(config["output_path"], 'sequence')
+    os.makedirs(output_dir, exist_ok=True)
+    # the first frame stands in for image_path (only its size and preview are used)
+    config = dict(config, image_path=frame_paths[0], output_path=output_dir)
+
+    seed_everything(config["seed"])
+    models = load_models(config, get_device(config["device"]))
+    inverter = FrameInverter(config, models, warm_steps=opt.warm_steps, keyframe_every=opt.keyframe_every)
+    frames = queue.Queue(maxsize=opt.queue_size)
+    errors = []
+    worker = threading.Thread(target=invert_frames, args=(inverter, frame_paths, frames, errors),
+                              name='inversion', daemon=True)
+    worker.start()
+
+    pnp = None
+    stats = []
+    previous = None
+    start = time.perf_counter()
+    with AsyncWriter(name='encode', max_pending=opt.queue_size) as writer:
+        for _ in tqdm(frame_paths, desc="Frames"):
+            frame = frames.get()
+            if frame is None:
+                break
+            if pnp is None:
+                # LoRAs and prompts load while the inversion of the next frames goes on
+                pnp = PNP(config, models=models, source_latents=frame['latents'])
+                # quantize / compile as in diffstyler.py (calibrated on the first frame)
+                pnp.prepare_unets()
+            sample_start = time.perf_counter()
+            image = sample_frame(pnp, frame['latents'])[0].cpu()
+            name = os.path.splitext(os.path.basename(frame['path']))[0]
+            writer.submit(save_frame, image, os.path.join(output_dir, f'{name}.png'))
+            row = {'frame': name, 'keyframe': frame['keyframe'], 'inversion_s': frame['inversion_s'],
+                   'sampling_s': time.perf_counter() - sample_start}
+            if previous is not None:
+                row['flicker'] = (image - previous['output']).abs().mean().item()
+                if frame['image'].shape == previous['input'].shape:
+                    row['input_change'] = (frame['image'] - previous['input']).abs().mean().item()
+            previous = {'output': image, 'input': frame['image']}
+            stats.append(row)
+    worker.join()
+    if errors:
+        raise errors[0]
+
+    total_s = time.perf_counter() - start
+    meta = {'config': opt.config_path, 'frames': len(stats), 'warm_steps': opt.warm_steps,
+            'keyframe_every': opt.keyframe_every, 'total_s': total_s, 'fps': len(stats) / total_s}
+    atomic_write(os.path.join(output_dir, 'sequence.json'),
+                 lambda f: json.dump({'meta': meta, 'frames': stats}, f, indent=2), mode='w')
+    print(f'[INFO] {len(stats)} frames in {total_s:.1f} s ({meta["fps"]:.3f} frames/s), written to {output_dir}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config_path', type=str, default='configs/config-girl1.yaml')
+    parser.add_argument('--frames', type=str, required=True, help="directory of frames, processed in name order")
+    parser.add_argument('--output_dir', type=str, default=None, help="default: <output_path>/sequence")
+    parser.add_argument('--warm_steps', type=int, default=None,
+                        help="inversion steps per frame after the first, the rest is warm-started (default: full)")
+    parser.add_argument('--keyframe_every', type=int, default=0, help="run the full inversion every N frames")
+    parser.add_argument('--queue_size', type=int, default=2, help="frames the inversion may run ahead")
+    opt = parser.parse_args()
+    run(opt)
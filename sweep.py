@@ -0,0 +1,105 @@
+import argparse
+import itertools
+import json
+import os
+import torch
+import torchvision.transforms as T
+import yaml
+from PIL import Image, ImageDraw
+from tqdm import tqdm
+
+from checkpoint import atomic_write
+from diffstyler import PNP
+from pnp_utils_combine import seed_everything
+from runtime import apply_runtime
+from solvers import reset_scheduler
+
+# batched sweep over guidance_scale, pnp_attn_t and pnp_f_t for one config
+#
+#   python sweep.py --config_path configs/config-girl1.yaml --guidance_scale 7.5 10.5 15 \
+#       --pnp_attn_t 0.3 0.5 --pnp_f_t 0.5 0.8 --batch_size 4
+#
+# The models, text embeddings, LoRAs and source latents are loaded once. Variants run together as rows of one
+# sampling batch ([source x V, uncond x V, cond x V]), each with its own guidance scale and its own
+# injection gates. Thresholds give int(n_timesteps * t) steps of injection, as in run_pnp, so a variant
+# picked from the contact sheet is reproduced by diffstyler.py with the same config values. Writes one image
+# per variant, a contact sheet and variants.json to <output_path>/sweep.
+
+PARAMS = ['guidance_scale', 'pnp_attn_t', 'pnp_f_t']
+
+
+def variant_grid(config, grid):
+    values = [grid.get(name) or [config[name]] for name in PARAMS]
+    return [dict(zip(PARAMS, combination)) for combination in itertools.product(*values)]
+
+
+def variant_label(variant):
+    return f'g{variant["guidance_scale"]:g}_attn{variant["pnp_attn_t"]:g}_f{variant["pnp_f_t"]:g}'
+
+
+@torch.no_grad()
+def sample_variants(pnp, variants):
+    n_timesteps = pnp.config["n_timesteps"]
+    pnp.init_pnp_variants(conv_injection_ts=[int(n_timesteps * v['pnp_f_t']) for v in variants],
+                          qk_injection_ts=[int(n_timesteps * v['pnp_attn_t']) for v in variants])
+    pnp.guidance_scale = torch.tensor([v['guidance_scale'] for v in variants],
+                                      device=pnp.device).view(-1, 1, 1, 1)
+    reset_scheduler(pnp.scheduler)
+    x = pnp.eps.repeat(len(variants), 1, 1, 1)
+    for t in tqdm(pnp.scheduler.timesteps, desc=f"Sampling {len(variants)} variants"):
+        x = pnp.denoise_step(x, t)
+    return pnp.decode_latent(x)
+
+
+def contact_sheet(images, labels, columns):
+    # grid of the variant images, each labelled in its top-left corner
+    width, height = images[0].size
+    rows = (len(images) + columns - 1) // columns
+    sheet = Image.new('RGB', (columns * width, rows * height), 'white')
+    draw = ImageDraw.Draw(sheet)
+    for i, (image, label) in enumerate(zip(images, labels)):
+        x, y = (i % columns) * width, (i // columns) * height
+        sheet.paste(image, (x, y))
+        draw.rectangle([x, y, x + 7 * len(label) + 8, y + 16], fill='black')
+        draw.text((x + 4, y + 3), label, fill='white')
+    return sheet
+
+
+def run(opt):
+    with open(opt.config_path, "r") as f:
+        config = yaml.safe_load(f)
+    apply_runtime(config.get("runtime"))
+    output_dir = os.path.join(config["output_path"], 'sweep')
+    os.makedirs(output_dir, exist_ok=True)
+
+    variants = variant_grid(config, {'guidance_scale': opt.guidance_scale, 'pnp_attn_t': opt.pnp_attn_t,
+                                     'pnp_f_t': opt.pnp_f_t})
+    print(f'[INFO] {len(variants)} variants in batches of {opt.batch_size}')
+    seed_everything(config["seed"])
+    pnp = PNP(config)
+
+    images = []
+    for start in range(0, len(variants), opt.batch_size):
+        decoded = sample_variants(pnp, variants[start:start + opt.batch_size])
+        images += [T.ToPILImage()(image) for image in decoded.float().cpu()]
+
+    labels = [variant_label(variant) for variant in variants]
+    for image, label in zip(images, labels):
+        atomic_write(os.path.join(output_dir, f'{label}.png'), image.save)
+    columns = opt.columns or len(opt.guidance_scale or [config["guidance_scale"]])
+    atomic_write(os.path.join(output_dir, 'contact_sheet.png'), contact_sheet(images, labels, columns).save)
+    index = [dict(variant, image=f'{label}.png') for variant, label in zip(variants, labels)]
+    atomic_write(os.path.join(output_dir, 'variants.json'), lambda f: json.dump(index, f, indent=2), mode='w')
+    print(f'[INFO] sweep written to {output_dir}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config_path', type=str, default='configs/config-girl1.yaml')
+    parser.add_argument('--guidance_scale', type=float, nargs='*', default=None)
+    parser.add_argument('--pnp_attn_t', type=float, nargs='*', default=None)
+    parser.add_argument('--pnp_f_t', type=float, nargs='*', default=None)
+    parser.add_argument('--batch_size', type=int, default=4, help="variants sampled together")
+    parser.add_argument('--columns', type=int, default=None, help="contact sheet columns (default: one per guidance scale)")
+    opt = parser.parse_args()
+    run(opt)
@@ -0,0 +1,147 @@
+import copy
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import torch.nn as nn
+from PIL import Image
+from transformers import CLIPTextConfig, CLIPTextModel
+from diffusers import AutoencoderKL, DDIMScheduler, DDPMScheduler, UNet2DConditionModel
+from diffusers.loaders import AttnProcsLayers
+from safetensors.torch import save_file
+
+# small, randomly initialized stand-ins for the SD 2.1 components, for offline benchmarks
+#
+# The UNet keeps the SD block layout that register_time and the PnP injection helpers index into
+# (3 cross-attention down blocks + 1 plain, cross-attention mid block, 1 plain + 3 cross-attention up
+# blocks with 3 resnets/attentions each), only with far fewer channels. Nothing here touches the network.
+
+SCHEDULER_CONFIG = dict(num_train_timesteps=1000, beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear",
+                        clip_sample=False, set_alpha_to_one=False, steps_offset=1, prediction_type="epsilon")
+
+
+class TinyTokenizer:
+    # character-level tokenizer with the call interface of CLIPTokenizer used in this repo
+    def __init__(self, vocab_size=1000, model_max_length=77):
+        self.vocab_size = vocab_size
+        self.model_max_length = model_max_length
+        self.pad_token_id, self.bos_token_id, self.eos_token_id = 0, 1, 2
+
+    def __call__(self, prompt, padding='max_length', max_length=None, truncation=True, return_tensors='pt'):
+        prompts = [prompt] if isinstance(prompt, str) else list(prompt)
+        max_length = max_length or self.model_max_length
+        input_ids = []
+        for text in prompts:
+            tokens = [3 + ord(c) % (self.vocab_size - 3) for c in text][:max_length - 2]
+            tokens = [self.bos_token_id] + tokens + [self.eos_token_id]
+            input_ids.append(tokens + [self.pad_token_id] * (max_length - len(tokens)))
+        input_ids = torch.tensor(input_ids)
+        return SimpleNamespace(input_ids=input_ids, attention_mask=(input_ids != self.pad_token_id).long())
+
+
+def build_tiny_models(latent_size=32, seed=0, channels=32, cross_attention_dim=32):
+    torch.manual_seed(seed)
+    text_encoder = CLIPTextModel(CLIPTextConfig(vocab_size=1000, hidden_size=cross_attention_dim, intermediate_size=64,
+                                                num_attention_heads=4, num_hidden_layers=2,
+                                                max_position_embeddings=77, projection_dim=cross_attention_dim))
+    unet = UNet2DConditionModel(
+        sample_size=latent_size,
+        in_channels=4,
+        out_channels=4,
+        layers_per_block=2,
+        block_out_channels=(channels, channels, 2 * channels, 2 * channels),
+        down_block_types=("CrossAttnDownBlock2D", "CrossAttnDownBlock2D", "CrossAttnDownBlock2D", "DownBlock2D"),
+        up_block_types=("UpBlock2D", "CrossAttnUpBlock2D", "CrossAttnUpBlock2D", "CrossAttnUpBlock2D"),
+        cross_attention_dim=cross_attention_dim,
+        attention_head_dim=4,
+        use_linear_projection=True,
+    )
+    vae = AutoencoderKL(
+        in_channels=3,
+        out_channels=3,
+        down_block_types=("DownEncoderBlock2D",) * 4,
+        up_block_types=("UpDecoderBlock2D",) * 4,
+        block_out_channels=(channels,) * 4,
+        layers_per_block=1,
+        latent_channels=4,
+        sample_size=latent_size * 8,
+    )
+    return {'vae': vae.eval(), 'tokenizer': TinyTokenizer(), 'text_encoder': text_encoder.eval(), 'unet': unet.eval(),
+            'scheduler': DDIMScheduler(**SCHEDULER_CONFIG), 'noise_scheduler': DDPMScheduler(**SCHEDULER_CONFIG)}
+
+
+def build_tiny_feature_extractor(seed=0):
+    # stand-in for the VGG19 features used by the style loss: convs at the same layer indices (0, 5, 10, 19, 28)
+    torch.manual_seed(seed)
+    layers = []
+    for i in range(29):
+        if i == 0:
+            layers.append(nn.Conv2d(3, 8, 3, padding=1))
+        elif i in (5, 10, 19, 28):
+            layers.append(nn.Conv2d(8, 8, 3, padding=1))
+        elif i in (4, 9, 18, 27):
+            layers.append(nn.MaxPool2d(2))
+        else:
+            layers.append(nn.ReLU())
+    vgg = nn.Sequential(*layers).eval()
+    for param in vgg.parameters():
+        param.requires_grad_(False)
+    return vgg
+
+
+def build_tiny_workspace(root, models, n_timesteps=50, n_loras=2, lora_rank=4, seed=0):
+    # content image, cached source latents, masks and random LoRA checkpoints in the layout of the real
+    # pipeline, plus a config that points at them
+    from lora_train import create_lora_attn_procs
+
+    generator = torch.Generator().manual_seed(seed)
+    latent_size = models['unet'].config.sample_size
+    image_size = latent_size * 8
+    os.makedirs(root, exist_ok=True)
+
+    image_path = os.path.join(root, 'tiny.png')
+    pixels = (torch.rand(image_size, image_size, 3, generator=generator) * 255).to(torch.uint8).numpy()
+    Image.fromarray(pixels).save(image_path)
+
+    # source latents for every sampling timestep, as preprocess.py would have saved them
+    latents_path = os.path.join(root, 'latents_forward')
+    os.makedirs(os.path.join(latents_path, 'tiny'), exist_ok=True)
+    scheduler = copy.deepcopy(models['scheduler'])
+    scheduler.set_timesteps(n_timesteps)
+    for t in scheduler.timesteps:
+        latents = torch.randn(1, 4, latent_size, latent_size, generator=generator)
+        torch.save(latents, os.path.join(latents_path, 'tiny', f'noisy_latents_{t}.pt'))
+
+    lora_configs = []
+    for i in range(n_loras):
+        # vertical stripes, one per LoRA
+        mask = np.zeros((image_size, image_size), dtype=np.uint8)
+        mask[:, i * image_size // n_loras:(i + 1) * image_size // n_loras] = 255
+        mask_path = os.path.join(root, f'mask_{i}.png')
+        Image.fromarray(mask).save(mask_path)
+
+        procs = create_lora_attn_procs(models['unet'], lora_rank)
+        for name, param in AttnProcsLayers(procs).named_parameters():
+            # LoRA up-projections start at zero, randomize them so the adapters do something
+            if name.endswith('up.weight'):
+                param.data.normal_(0, 0.02, generator=generator)
+        weight_path = os.path.join(root, f'lora_{i}.safetensors')
+        save_file(AttnProcsLayers(procs).state_dict(), weight_path, metadata={'format': 'pt'})
+        lora_configs.append({'weight_path': weight_path, 'mask_path': mask_path, 'prompt': f'painting of <sss>, region {i}'})
+
+    return {
+        'seed': seed,
+        'device': 'cpu',
+        'output_path': os.path.join(root, 'results'),
+        'image_path': image_path,
+        'latents_path': latents_path,
+        'sd_version': 'tiny',
+        'guidance_scale': 10.5,
+        'n_timesteps': n_timesteps,
+        'prompt': '',
+        'negative_prompt': 'ugly, blurry, black, low res, unrealistic',
+        'pnp_attn_t': 0.5,
+        'pnp_f_t': 0.8,
+        'lora_configs': lora_configs,
+    }
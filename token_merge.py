@@ -0,0 +1,170 @@
+import math
+
+import torch
+
+# token merging (ToMe) for the self-attention of the highest-resolution UNet layers
+#
+# The attn1 layers of down_blocks[0] and up_blocks[3] attend over every latent pixel (4096 tokens at 512px),
+# which is the bulk of the attention cost. Before such a layer, `ratio` of the tokens are merged into their
+# most similar neighbour (bipartite soft matching: the grid is split into sx x sy cells, one token per cell is
+# a destination, the best-matching sources are averaged into their destinations). Attention runs on the
+# merged tokens and its output is copied back to every merged token afterwards.
+#
+# The matching is computed on the source rows of the [source, uncond, cond] batch and used for all three
+# groups, so a merged token stands for the same pixels in every row and the PnP injection (source queries
+# and keys copied to the other rows) stays aligned. The destinations per cell are drawn once per grid size
+# from a fixed seed, so every step and every branch merges the same way for the same features.
+#
+# `token_merge: 0.5` in a config (or {ratio: 0.5, sx: 2, sy: 2, seed: 0}) enables it, see register_token_merge.
+
+TOKEN_MERGE_LAYERS = {'down_blocks': {0: [0, 1]}, 'up_blocks': {3: [0, 1, 2]}}
+
+
+class TokenMerge:
+    # merge / unmerge of one layer call, for a batch of `rows` rows sharing the matching of `groups` groups
+    def __init__(self, a_idx, b_idx, unm_idx, src_idx, dst_idx, n_tokens):
+        self.a_idx, self.b_idx = a_idx, b_idx
+        self.unm_idx, self.src_idx, self.dst_idx = unm_idx, src_idx, dst_idx
+        self.n_tokens = n_tokens
+
+    def _split(self, x):
+        c = x.shape[-1]
+        src = torch.gather(x, 1, self.a_idx.expand(x.shape[0], self.a_idx.shape[1], c))
+        dst = torch.gather(x, 1, self.b_idx.expand(x.shape[0], self.b_idx.shape[1], c))
+        return src, dst
+
+    def merge(self, x):
+        # [rows, n_tokens, c] -> [rows, n_tokens - r, c]
+        src, dst = self._split(x)
+        rows, _, c = src.shape
+        unm = torch.gather(src, 1, self.unm_idx.expand(rows, self.unm_idx.shape[1], c))
+        src = torch.gather(src, 1, self.src_idx.expand(rows, self.src_idx.shape[1], c))
+        dst = dst.scatter_reduce(1, self.dst_idx.expand(rows, self.dst_idx.shape[1], c), src, reduce='mean')
+        return torch.cat([unm, dst], dim=1)
+
+    def unmerge(self, x):
+        # [rows, n_tokens - r, c] -> [rows, n_tokens, c], every merged token gets the output of its destination
+        n_unm = self.unm_idx.shape[1]
+        unm, dst = x[:, :n_unm], x[:, n_unm:]
+        rows, _, c = x.shape
+        src = torch.gather(dst, 1, self.dst_idx.expand(rows, self.dst_idx.shape[1], c))
+        out = x.new_zeros(rows, self.n_tokens, c)
+        out.scatter_(1, self.b_idx.expand(rows, self.b_idx.shape[1], c), dst)
+        a_idx = self.a_idx.expand(self.unm_idx.shape[0], self.a_idx.shape[1], 1)
+        out.scatter_(1, torch.gather(a_idx, 1, self.unm_idx).expand(rows, n_unm, c), unm)
+        out.scatter_(1, torch.gather(a_idx, 1, self.src_idx).expand(rows, self.src_idx.shape[1], c), src)
+        return out
+
+
+class TokenMergeState:
+    # settings and per-call state shared by the merging hooks of one UNet
+    def __init__(self, ratio, sx=2, sy=2, seed=0):
+        if not 0 <= ratio < 1:
+            raise ValueError(f'token_merge ratio must be in [0, 1), got {ratio}.')
+        self.ratio = ratio
+        self.sx, self.sy = sx, sy
+        self.seed = seed
+        self.latent_size = None
+        self._partitions = {}
+
+    def grid(self, n_tokens):
+        # height and width of the token grid of a layer, from the latent size of the current UNet call
+        height, width = self.latent_size
+        downsample = max(round(math.sqrt(height * width / n_tokens)), 1)
+        return math.ceil(height / downsample), math.ceil(width / downsample)
+
+    def partition(self, h, w, device):
+        # token indices of the sources and of the destinations (one random token per sy x sx cell)
+        key = (h, w, device)
+        if key not in self._partitions:
+            sx, sy = self.sx, self.sy
+            hsy, wsx = h // sy, w // sx
+            generator = torch.Generator().manual_seed(self.seed)
+            rand_idx = torch.randint(sy * sx, size=(hsy, wsx, 1), generator=generator)
+            cells = torch.zeros(hsy, wsx, sy * sx, dtype=torch.int64)
+            cells.scatter_(2, rand_idx, -1)
+            cells = cells.view(hsy, wsx, sy, sx).transpose(1, 2).reshape(hsy * sy, wsx * sx)
+            buffer = torch.zeros(h, w, dtype=torch.int64)
+            buffer[:hsy * sy, :wsx * sx] = cells
+            order = buffer.reshape(1, -1, 1).argsort(dim=1)
+            n_dst = hsy * wsx
+            self._partitions[key] = (order[:, n_dst:].to(device), order[:, :n_dst].to(device))
+        return self._partitions[key]
+
+    def matching(self, x):
+        # TokenMerge for x [rows, n_tokens, c]; the matching of the source rows is shared by the three groups
+        rows, n_tokens, _ = x.shape
+        h, w = self.grid(n_tokens)
+        if h * w != n_tokens:
+            return None
+        a_idx, b_idx = self.partition(h, w, x.device)
+        groups = 3 if rows % 3 == 0 else 1
+        metric = x[:rows // groups].float()
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        c = metric.shape[-1]
+        src = torch.gather(metric, 1, a_idx.expand(metric.shape[0], a_idx.shape[1], c))
+        dst = torch.gather(metric, 1, b_idx.expand(metric.shape[0], b_idx.shape[1], c))
+        scores = src @ dst.transpose(-1, -2)
+        r = min(int(n_tokens * self.ratio), src.shape[1])
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unm_idx, src_idx = edge_idx[:, r:], edge_idx[:, :r]
+        dst_idx = torch.gather(node_idx[..., None], 1, src_idx)
+        unm_idx, src_idx, dst_idx = (idx.repeat(groups, 1, 1) for idx in (unm_idx, src_idx, dst_idx))
+        return TokenMerge(a_idx, b_idx, unm_idx, src_idx, dst_idx, n_tokens)
+
+
+def token_merge_settings(setting):
+    # `token_merge` config entry: a ratio, or {ratio, sx, sy, seed}
+    if isinstance(setting, dict):
+        return setting
+    return {'ratio': float(setting)}
+
+
+def token_merge_modules(model_unet):
+    for blocks_name, blocks in TOKEN_MERGE_LAYERS.items():
+        for res, attentions in blocks.items():
+            for block in attentions:
+                yield getattr(model_unet, blocks_name)[res].attentions[block].transformer_blocks[0].attn1
+
+
+def register_token_merge(model_unet, ratio, sx=2, sy=2, seed=0):
+    # merge tokens around the attn1 layers of TOKEN_MERGE_LAYERS; works with the patched PnP forwards and with
+    # the attention processors alike (hooks run around whichever forward the module has)
+    remove_token_merge(model_unet)
+    state = TokenMergeState(ratio, sx=sx, sy=sy, seed=seed)
+
+    def record_size(module, args, kwargs):
+        sample = args[0] if args else kwargs['sample']
+        state.latent_size = tuple(sample.shape[-2:])
+
+    def merge(module, args, kwargs):
+        module.token_merge = None
+        if not args or kwargs.get('encoder_hidden_states') is not None or state.ratio == 0:
+            return None
+        token_merge = state.matching(args[0])
+        if token_merge is None:
+            return None
+        # processors that work per token (the regional LoRA masks) read the merge of this call here
+        module.token_merge = token_merge
+        return (token_merge.merge(args[0]),) + tuple(args[1:]), kwargs
+
+    def unmerge(module, args, output):
+        token_merge, module.token_merge = module.token_merge, None
+        return output if token_merge is None else token_merge.unmerge(output)
+
+    handles = [model_unet.register_forward_pre_hook(record_size, with_kwargs=True)]
+    for module in token_merge_modules(model_unet):
+        handles.append(module.register_forward_pre_hook(merge, with_kwargs=True))
+        handles.append(module.register_forward_hook(unmerge))
+        module.token_merge = None
+    model_unet.token_merge_handles = handles
+    model_unet.token_merge_state = state
+    return state
+
+
+def remove_token_merge(model_unet):
+    for handle in getattr(model_unet, 'token_merge_handles', []):
+        handle.remove()
+    model_unet.token_merge_handles = []
+    model_unet.token_merge_state = None